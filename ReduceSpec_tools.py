@@ -18,6 +18,7 @@ import os
 import datetime
 import matplotlib.pyplot as plt
 import cosmics
+import fitsaccess
 from glob import glob
 from astropy.convolution import convolve, convolve_fft, Box2DKernel
 
@@ -332,9 +333,7 @@ def Trim_Spec(img):
     # The limits of the 1x2 trim are: [:, 1:199, 19:4111]
     print "\n====================\n"  
     print 'Triming Image: %s\n' % img
-    img_head= fits.getheader(img) 
-    img_data= fits.getdata(img)    
-    Fix_Header(img_head)
+    img_head, img_data= fitsaccess.read(img)
     try:
         length = float(img_head['PARAM17'])
     except:
@@ -417,14 +416,11 @@ def Mult_Scale (img_block,index):
 def lacosmic(img):
     print ''
     print 'Finding cosmic rays in ', img
-    datalist = fits.open(img)
-    data = datalist[0].data
+    header, data = fitsaccess.read(img)
     data2 = data[0,:,:]
     array = data2
-    header = fits.getheader(img)
-    Fix_Header(header) 
-    gain = 1.33 #datalist[0].header['GAIN'] #1.33 from 2017-06-07
-    rdnoise = datalist[0].header['RDNOISE']
+    gain = 1.33 #header['GAIN'] #1.33 from 2017-06-07
+    rdnoise = header['RDNOISE']
 
     c = cosmics.cosmicsimage(array, gain=gain, readnoise=rdnoise, sigclip = 5.0, sigfrac = 0.5, objlim = 4.0,satlevel=45000.0,verbose=True)
     c.run(maxiter=4)
@@ -452,13 +448,11 @@ def Bias_Subtract( img_list, zero_img ):
     print "\n====================\n"  
     print 'Bias Subtracting Images: \n' 
         
-    zero_data = fits.getdata(zero_img)
+    zero_data = fitsaccess.read_data(zero_img)
     bias_sub_list = []
     for img in img_list:
         print img
-        hdu = fits.getheader(img)
-        Fix_Header(hdu) 
-        img_data = fits.getdata(img)
+        hdu, img_data = fitsaccess.read(img)
         img_data[ np.isnan(img_data) ] = 0
         b_img_data = np.subtract(img_data, zero_data)
         print 'b.'+"%s Mean: %.3f StDev: %.3f" % (img, np.mean(b_img_data), np.std(img_data))
@@ -479,15 +473,13 @@ def Norm_Flat_Avg( flat ):
     print "\n====================\n" 
     print 'Normalizing %s By Dividing Each Pixel By Average Value:' % ( flat )
     # Read Data, take average, and divide # 
-    flat_data = fits.getdata(flat)
+    hdu, flat_data = fitsaccess.read(flat)
     flat_data[ np.isnan(flat_data) ] = 0
     # Calculate Average of the flat excluding bottom row and overscan regions # 
     avg_flat = np.average( flat_data[:, 1:200, 9:2055] )
     norm_flat_data = np.divide( flat_data, float(avg_flat) )
     print 'Average Value: %s\n' % avg_flat
-    # Copy Header, write changes, and write file #
-    hdu = fits.getheader(flat)
-    Fix_Header(hdu)
+    # Write changes to header, and write file #
     hdu.append( ('NORMFLAT', avg_flat,'Average Used to Normalize the Flat.'), 
                useblanks= True, bottom= True )
     NewHdu = fits.PrimaryHDU(data= norm_flat_data, header= hdu)
@@ -529,7 +521,7 @@ def Norm_Flat_Poly( flat , order):
         litt_low = 100
         litt_hi = 99
     # Read Flat and Average Center Rows # 
-    flat_data = fits.getdata(flat)
+    hdu, flat_data = fitsaccess.read(flat)
     flat_data[ np.isnan(flat_data) ] = 0
     fit_data= np.median(flat_data[0][95:105], axis=0) # Median of center Rows ###
     X= range(0,len(fit_data)) # Column Numbers 
@@ -561,9 +553,7 @@ def Norm_Flat_Poly( flat , order):
             row[i]= row[i]/profile[i]
             i= i+1   
             
-    # Copy Header, write changes, and write file #
-    hdu = fits.getheader(flat)
-    Fix_Header(hdu)
+    # Write changes to header, and write file #
     hdu.append( ('NORMFLAT ', order,'Flat Polynomial Fit Order'), 
                useblanks= True, bottom= True )
     for i in range(0,len(coeff)):
@@ -584,7 +574,7 @@ def Norm_Flat_Poly( flat , order):
 
 def Norm_Flat_Boxcar( flat ):
     print 'Normalizing ', flat , 'by boxcar smoothing'
-    flat_image = fits.getdata(flat)
+    hdu, flat_image = fitsaccess.read(flat)
     flat_data = flat_image[0,:,:] ###
     #See if littrow ghost file already exists for blue files
     if flat.lower().__contains__("blue")== True:
@@ -642,9 +632,7 @@ def Norm_Flat_Boxcar( flat ):
         diagnostic[0:len(image_divided[100,:]),15] = image_divided[100,:]
 
 
-    # Copy Header, write changes, and write file #
-    hdu = fits.getheader(flat)
-    Fix_Header(hdu)
+    # Write changes to header, and write file #
     hdu.append( ('FLATTYPE', 'BOXCAR','Kernel used to flatten'), useblanks= True, bottom= True )
     hdu.append(('KERNEL',kernel_size,'Kernel size used'), useblanks= True, bottom= True )
     NewHdu = fits.PrimaryHDU(data= image_divided, header= hdu)
@@ -658,10 +646,9 @@ def Norm_Flat_Boxcar( flat ):
 
 def Norm_Flat_Boxcar_Multiples( flat ,adc_stat=None):
     print 'Normalizing ', flat, 'by using multiple boxcars.'
-    flat_image = fits.getdata(flat)
+    hdu, flat_image = fitsaccess.read(flat)
     quartz_data = flat_image[0,:,:] ###
     if adc_stat == None:
-        hdu = fits.getheader(flat)
         adc_stat = hdu['ADCSTAT']
     print 'Using ADC status: ', adc_stat
     if adc_stat == 'IN':
@@ -833,7 +820,6 @@ def Norm_Flat_Boxcar_Multiples( flat ,adc_stat=None):
     ###############################
     #Do a 200 pixel boxcar on the original quartz flat and use that for the first 760 pixels.
     ###############################
-    flat_image = fits.getdata(flat)
     flat_data = flat_image[0,:,:] ###
     # Calculate Fit # 
     fit_data = np.median(flat_data[95:105],axis=0)
@@ -883,9 +869,7 @@ def Norm_Flat_Boxcar_Multiples( flat ,adc_stat=None):
     if flat.lower().__contains__("blue"):
         diagnostic[0:len(newimage[100,:]),14] = newimage[100,:]
 
-    # Copy Header, write changes, and write file #
-    hdu = fits.getheader(flat)
-    Fix_Header(hdu)
+    # Write changes to header, and write file #
     hdu.append( ('FLATTYPE', 'BOXCAR','Kernel used to flatten'), useblanks= True, bottom= True )
     hdu.append(('KERNEL',kernel_size,'Kernel size used'), useblanks= True, bottom= True )
     hdu.append(('DOMEFLAT',dome_flat_name,'Dome Flat used'), useblanks= True, bottom= True )
@@ -910,7 +894,7 @@ def Flat_Field( spec_list, flat ):
     print 'Flat Fielding Images by Dividing by %s\n' % (flat) 
     
     np.seterr(divide= 'warn')
-    flat_data = fits.getdata(flat)
+    hduflat, flat_data = fitsaccess.read(flat)
     #If flat is a blue spectrum, find the Littrow ghost and add those pixels to the header
     if 'blue' in flat.lower():
         #See if littrow_ghost.txt already exists
@@ -932,7 +916,6 @@ def Flat_Field( spec_list, flat ):
             litt_low = int(littrow_ghost[0])
             litt_hi = int(littrow_ghost[1])
         try:
-            hduflat = fits.getheader(flat)
             stitchloc = hduflat['STITCHLO']
             #print stitchloc
         except:
@@ -945,12 +928,10 @@ def Flat_Field( spec_list, flat ):
     if isinstance(spec_list,str):
         spec_list = [spec_list] #Ensure that spec_list is actually a list
     for spec in spec_list:
-        spec_data = fits.getdata(spec)
+        hdu, spec_data = fitsaccess.read(spec)
         f_spec_data = np.divide(spec_data, flat_data)
         f_spec_data[ np.isnan(f_spec_data) ] = 0
         print "f"+"%s Mean: %.3f StDev: %.3f" % (spec, np.mean(f_spec_data), np.std(f_spec_data) ) 
-        hdu = fits.getheader(spec)
-        Fix_Header(hdu)
         hdu.set('DATEFLAT', datetime.datetime.now().strftime("%Y-%m-%d"), 'Date of Flat Fielding')
         hdu.set('LITTROW',str(littrow_ghost),'Littrow Ghost location in Flat')
         hdu.append( ('FLATFLD', flat,'Image used to Flat Field.'), 
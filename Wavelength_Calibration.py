@@ -16,10 +16,16 @@ Use:
 :OPTIONAL:
        ZZCeti_spectrum.ms.fits: string, parameters written to header of this image if supplied when prompted
 
+       offsets.txt: wavelength offsets (blue, then red) to apply to the initial solution. If not supplied, the offset is found by cross correlating the lamp with a synthetic lamp built from the line list (find_offset). Use autooffset=False in calibrate_now to set it by clicking instead, or identify=True to find the initial solution from the lamp lines alone (identify_lines), for new setups or nights far from the saved solutions.
+
 :OUTPUTS:
-       wtFe*fits: lamp spectrum with wavelength calibration parameters written to header
+       wtFe*fits: lamp spectrum with wavelength calibration parameters written to header, and the wavelengths in a WAVE extension
+
+       w*fits: ZZ Ceti spectrum with wavelength calibration parameters written to header, and the wavelengths in a WAVE extension
+
+       Wavelength solutions database: each fitted solution is saved under its setup (GRT_TARG, CAM_TARG, binning) and date (see solution_store.py). A new night starts from the nearest saved solution instead of the parameters below. Use zero_point_drift to list the saved zero points.
 
-       w*fits: ZZ Ceti spectrum with wavelength calibration parameters written to header
+       wavelength_solutions.txt: written by calibrate_batch, which calibrates many lamp/spectrum pairs at once without prompting. One row per pair with the fitted parameters and RMS.
 
        wavecal_ZZCETINAME_DATE.txt: saved parameters for diagnostics. ZZCETINAME is name of the ZZ Ceti spectrum supplied. DATE is the current date and time. Columns are: fitted wavelengths, residuals, wavelengths, flux, lambdas fit,  wavelengths, sky flux, fit to line for recentering
 
@@ -38,10 +44,14 @@ import numpy as np
 import astropy.io.fits as fits
 import scipy.signal as sg
 import matplotlib.pyplot as plt
-from scipy.optimize import curve_fit, fsolve
+from scipy.optimize import curve_fit
 import mpfit
 import datetime
 import os
+import grating_equation as ge
+import line_fitting as lf
+import solution_store
+import fitsaccess
 
 # ==========================================================================
 # Data # ===================================================================
@@ -160,12 +170,8 @@ def DispCalc(Pixels, alpha, theta, fr, fd, fl, zPnt):
     # fr= fringe density of grating
     # fd= Camera Angle Correction Factor
     # zPnt= Zero point pixel 
-    Wavelengths= [] # Vector to store calculated wavelengths 
-    for pix in Pixels:    
-        beta = np.arctan( (pix-zPnt)*15./fl ) + (fd*theta*np.pi/180.) - (alpha*np.pi/180.) 
-        wave = (10**6.)*( np.sin(beta) + np.sin(alpha*np.pi/180.) )/fr
-        Wavelengths.append(wave)
-    return Wavelengths
+    # Returns a list, which the line-finding code below indexes into.
+    return ge.wavelengths(Pixels, alpha, theta, fr, fd, fl, zPnt).tolist()
     
 # ===========================================================================
 
@@ -179,12 +185,7 @@ def PixCalc(Wavelenghts, alpha, theta, fr, fd, fl, zPnt):
     # fr= fringe density of grating
     # fd= Camera Angle Correction Factor
     # zPnt= Zero point pixel 
-    Pixels= [] # Vector to store calculated wavelengths 
-    for wave in Wavelenghts:   
-        beta = np.arcsin( ((wave*fr/1000000.0)) - np.sin(alpha*np.pi/180.) )
-        pix = np.tan((beta + (alpha*np.pi/180.)) - (fd*theta*np.pi/180.)) * (fl/15.) + zPnt
-        Pixels.append(pix)
-    return Pixels
+    return ge.pixels(Wavelenghts, alpha, theta, fr, fd, fl, zPnt).tolist()
 
 # ===========================================================================
 
@@ -198,42 +199,193 @@ def Gauss(x,a,c,w,b):
 
 # ===========================================================================
 
-def CrossCorr(lamp_data):
-    # This sunction takes a lamp spectra and cross corelates the data with 
-    # Gaussian of RMS width= 1, amplitude= 1, peaked at each pixel. 
-    # It reteturns a list of peak values.    
-    nx= np.size(lamp_data); # Number of pixels
-    X= np.arange(nx) # Vector of pixel values 
-    Corr= np.zeros(nx) # Vector to store cross corrolated result 
-    # Calculate Cross Correlation
-    print ("\nCross Correlateing")
-    for i in range(0,nx):
-       G= [Gauss(X[n],1.,i,3.,0.) for n in range(0,nx)]
-       Corr= Corr+ G*lamp_data;
-    return Corr
+def CrossCorr(lamp_data, template=None):
+    # This function cross correlates a lamp spectrum with a template using FFTs.
+    # If no template is given, it uses a Gaussian of RMS width= 3, amplitude= 1,
+    # so the result is the lamp smoothed by that Gaussian.
+    # Returns Corr, where Corr[k] = sum(lamp_data[n+k]*template[n]) for
+    # lags k= -nx+1 ... nx-1, stored with negative lags at the end (numpy FFT order).
+    lamp_data= np.asarray(lamp_data, dtype=float)
+    nx= np.size(lamp_data) # Number of pixels
+    if template is None:
+        X= np.arange(nx) - nx//2
+        template= np.roll(Gauss(X, 1., 0., 3., 0.), -(nx//2))
+    nfft= 2**int(np.ceil(np.log2(2*nx))) # Zero pad so the correlation does not wrap
+    Corr= np.fft.irfft(np.fft.rfft(lamp_data, nfft) * np.conj(np.fft.rfft(template, nfft)), nfft)
+    return np.concatenate((Corr[0:nx], Corr[nfft-nx+1:]))
+
+# ===========================================================================
+
+def synthetic_lamp(Wavelengths, line_waves, width=3.):
+    # Model lamp spectrum on the pixels of Wavelengths (initial guess solution)
+    # with a Gaussian of RMS width= width pixels at each line in line_waves.
+    Wavelengths= np.asarray(Wavelengths, dtype=float)
+    nx= np.size(Wavelengths)
+    X= np.arange(nx)
+    line_waves= np.asarray(line_waves, dtype=float)
+    line_waves= line_waves[(line_waves >= Wavelengths[0]) & (line_waves <= Wavelengths[-1])]
+    line_pix= np.interp(line_waves, Wavelengths, X)
+    model= np.exp( -(X.reshape(1,nx)-line_pix.reshape(-1,1))**2. / (2.*width**2.) ).sum(axis=0)
+    return model, line_waves, line_pix
+
+# ===========================================================================
+
+def find_offset(lamp_spec, Wavelengths, line_waves, width=3., maxshift=None):
+    # Find the wavelength offset to add to Wavelengths (initial guess solution)
+    # so the lamp lines land on line_waves. Replaces clicking a line and its peak.
+    # The lamp is cross correlated with a synthetic lamp (see synthetic_lamp) and
+    # the peak is refined to a fraction of a pixel with a parabola.
+    # maxshift is the largest shift to search, in pixels. Default is a quarter of the spectrum.
+    # Returns offset in Angstroms and the shift in pixels.
+    lamp_spec= np.asarray(lamp_spec, dtype=float)
+    Wavelengths= np.asarray(Wavelengths, dtype=float)
+    nx= np.size(lamp_spec)
+    if maxshift is None:
+        maxshift= nx//4
+    maxshift= int(min(maxshift, nx-2))
+    model, line_waves, line_pix= synthetic_lamp(Wavelengths, line_waves, width=width)
+    if len(line_waves) == 0:
+        print 'No lines in range. Offset set to 0.'
+        return 0., 0.
+    #Remove the continuum so the correlation is set by the lines
+    lamp= lamp_spec - np.median(lamp_spec)
+    lamp[lamp < 0.]= 0.
+    Corr= CrossCorr(lamp, model)
+    lags= np.concatenate((np.arange(0,nx), np.arange(-nx+1,0)))
+    search= np.abs(lags) <= maxshift
+    best= np.argmax(np.where(search, Corr, -np.inf))
+    shift= float(lags[best])
+    #Parabola through the peak and its neighbors
+    if np.abs(lags[best]) < maxshift:
+        left, middle, right= Corr[best-1], Corr[best], Corr[(best+1) % len(Corr)]
+        denom= left - 2.*middle + right
+        if denom != 0:
+            shift+= 0.5*(left - right)/denom
+    #Wavelength of each line where it is observed, from the uncorrected solution
+    observed= np.interp(line_pix+shift, np.arange(nx), Wavelengths)
+    offset= np.median(line_waves - observed)
+    return offset, shift
+
+# ===========================================================================
+
+def find_lamp_peaks(lamp_spec, nsigma=5., minsep=3, nmax=None):
+    # Find emission lines in a lamp spectrum: local maxima more than nsigma times the
+    # noise above the median. The noise is from the median absolute deviation.
+    # Peaks closer than minsep pixels to a stronger peak are dropped. If nmax is given,
+    # only the nmax strongest peaks are kept.
+    # Returns peak positions in pixels (refined with a parabola through the peak
+    # and its neighbors) and peak heights, sorted by position.
+    lamp_spec= np.asarray(lamp_spec, dtype=float)
+    base= np.median(lamp_spec)
+    noise= 1.4826*np.median(np.abs(lamp_spec - base))
+    if noise == 0:
+        noise= np.std(lamp_spec)
+    left, middle, right= lamp_spec[:-2], lamp_spec[1:-1], lamp_spec[2:]
+    index= np.where( (middle > left) & (middle >= right) & (middle > base + nsigma*noise) )[0] + 1
+    # Keep the strongest peak of any group closer than minsep
+    index= index[np.argsort(lamp_spec[index])[::-1]]
+    keep= np.ones(len(index), dtype=bool)
+    for i in range(len(index)):
+        if keep[i]:
+            keep[i+1:]&= np.abs(index[i+1:] - index[i]) >= minsep
+    index= index[keep]
+    if nmax is not None:
+        index= index[0:nmax]
+    index= np.sort(index)
+    left, middle, right= lamp_spec[index-1], lamp_spec[index], lamp_spec[index+1]
+    denom= left - 2.*middle + right
+    denom[denom == 0]= -1.
+    positions= index + 0.5*(left - right)/denom
+    return positions, middle - base
 
 # ===========================================================================
 
 def PeakFind(data):
     print "\nFinding Peaks"
-    widths= np.arange(1.,5.,.1)
-    maybe= sg.find_peaks_cwt(data, widths)
-    n= np.size(maybe)
-    prob= []
-    for i in range(0,n):
-        if (maybe[i]-maybe[i-1])==1:
-            prob.append( np.max([maybe[i],maybe[i-1]]) )
-        else:
-            prob.append(maybe[i])
-    peaks_x= []
-    peaks_y= []
-    std= np.std(data)
-    for p in prob:
-        if data[p]>2.0*std:
-            peaks_x.append(p)
-            peaks_y.append(data[p])               
+    peaks_x= find_lamp_peaks(data, nsigma=2.)[0]
+    peaks_x= [int(np.round(p)) for p in peaks_x]
+    peaks_y= [data[p] for p in peaks_x]
     return peaks_x, peaks_y
-    
+
+# ===========================================================================
+
+def spacing_ratios(positions, nnear=5):
+    # Invariant of every set of three lines i < j < k with k no more than nnear lines past i:
+    # r = (x_j - x_i)/(x_k - x_i). r does not change under a shift or stretch of x,
+    # so it is the same for peak pixels and line wavelengths where the dispersion is close to linear.
+    # Returns r and the indices i, j, k.
+    positions= np.asarray(positions, dtype=float)
+    n= len(positions)
+    triplets= [(i, j, k) for i in range(n) for j in range(i+1, min(i+nnear, n)) for k in range(j+1, min(i+nnear+1, n))]
+    if len(triplets) == 0:
+        return np.zeros(0), np.zeros((0,3), dtype=int)
+    triplets= np.array(triplets)
+    x= positions[triplets]
+    return (x[:,1]-x[:,0])/(x[:,2]-x[:,0]), triplets
+
+# ===========================================================================
+
+def identify_lines(lamp_spec, Pixels, line_waves, alpha, theta, Param, nmax=40, nnear=5, tol=0.01, plotalot=False):
+    # Identify lamp lines without an initial offset and fit the grating equation to them.
+    # Peaks (find_lamp_peaks) and lines in line_waves are matched by the spacing ratios of
+    # groups of three (spacing_ratios). Every matched group votes for a dispersion and a
+    # wavelength at the center of the spectrum, and the most common vote is kept.
+    # Param [fr, fd, fl, zPnt] is only used for the expected dispersion, which may be off by 30%.
+    # Returns the fitted [fr, fd, fl, zPnt], and the pixels and wavelengths of the lines identified.
+    Pixels= np.asarray(Pixels, dtype=float)
+    line_waves= np.sort(np.asarray(line_waves, dtype=float))
+    nx= np.size(lamp_spec)
+    peaks, heights= find_lamp_peaks(lamp_spec, nmax=nmax)
+    peak_pix= np.interp(peaks, np.arange(nx), Pixels)
+    center= Pixels[nx//2]
+    disp0= ge.dispersion(center, alpha, theta, *Param)
+
+    # Match groups of peaks to groups of lines with the same spacing ratios
+    rpeak, tpeak= spacing_ratios(peak_pix, nnear)
+    rline, tline= spacing_ratios(line_waves, nnear)
+    a, b= np.where( np.abs(rpeak.reshape(-1,1) - rline.reshape(1,-1)) < tol )
+    xp= peak_pix[tpeak[a]]
+    wl= line_waves[tline[b]]
+    disp= (wl[:,2]-wl[:,0])/(xp[:,2]-xp[:,0])
+    wcen= wl[:,0] + disp*(center - xp[:,0])
+    ok= (disp > 0.7*disp0) & (disp < 1.3*disp0)
+    if ok.sum() == 0:
+        raise ValueError('No lamp lines could be identified')
+    disp, wcen= disp[ok], wcen[ok]
+
+    # Most common vote, in bins of 1% in dispersion and 3 pixels in wavelength
+    dbins= np.arange(0.7*disp0, 1.3*disp0 + 0.01*disp0, 0.01*disp0)
+    wbins= np.arange(wcen.min(), wcen.max() + 3.*disp0*2., 3.*disp0)
+    counts, dedges, wedges= np.histogram2d(disp, wcen, bins=[dbins, wbins])
+    di, wi= np.unravel_index(np.argmax(counts), counts.shape)
+    near= (np.abs(disp - 0.5*(dedges[di]+dedges[di+1])) <= 0.015*disp0) & (np.abs(wcen - 0.5*(wedges[wi]+wedges[wi+1])) <= 4.5*disp0)
+    disp_best= np.median(disp[near])
+    wcen_best= np.median(wcen[near])
+
+    # Match every peak to the nearest line and refine with a low order polynomial
+    coeffs= np.array([disp_best, wcen_best - disp_best*center])
+    for order in [1, 2, 2]:
+        predicted= np.polyval(coeffs, peak_pix)
+        nearest= np.abs(predicted.reshape(-1,1) - line_waves.reshape(1,-1)).argmin(axis=1)
+        matched= np.abs(predicted - line_waves[nearest]) < 3.*disp0
+        if matched.sum() <= order+2:
+            raise ValueError('Too few lamp lines identified')
+        coeffs= np.polyfit(peak_pix[matched], line_waves[nearest[matched]], order)
+    known_pix= peak_pix[matched]
+    known_wave= line_waves[nearest[matched]]
+
+    # Grating equation, starting from the zero point that puts the central wavelength at the center
+    fr, fd, fl, zPnt= Param
+    zPnt= float(ge.zero_point(center, np.polyval(coeffs, center), alpha, theta, fr, fd, fl))
+    par, errors, rms, residuals, used= ge.fit_grating(known_pix, known_wave, alpha, theta, [fr, fd, fl, zPnt])
+    if plotalot:
+        plt.plot(np.arange(nx), lamp_spec)
+        for p in peaks[matched]:
+            plt.axvline(p, color= 'r', linestyle= '--')
+        plt.title('Identified Lines')
+        plt.show()
+    return [par[0], par[1], fl, par[2]], known_pix[used], known_wave[used]
+
 # ===========================================================================
     
 def fit_Gauss(X,Y):
@@ -246,24 +398,23 @@ def fit_Gauss(X,Y):
 
 # ===========================================================================
 
-def find_peak_centers(peak_w, Wavelen, Counts):
-    list_centers= []
-    for w in peak_w:
-        i= Wavelen.index(w) # index of peak_w with wavelengths list
-        fit_data_w= Wavelen[i-9:i+9]
-        fit_data_c= Counts[i-9:i+9]
-        amp, cent, width, b= fit_Gauss(fit_data_w, fit_data_c)
-        list_centers.append(cent)
-        ## Plot the gaussian fit 
-        X= np.arange(fit_data_w[0],fit_data_w[-1], (fit_data_w[-1]-fit_data_w[0])/50.0 )
-        Y= [Gauss(x, amp, cent, width, b) for x in X]
-        #plt.plot(fit_data_w, fit_data_c)
-        #plt.hold('on')
-        #plt.plot(X, Y, 'r--')
-        #plt.axvline(cent)
-        #plt.hold('off')
-        #print cent
-        #plt.show()
+def find_peak_centers(peak_w, Wavelen, Counts, retflags=False):
+    # Fit a Gaussian to 18 points around each wavelength in peak_w. All lines
+    # are fit together (see line_fitting.py).
+    # If retflags, also return a list that is True for lines with a good fit.
+    Wavelen= np.asarray(Wavelen, dtype=float)
+    i= np.searchsorted(Wavelen, peak_w) # index of peak_w with wavelengths list
+    fit_data_w, fit_data_c, inside= lf.line_windows(Wavelen, Counts, i, 9)
+    params, errors, good= lf.fit_gaussians(fit_data_w, fit_data_c)
+    list_centers= params[:,1].tolist()
+    ## To plot the gaussian fit to line n
+    #X= np.linspace(fit_data_w[n,0], fit_data_w[n,-1], 50)
+    #plt.plot(fit_data_w[n], fit_data_c[n])
+    #plt.plot(X, Gauss(X, *params[n]), 'r--')
+    #plt.axvline(params[n,1])
+    #plt.show()
+    if retflags:
+        return list_centers, (good & inside).tolist()
     return list_centers
 
 # ===========================================================================
@@ -286,65 +437,38 @@ def find_near(p, in_data):
     
 # =========================================================================== 
     
-def fit_Grating_Eq(known_pix, known_wave, alpha, theta, Param,plotalot=False):
-    # Model # =============================================
-    
-    def Beta_Calc(w,a, FR, TF):
-        beta = np.arcsin( (w*FR/1000000.0) - np.sin(a*np.pi/180.) )
-        return beta
-    def Predict_Pixel(X, FR, TF, ZPNT):
-        a, w, t = X
-        pPixel = np.tan((Beta_Calc(w,a, FR, TF) + (a*np.pi/180.)) - (TF*t*np.pi/180.)) * (fl/15.) + ZPNT
-        return pPixel
-
-    # Curve Fitting # =====================================
-    Alpha= np.ones(np.shape(known_wave))*alpha  
-    Theta= np.ones(np.shape(known_wave))*theta
-    global fl 
-    fr, fd, fl, zPnt= Param
-    p0= [fr, fd, zPnt]
-    xdata= [Alpha, known_wave, Theta] 
-    Par, Covar = curve_fit(Predict_Pixel, xdata, known_pix, p0, maxfev= 10000)
+def fit_Grating_Eq(known_pix, known_wave, alpha, theta, Param,plotalot=False,savearray=None):
+    # Fit the grating equation to the known lines with sigma clipping (see
+    # grating_equation.fit_grating). The focal length Param[2] is held fixed.
+    # If savearray is given, the wavelengths and residuals of the lines kept
+    # are saved in its first two columns for diagnostics.
+    Par, Errors, rmsfit, Res, used = ge.fit_grating(known_pix, known_wave, alpha, theta, Param)
+    fl = Param[2]
+    known_wave = np.asarray(known_wave, dtype=float)
 
     # Print Results # =====================================
     print '\nFitted Parameters:'
     print '\nLine Density= %s \nCam. Fudge= %s \nZero Pt. = %s'  % (Par[0], Par[1], Par[2])
     print '\nConstants: \nFocal Length = %s' % (fl)
-    #print '\nCovarince Matrix: \n%s' % Covar
-
-    # Variance of Parameters # ===============================
-    # Calculated from Covariance matrix 
-    Varience = []
-    for i in range (0,len(Par)):
-        P = np.zeros(len(Par))
-        P[i] = 1
-        Pt= np.transpose(P)
-        C = np.asarray(Covar)
-        SigSq = np.dot(P, np.dot(C,Pt) )
-        Varience.append( np.sqrt(SigSq) )
-    print "\nVariance of Parameters: \n%s" % Varience
+    print "\nUncertainty of Parameters: \n%s" % Errors
+    if not used.all():
+        print '\nRejected %i lines: %s' % ((~used).sum(), known_wave[~used])
+    print '\nRMS = %s' % rmsfit
 
     # Plot Residuals # =====================================
-    X = zip(Alpha,known_wave,Theta)
-    # Xb = zip(Alpha,known_wave)
-    N = len(X)
-
-    pPixel = [Predict_Pixel(X[n], Par[0],Par[1],Par[2]) for n in range(0,N)]
-    Res = [known_pix[n]-pPixel[n] for n in range(0,N)]
-    # print '\nResiduals:\n %s' % Res
-    rmsfit = np.sqrt(np.mean([n**2. for n in Res]))
-    print '\nRMS = %s' % rmsfit
     if plotalot:
-        plt.scatter(known_wave, Res, color='r', marker='+')
+        plt.scatter(known_wave[used], Res[used], color='r', marker='+')
+        plt.scatter(known_wave[~used], Res[~used], color='k', marker='x')
         plt.grid()
-        plt.ylim( min(Res)*2., max(Res)*2.)
+        plt.ylim( min(Res[used])*2., max(Res[used])*2.)
         plt.title('Least Squares Fit Residuals')
         plt.ylabel('Pixels')
         plt.xlabel('Wavelength')
         plt.show()
     
-    savearray[0:len(known_wave),0] = known_wave
-    savearray[0:len(Res),1] = Res
+    if savearray is not None:
+        savearray[0:used.sum(),0] = known_wave[used]
+        savearray[0:used.sum(),1] = Res[used]
     
     return Par, rmsfit
     
@@ -378,21 +502,51 @@ def fitpseudogausscubic(p,fjac=None,x=None, y=None, err=None):
 
 # ===========================================================================
 
+def balmer_window(specname):
+    #Pixel window, wavelength, and half maximum fraction used to fit the Balmer line for the zero point.
+    #Blue: H-beta between pixels 1300 (4680) and 1750 (5040). Red: H-alpha between pixels 940 (6380) and 1400 (6760).
+    if 'blue' in specname.lower():
+        return 1300, 1750, 4862.0, 2.5
+    elif 'red' in specname.lower():
+        return 940, 1400, 6564.6, 3.
+
+# ===========================================================================
+
+def pseudogauss_guess(pix,dataval,fitlow,fithi,halfmaxfrac):
+    #Initial guesses for pseudogausscubic from a cubic through the ends of the window and the deepest pixel.
+    #The width is measured at the continuum + depth/halfmaxfrac.
+    pix = np.asarray(pix)
+    fitpixels = pix[fitlow:fithi+1]
+    fitval = dataval[fitlow:fithi+1]
+    guess = np.zeros(8)
+    xes = np.array([pix[fitlow],pix[fitlow+10],pix[fitlow+20],pix[fithi-10],pix[fithi]])
+    yes = np.array([dataval[fitlow],dataval[fitlow+10],dataval[fitlow+20],dataval[fithi-10],dataval[fithi]])
+    cp = np.polyfit(xes,yes,3)
+    cpp = np.poly1d(cp)
+    guess[0] = cp[3]
+    guess[1] = cp[2]
+    guess[2] = cp[1]
+    guess[7] = cp[0]
+    guess[4] = pix[np.min(np.where(fitval == fitval.min()))] + fitlow
+    guess[3] = np.min(fitval) - cpp(guess[4]) #depth of line relative to continuum
+    halfmax = cpp(guess[4]) + guess[3]/halfmaxfrac
+    diff = np.abs(fitval-halfmax)
+    lowidx = diff[np.where(fitpixels < guess[4])].argmin()
+    highidx = diff[np.where(fitpixels > guess[4])].argmin() + len(diff[np.where(fitpixels < guess[4])])
+    guess[5] = (fitpixels[highidx] - fitpixels[lowidx]) / (2.*np.sqrt(2.*np.log(2.))) #convert FWHM to sigma
+    guess[6] = 1.0 #how much of a pseudo-gaussian
+    return guess
+
+# ===========================================================================
+
    
-def newzeropoint(x):
-    beta = np.arctan( (bestpixel-x)*15./parm[2] ) + (n_fd*theta*np.pi/180.) - (alpha*np.pi/180.)
-    out = newlambda - (10**6.)*( np.sin(beta) + np.sin(alpha*np.pi/180.) )/n_fr
-    return out
-    
-# =========================================================================== 
-    
-def WaveShift(specname,zzceti,plotall):
-    #Calculates a new zero point for a spectrum based on a skyline
-    spec_data= fits.getdata(specname)
+def WaveShift(specname,zzceti,plotall,n_fr,n_fd,fl,n_zPnt,savearray=None):
+    #Calculates a new zero point for a spectrum based on a skyline or Balmer line.
+    #n_fr, n_fd, fl, and n_zPnt are the grating equation parameters from the lamp.
+    #If savearray is given, the fit is saved in columns 5-7 for diagnostics.
+    spec_header, spec_data= fitsaccess.read(specname)
     dataval = spec_data[0,0,:]
     sigmaval = spec_data[3,0,:]
-    spec_header= fits.getheader(specname)
-    global alpha, theta
     alpha= float( spec_header["GRT_TARG"] )
     theta= float( spec_header["CAM_TARG"] )
     
@@ -404,77 +558,23 @@ def WaveShift(specname,zzceti,plotall):
         bining= float( spec_header["PG3_2"] ) 
     nx= np.size(spec_data[0])
     Pixels= bining*(np.arange(0,nx,1)+trim_offset)
-    WDwave = DispCalc(Pixels, alpha, theta, n_fr, n_fd, parm[2], n_zPnt)
+    WDwave = DispCalc(Pixels, alpha, theta, n_fr, n_fd, fl, n_zPnt)
     
     #Select whether to fit a Balmer line or choose a different line
     #selectline = raw_input('Is this a ZZ Ceti? (yes/no): ')
     pix = range(len(dataval)) #This sets up an array of pixel numbers
     if zzceti == 'yes':
-        if 'blue' in specname.lower():
-            #Recenter the observed data to match the models by fitting beta and gamma
-            bfitlow = 1300 #4680
-            bfithi = 1750 #5040
-            
-            fitpixels = np.asarray(pix[bfitlow:bfithi+1])
-            fitsigmas = sigmaval[bfitlow:bfithi+1]
-            fitval = dataval[bfitlow:bfithi+1]
-            
-            best = np.zeros(8)
-            xes = np.array([pix[bfitlow],pix[bfitlow+10],pix[bfitlow+20],pix[bfithi-10],pix[bfithi]])
-            yes = np.array([dataval[bfitlow],dataval[bfitlow+10],dataval[bfitlow+20],dataval[bfithi-10],dataval[bfithi]])
-            bp = np.polyfit(xes,yes,3)
-            bpp = np.poly1d(bp)
-            best[0] = bp[3]
-            best[1] = bp[2]
-            best[2] = bp[1]
-            best[7] = bp[0]
-            best[4] = pix[np.min(np.where(fitval == fitval.min()))] + bfitlow
-            best[3] = np.min(dataval[bfitlow:bfithi+1]) - bpp(best[4]) #depth of line relative to continuum
-            bhalfmax = bpp(best[4]) + best[3]/2.5
-            bdiff = np.abs(fitval-bhalfmax)
-            blowidx = bdiff[np.where(fitpixels < best[4])].argmin()
-            bhighidx = bdiff[np.where(fitpixels > best[4])].argmin() + len(bdiff[np.where(fitpixels < best[4])])
-            best[5] = (fitpixels[bhighidx] - fitpixels[blowidx]) / (2.*np.sqrt(2.*np.log(2.))) #convert FWHM to sigma
-            best[6] = 1.0 #how much of a pseudo-gaussian
-            
-            bfa = {'x':fitpixels, 'y':fitval, 'err':fitsigmas}
-            bparams = mpfit.mpfit(fitpseudogausscubic,best,functkw=bfa,maxiter=3000,ftol=1e-16,xtol=1e-10,quiet=True)
-            line_center = bparams.params[4]
-            line_fit = pseudogausscubic(fitpixels,bparams.params)
-            known_wavelength = 4862.0
-            
-        if 'red' in specname.lower():
-            #Recenter the observed data to match the models by fitting beta and gamma
-            rfitlow = 940 #6380
-            rfithi = 1400 #6760
-            
-            fitpixels = np.asarray(pix[rfitlow:rfithi+1])
-            fitsigmas = sigmaval[rfitlow:rfithi+1]
-            fitval = dataval[rfitlow:rfithi+1]
-            
-            rest = np.zeros(8)
-            xes = np.array([pix[rfitlow],pix[rfitlow+10],pix[rfitlow+20],pix[rfithi-10],pix[rfithi]])
-            yes = np.array([dataval[rfitlow],dataval[rfitlow+10],dataval[rfitlow+20],dataval[rfithi-10],dataval[rfithi]])
-            rp = np.polyfit(xes,yes,3)
-            rpp = np.poly1d(rp)
-            rest[0] = rp[3]
-            rest[1] = rp[2]
-            rest[2] = rp[1]
-            rest[7] = rp[0]
-            rest[4] = pix[np.min(np.where(fitval == fitval.min()))] + rfitlow
-            rest[3] = np.min(dataval[rfitlow:rfithi+1]) - rpp(rest[4]) #depth of line relative to continuum
-            rhalfmax = rpp(rest[4]) + rest[3]/3.
-            rdiff = np.abs(fitval-rhalfmax)
-            rlowidx = rdiff[np.where(fitpixels < rest[4])].argmin()
-            rhighidx = rdiff[np.where(fitpixels > rest[4])].argmin() + len(rdiff[np.where(fitpixels < rest[4])])
-            rest[5] = (fitpixels[rhighidx] - fitpixels[rlowidx]) / (2.*np.sqrt(2.*np.log(2.))) #convert FWHM to sigma
-            rest[6] = 1.0 #how much of a pseudo-gaussian
-            
-            rfa = {'x':fitpixels, 'y':fitval, 'err':fitsigmas}
-            rparams = mpfit.mpfit(fitpseudogausscubic,rest,functkw=rfa,maxiter=3000,ftol=1e-16,xtol=1e-10,quiet=True)
-            line_center = rparams.params[4]
-            line_fit = pseudogausscubic(fitpixels,rparams.params)
-            known_wavelength = 6564.6
+        #Recenter the observed data to match the models by fitting beta and gamma
+        fitlow, fithi, known_wavelength, halfmaxfrac = balmer_window(specname)
+        fitpixels = np.asarray(pix[fitlow:fithi+1])
+        fitsigmas = sigmaval[fitlow:fithi+1]
+        fitval = dataval[fitlow:fithi+1]
+
+        best = pseudogauss_guess(pix,dataval,fitlow,fithi,halfmaxfrac)
+        fa = {'x':fitpixels, 'y':fitval, 'err':fitsigmas}
+        params = mpfit.mpfit(fitpseudogausscubic,best,functkw=fa,maxiter=3000,ftol=1e-16,xtol=1e-10,quiet=True)
+        line_center = params.params[4]
+        line_fit = pseudogausscubic(fitpixels,params.params)
     elif zzceti == 'no':
         #Plot the spectrum and allow user to set fit width
         global ax, fig, coords
@@ -516,24 +616,159 @@ def WaveShift(specname,zzceti,plotall):
         plt.hold('off')
         plt.show()
 
-    savearray[0:len(fitpixels),5] = fitpixels
-    savearray[0:len(fitval),6] = fitval
-    savearray[0:len(line_fit),7] = line_fit
+    if savearray is not None:
+        savearray[0:len(fitpixels),5] = fitpixels
+        savearray[0:len(fitval),6] = fitval
+        savearray[0:len(line_fit),7] = line_fit
 
     #Take this fit and determine the new zero point
-    global newlambda
-    newlambda = known_wavelength
-    global bestpixel
     bestpixel = bining*(line_center +trim_offset)
-    guess = n_zPnt
-    newzero = fsolve(newzeropoint,guess,xtol=1e-12)
-    newzPnt = float(newzero)
+    newzPnt = float(ge.zero_point(bestpixel, known_wavelength, alpha, theta, n_fr, n_fd, fl))
     
-    WDwave2 = DispCalc(Pixels, alpha, theta, n_fr, n_fd, parm[2], newzPnt)
+    WDwave2 = DispCalc(Pixels, alpha, theta, n_fr, n_fd, fl, newzPnt)
     #plt.plot(WDwave2,spec_data[2,0,:])
     #plt.show()
     return newzPnt
 
+# ===========================================================================
+
+def ZeroPoints(specnames,n_fr,n_fd,fl,template=None):
+    #Zero points for a stack of ZZ Ceti spectra from the same arm, all fit at once with the Balmer line model used by WaveShift.
+    #n_fr, n_fd, and fl are the grating equation parameters from the lamp, either one for all spectra or a list with one per spectrum.
+    #The first spectrum is fit from pseudogauss_guess and its parameters are the starting guess for all spectra.
+    #If template (8 pseudogausscubic parameters, e.g. the template returned by an earlier call) is given, only a shift,
+    #scale, and linear continuum of the template are fit to each spectrum.
+    #Returns the zero points, line centers in pixels, bool array of good fits, and the template parameters.
+    fitlow, fithi, known_wavelength, halfmaxfrac = balmer_window(specnames[0])
+    dataval = []
+    sigmaval = []
+    headers = []
+    for specname in specnames:
+        spec_header, spec_data = fitsaccess.read(specname)
+        dataval.append(spec_data[0,0,:])
+        sigmaval.append(spec_data[3,0,:])
+        headers.append(spec_header)
+    dataval = np.array(dataval)
+    sigmaval = np.array(sigmaval)
+    nx = dataval.shape[1]
+    pix = np.arange(nx)
+    fitpixels = pix[fitlow:fithi+1]
+
+    if template is None:
+        best = pseudogauss_guess(pix,dataval[0],fitlow,fithi,halfmaxfrac)
+        first, firsterr, firstgood = lf.fit_pseudogausscubic(fitpixels,dataval[0:1,fitlow:fithi+1],sigmaval[0:1,fitlow:fithi+1],best)
+        template = first[0]
+        params, errors, good = lf.fit_pseudogausscubic(fitpixels,dataval[:,fitlow:fithi+1],sigmaval[:,fitlow:fithi+1],template)
+        line_centers = params[:,4]
+    else:
+        line_centers, errors, good = lf.fit_template_shift(fitpixels,dataval[:,fitlow:fithi+1],sigmaval[:,fitlow:fithi+1],template)
+
+    n_fr, n_fd, fl = [np.zeros(len(specnames)) + x for x in (n_fr, n_fd, fl)]
+    zeropoints = np.zeros(len(specnames)) + np.nan
+    for i in range(len(specnames)):
+        if not good[i]:
+            print 'Balmer line fit failed for ', specnames[i]
+            continue
+        alpha = float( headers[i]["GRT_TARG"] )
+        theta = float( headers[i]["CAM_TARG"] )
+        bestpixel = np.interp(line_centers[i],pix,ge.header_pixels(headers[i],nx))
+        zeropoints[i] = ge.zero_point(bestpixel, known_wavelength, alpha, theta, n_fr[i], n_fd[i], fl[i])
+    return zeropoints, line_centers, good, np.asarray(template)
+
+
+# ===========================================================================
+
+def initial_parameters(lamp,lamp_header,parm):
+    #Starting [fr, fd, fl, zPnt] for a lamp: the saved wavelength solution for this setup nearest in date, or parm if there is none.
+    #Also returns True if a saved solution was used.
+    keys = solution_store.grating_keys(lamp,lamp_header)
+    entry = solution_store.SolutionStore('wavelength').nearest(keys,lamp_header['DATE-OBS'])
+    if entry is None:
+        return parm, False
+    print 'Starting from wavelength solution of %s (%s)' % (entry['date'], entry['source'])
+    info = entry['info']
+    return [info['fr'], info['fd'], info['fl'], info['zpoint']], True
+
+# ===========================================================================
+
+def read_offset(offset_file,lamp):
+    #Offset in Angstroms for lamp from offset_file (blue, then red)
+    offsets = np.genfromtxt(offset_file,dtype='d')
+    if offsets.size == 1:
+        offsets = np.array([offsets])
+    if 'blue' in lamp.lower():
+        return offsets[0]
+    elif 'red' in lamp.lower():
+        return offsets[1]
+
+# ===========================================================================
+
+def starting_solution(lamp,lamp_header,Pixels,parm,offset_file=None,usestore=True):
+    #Initial parameters and wavelengths of the pixels of a lamp.
+    #Offsets in offset_file were measured against the default guess (Param_930_*), so they are only added when starting from it.
+    #A saved solution was fit after that offset was applied, so adding it again would move the start by the full offset each run.
+    #Returns parm, Wavelengths, and the offset applied, which is None if there is no offset file and the offset still has to be found.
+    stored= False
+    if usestore:
+        parm, stored= initial_parameters(lamp, lamp_header, parm)
+    alpha= float( lamp_header["GRT_TARG"] )
+    theta= float( lamp_header["CAM_TARG"] )
+    Wavelengths= DispCalc(Pixels, alpha, theta, parm[0], parm[1], parm[2], parm[3])
+    if not offset_file:
+        return parm, Wavelengths, None
+    if stored:
+        print 'Starting from a saved solution, so the offset in %s is not applied.' % offset_file
+        offset= 0.
+    else:
+        print 'Using offset file: ', offset_file
+        offset= read_offset(offset_file,lamp)
+    return parm, [w+offset for w in Wavelengths], offset
+
+# ===========================================================================
+
+def save_solution(lamp,lamp_header,par,fl,rmsfit,specpoint=None,centers_in_pix=None,known_waves=None):
+    #Save a fitted wavelength solution to the database. specpoint is the zero point fitted to the spectrum, if any.
+    keys = solution_store.grating_keys(lamp,lamp_header)
+    info = {'fr':float(par[0]), 'fd':float(par[1]), 'fl':float(fl), 'zpoint':float(par[2]), 'rms':float(rmsfit)}
+    if specpoint is not None:
+        info['specpoint'] = float(specpoint)
+    arrays = {}
+    if centers_in_pix is not None:
+        arrays['lines'] = np.array([centers_in_pix,known_waves],dtype=float)
+    solution_store.SolutionStore('wavelength').add(keys,lamp_header['DATE-OBS'],arrays,info=info,source=os.path.basename(lamp))
+
+# ===========================================================================
+
+def output_name(newname,overwrite=None):
+    #Name and clobber flag for an output file. If the file exists, overwrite sets what to do:
+    #None asks, 'overwrite' replaces it, 'skip' returns None for the name so the file is not written.
+    clob = False
+    if os.path.isfile(newname):
+        print 'File %s already exists.' % newname
+        if overwrite is None:
+            nextstep = raw_input('Do you want to overwrite or designate a new name (overwrite/new)? ')
+            if nextstep == 'overwrite':
+                clob = True
+            elif nextstep == 'new':
+                newname = raw_input('New file name: ')
+        elif overwrite == 'overwrite':
+            print 'Overwriting %s' % newname
+            clob = True
+        elif overwrite == 'skip':
+            print 'Keeping %s' % newname
+            newname = None
+    return newname, clob
+
+# ===========================================================================
+
+def zero_point_drift(lamp,name='zpoint'):
+    #Print and return the saved zero points for the setup of lamp, in date order.
+    #name='specpoint' gives the zero points fitted to the spectra instead of the lamps.
+    keys = solution_store.grating_keys(lamp,fitsaccess.read_header(lamp))
+    dates, values = solution_store.SolutionStore('wavelength').history(keys,name)
+    for date, value in zip(dates,values):
+        print date, '%.3f' % value
+    return dates, values
 
 # ===========================================================================
 # Code ====================================================================== 
@@ -541,10 +776,20 @@ def WaveShift(specname,zzceti,plotall):
 
 #  Get Lamps # ==============================================================
 
-def calibrate_now(lamp,zz_specname,fit_zpoint,zzceti,offset_file,plotall=True):
+def calibrate_now(lamp,zz_specname,fit_zpoint,zzceti,offset_file,plotall=True,autooffset=True,usestore=True,savesolution=True,overwrite=None,identify=False):
+    # overwrite: what to do if an output file already exists. None asks, 'overwrite' replaces it, 'skip' keeps it and does not write the new one.
+    # usestore starts from the nearest saved solution. savesolution saves the new one (see save_solution).
+    # identify finds the initial solution by matching lamp peaks to the line list (identify_lines), with no offset needed.
+    # Returns a dictionary with the solution, its RMS, and the files written.
+    # The lamp and spectrum are each opened once and closed at the end (see fitsaccess.py).
+    with fitsaccess.stage():
+        return _calibrate(lamp,zz_specname,fit_zpoint,zzceti,offset_file,plotall,autooffset,usestore,savesolution,overwrite,identify)
+
+# ===========================================================================
+
+def _calibrate(lamp,zz_specname,fit_zpoint,zzceti,offset_file,plotall,autooffset,usestore,savesolution,overwrite,identify):
     # Read Lamp Data and Header # 
-    lamp_data= fits.getdata(lamp)
-    lamp_header= fits.getheader(lamp)
+    lamp_header, lamp_data= fitsaccess.read(lamp)
     
     # Check number of image slices, and select the spectra # 
     if lamp_header["NAXIS"]== 2:
@@ -561,21 +806,11 @@ def calibrate_now(lamp,zz_specname,fit_zpoint,zzceti,offset_file,plotall=True):
     # plt.title('Raw')
     # plt.show()
 
-    # Find the pixel number offset due to trim reindexing # 
-    trim_sec= lamp_header["CCDSEC"]
-    trim_offset= float( trim_sec[1:len(trim_sec)-1].split(':')[0] )-1
-
-    # Find Bining # 
-    try:
-        bining= float( lamp_header["PARAM18"] ) 
-    except:
-        bining= float( lamp_header["PG3_2"] ) 
-    # Get Pixel Numbers # 
+    # Get Pixel Numbers, accounting for trim reindexing and bining # 
     nx= np.size(lamp_spec)
-    Pixels= bining*(np.arange(0,nx,1)+trim_offset)
+    Pixels= ge.header_pixels(lamp_header, nx)
 
     # Select Set of Parameters to use # 
-    global parm
     if lamp.lower().__contains__('red'):
         parm= Param_930_20_40
         line_list= WaveList_Fe_930_20_40
@@ -589,20 +824,23 @@ def calibrate_now(lamp,zz_specname,fit_zpoint,zzceti,offset_file,plotall=True):
 
     alpha= float( lamp_header["GRT_TARG"] )
     theta= float( lamp_header["CAM_TARG"] )
-    Wavelengths= DispCalc(Pixels, alpha, theta, parm[0], parm[1], parm[2], parm[3])
+    if identify:
+        offset_file= None
+    parm, Wavelengths, file_offset= starting_solution(lamp, lamp_header, Pixels, parm, offset_file, usestore)
 
     # Ask for offset # ===========================================================
     print offset_file
-    if offset_file:
-        print 'Using offset file: ', offset_file
-        offsets = np.genfromtxt(offset_file,dtype='d')
-        if offsets.size == 1:
-            offsets = np.array([offsets])
-        #print offsets
-        if 'blue' in lamp.lower():
-            offset = offsets[0]
-        elif 'red' in lamp.lower():
-            offset = offsets[1]
+    if identify:
+        parm, id_pix, id_waves= identify_lines(lamp_spec, Pixels, line_list[1], alpha, theta, parm, plotalot=plotall)
+        print 'Identified %i lines. Initial solution: %s' % (len(id_pix), parm)
+        Wavelengths= DispCalc(Pixels, alpha, theta, parm[0], parm[1], parm[2], parm[3])
+        offset= 0.
+    elif file_offset is not None:
+        #Already added by starting_solution
+        offset= file_offset
+    elif autooffset:
+        offset, shift= find_offset(lamp_spec, Wavelengths, line_list[1])
+        print 'Offset from cross correlation: %.3f Angstroms (%.2f pixels)' % (offset, shift)
         Wavelengths= [w+offset for w in Wavelengths]
     else:
         # Plot Dispersion # 
@@ -719,7 +957,7 @@ def calibrate_now(lamp,zz_specname,fit_zpoint,zzceti,offset_file,plotall=True):
             for i in range(0,n_pnt):
                 x= find_near(coord_x[i], Wavelengths)
                 peak_x.append(x)
-            centers_in_wave= find_peak_centers(peak_x, Wavelengths, lamp_spec)
+            centers_in_wave, goodfit= find_peak_centers(peak_x, Wavelengths, lamp_spec, retflags=True)
             centers_in_wave= [w-offset for w in centers_in_wave]
             centers_in_pix= PixCalc(centers_in_wave, alpha, theta, parm[0], parm[1], parm[2], parm[3])
     
@@ -728,11 +966,16 @@ def calibrate_now(lamp,zz_specname,fit_zpoint,zzceti,offset_file,plotall=True):
                 x= find_near(coord_x[i], line_list[1])
                 known_waves.append(x)
 
+            # Drop lines whose Gaussian fit failed or ran off the spectrum
+            if not all(goodfit):
+                print 'Dropping %i lines with bad fits: %s' % (goodfit.count(False), [known_waves[i] for i in range(n_pnt) if not goodfit[i]])
+            centers_in_pix= [centers_in_pix[i] for i in range(n_pnt) if goodfit[i]]
+            known_waves= [known_waves[i] for i in range(n_pnt) if goodfit[i]]
+
             #Create array to save data for diagnostic purposes
-            global savearray, n_fr, n_fd, n_zPnt
             savearray = np.zeros([len(Wavelengths),8])
             #n_fr, n_fd, n_zPnt= fit_Grating_Eq(centers_in_pix, known_waves, alpha, theta, parm)
-            par, rmsfit = fit_Grating_Eq(centers_in_pix, known_waves, alpha, theta, parm,plotalot=plotall)
+            par, rmsfit = fit_Grating_Eq(centers_in_pix, known_waves, alpha, theta, parm,plotalot=plotall,savearray=savearray)
             n_fr, n_fd, n_zPnt = par
             n_Wavelengths= DispCalc(Pixels, alpha-alpha_offset, theta, n_fr, n_fd, parm[2], n_zPnt)
         
@@ -763,38 +1006,19 @@ def calibrate_now(lamp,zz_specname,fit_zpoint,zzceti,offset_file,plotall=True):
             '''
 
             plt.show()
-        if ('blue' in lamp.lower()) and (rmsfit > 1.0):
-            coord_list_short = line_list[0][1:]
-            wave_list_short = line_list[1][1:]
-            line_list = np.array([coord_list_short,wave_list_short])
-            print 'Refitting without first line.'
-            yn = 'yes'
-        else:
-            yn = 'no' #Don't refit again
+        yn = 'no' #Lines that do not fit are rejected in fit_Grating_Eq, so no refit is needed
 
     # Save parameters in header and write file # 
     #print "\nWrite solution to header?"
     #yn= raw_input("yes/no? >>>")
     print '\n Writing solution to header'
     yn = 'yes'
+    result = {'lamp':lamp, 'spectrum':zz_specname, 'fr':n_fr, 'fd':n_fd, 'fl':parm[2], 'zpoint':n_zPnt,
+              'specpoint':np.nan, 'rms':rmsfit, 'nlines':len(known_waves), 'lampfile':None, 'specfile':None,
+              'lines':np.array([centers_in_pix,known_waves],dtype=float)}
     if yn== "yes":
-        newname = 'w'+lamp
-        mylist = [True for f in os.listdir('.') if f == newname]
-        exists = bool(mylist)
-        clob = False
-        if exists:
-            print 'File %s already exists.' % newname
-            nextstep = raw_input('Do you want to overwrite or designate a new name (overwrite/new)? ')
-            if nextstep == 'overwrite':
-                clob = True
-                exists = False
-            elif nextstep == 'new':
-                newname = raw_input('New file name: ')
-                exists = False
-            else:
-                exists = False
+        newname, clob = output_name('w'+lamp, overwrite)
     
-        rt.Fix_Header(lamp_header)
         lamp_header.append( ('LINDEN', n_fr,'Line Desity for Grating Eq.'), 
                        useblanks= True, bottom= True )
         lamp_header.append( ('CAMFUD', n_fd,'Camera Angle Correction Factor for Grat. Eq.'), 
@@ -806,7 +1030,10 @@ def calibrate_now(lamp,zz_specname,fit_zpoint,zzceti,offset_file,plotall=True):
         lamp_header.append( ('RMSWAVE',rmsfit, 'RMS from Wavelength Calib.'),
                             useblanks= True, bottom= True )
         NewHdu = fits.PrimaryHDU(data= lamp_data, header= lamp_header)
-        NewHdu.writeto(newname, output_verify='warn', clobber= clob)
+        NewHdu = fits.HDUList([NewHdu, ge.wave_hdu(lamp_header, nx)])
+        if newname:
+            NewHdu.writeto(newname, output_verify='warn', clobber= clob)
+        result['lampfile'] = newname
 
     #Save parameters to ZZ Ceti spectrum#
     #print "\nWrite solution to header of another spectrum?"
@@ -815,12 +1042,11 @@ def calibrate_now(lamp,zz_specname,fit_zpoint,zzceti,offset_file,plotall=True):
         #specname = raw_input("Filename: ")
         #fitspectrum = raw_input('Would you like to fit a new zero point using a spectral line? (yes/no) ')
         if fit_zpoint == 'yes':
-            newzeropoint = WaveShift(zz_specname,zzceti,plotall)
+            newzeropoint = WaveShift(zz_specname,zzceti,plotall,n_fr,n_fd,parm[2],n_zPnt,savearray=savearray)
+            result['specpoint'] = newzeropoint
         else:
             newzeropoint = n_zPnt
-        spec_data= fits.getdata(zz_specname)
-        spec_header= fits.getheader(zz_specname)
-        rt.Fix_Header(spec_header)
+        spec_header, spec_data= fitsaccess.read(zz_specname)
         spec_header.append( ('LINDEN', n_fr,'Line Desity for Grating Eq.'), 
                        useblanks= True, bottom= True )
         spec_header.append( ('CAMFUD', n_fd,'Camera Angle Correction Factor for Grat. Eq.'), 
@@ -832,23 +1058,19 @@ def calibrate_now(lamp,zz_specname,fit_zpoint,zzceti,offset_file,plotall=True):
         spec_header.append( ('RMSWAVE',rmsfit, 'RMS from Wavelength Calib.'),
                             useblanks= True, bottom= True )
         NewspecHdu = fits.PrimaryHDU(data= spec_data, header= spec_header)
+        NewspecHdu = fits.HDUList([NewspecHdu, ge.wave_hdu(spec_header, spec_data.shape[-1])])
 
-        newname = 'w'+zz_specname
-        mylist = [True for f in os.listdir('.') if f == newname]
-        exists = bool(mylist)
-        clob = False
-        if exists:
-            print 'File %s already exists.' % newname
-            nextstep = raw_input('Do you want to overwrite or designate a new name (overwrite/new)? ')
-            if nextstep == 'overwrite':
-                clob = True
-                exists = False
-            elif nextstep == 'new':
-                newname = raw_input('New file name: ')
-                exists = False
-            else:
-                exists = False
-        NewspecHdu.writeto(newname, output_verify='warn', clobber= clob)
+        newname, clob = output_name('w'+zz_specname, overwrite)
+        if newname:
+            NewspecHdu.writeto(newname, output_verify='warn', clobber= clob)
+        result['specfile'] = newname
+
+    #Save the solution so later nights start from it
+    if savesolution:
+        if zz_specname and fit_zpoint == 'yes':
+            save_solution(lamp,lamp_header,par,parm[2],rmsfit,specpoint=newzeropoint,centers_in_pix=centers_in_pix,known_waves=known_waves)
+        else:
+            save_solution(lamp,lamp_header,par,parm[2],rmsfit,centers_in_pix=centers_in_pix,known_waves=known_waves)
 
     #Save arrays for diagnostics
     now = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M")
@@ -856,8 +1078,133 @@ def calibrate_now(lamp,zz_specname,fit_zpoint,zzceti,offset_file,plotall=True):
     with open('wavecal_' + zz_specname[4:zz_specname.find(endpoint)] + '_' + now + '.txt','a') as handle:
         header = lamp + ',' + zz_specname + '\n First 2 columns: fitted wavelengths, residuals \n Next 3 columns: wavelengths, flux, lambdas fit \n Final 3 columns: wavelengths, sky flux, fit to line for recentering'
         np.savetxt(handle,savearray,fmt='%f',header = header)
+    return result
     
     
+# ===========================================================================
+
+def pair_files(lamp_files,spec_files):
+    #Match each extracted lamp to the spectrum whose trace was used to extract it (REF in the lamp header).
+    #Lamps extracted before REF was written are matched by arm and target name in the filenames.
+    #Returns a list of (lamp, spectrum). Each spectrum is calibrated with the first lamp matched to it.
+    pairs = []
+    used = []
+    for x in lamp_files:
+        ref = fitsaccess.read_header(x).get('REF')
+        if ref in spec_files:
+            matches = [ref]
+        else:
+            if 'blue' in x.lower():
+                lamp_color = 'blue'
+            elif 'red' in x.lower():
+                lamp_color = 'red'
+            matches = [y for y in spec_files if (lamp_color in y.lower()) and (y[5:y.find('_930')] in x)]
+        for y in matches:
+            if y in used:
+                print 'Spectrum %s already has a lamp. Not using %s' % (y, x)
+                continue
+            used.append(y)
+            pairs.append((x,y))
+    return pairs
+
+# ===========================================================================
+
+def _calibrate_pair(args):
+    #Run calibrate_now for one (lamp, spectrum) pair in a worker process.
+    #Solutions are saved by calibrate_batch so only one process writes the database.
+    lamp, zz_specname, fit_zpoint, zzceti, offset_file, overwrite, identify = args
+    try:
+        return calibrate_now(lamp,zz_specname,fit_zpoint,zzceti,offset_file,plotall=False,savesolution=False,overwrite=overwrite,identify=identify)
+    except Exception as error:
+        print 'Wavelength calibration failed for %s, %s: %s' % (lamp, zz_specname, error)
+        return {'lamp':lamp, 'spectrum':zz_specname, 'error':str(error)}
+
+# ===========================================================================
+
+def stack_zero_points(results):
+    #Fit the Balmer line zero points of the spectra in results (from calibrate_now with fit_zpoint='no') with ZeroPoints,
+    #one stack per arm, each spectrum with its own lamp solution. The new zero points are written to the w* spectra
+    #and set as result['specpoint']. Spectra whose line fit fails keep the lamp zero point.
+    done = [result for result in results if 'error' not in result and result['spectrum']]
+    for arm in ['blue','red']:
+        stack = [result for result in done if arm in result['spectrum'].lower()]
+        if not stack:
+            continue
+        zeropoints, line_centers, good, template = ZeroPoints([result['spectrum'] for result in stack],[result['fr'] for result in stack],
+                                                              [result['fd'] for result in stack],[result['fl'] for result in stack])
+        for result, zeropoint in zip(stack,zeropoints):
+            if not np.isfinite(zeropoint):
+                continue
+            result['specpoint'] = zeropoint
+            if not result['specfile']:
+                continue
+            spec_header, spec_data = fitsaccess.read(result['specfile'])
+            spec_data = np.array(spec_data)
+            spec_header.set('ZPOINT', zeropoint, 'Zero Point Pixel for Grat Eq.')
+            NewspecHdu = fits.HDUList([fits.PrimaryHDU(data= spec_data, header= spec_header), ge.wave_hdu(spec_header, spec_data.shape[-1])])
+            NewspecHdu.writeto(result['specfile'], output_verify='warn', clobber= True)
+
+# ===========================================================================
+
+def calibrate_batch(lamp_files,spec_files,offset_file=None,fit_zpoint='no',zzceti='yes',overwrite='overwrite',processes=None,summaryfile='wavelength_solutions.txt',identify=False):
+    #Calibrate every lamp/spectrum pair without prompting. The pairs are run in a pool of processes (all cores if processes is None).
+    #overwrite is the policy for existing w* files ('overwrite' or 'skip', see output_name).
+    #identify=True finds each initial solution from the lamp lines alone (see identify_lines).
+    #With fit_zpoint='yes' and zzceti='yes', the Balmer line zero points are fit once the lamps are done, all spectra of an arm at once (see stack_zero_points).
+    #Each solution is saved to the database, and one row per pair is added to summaryfile.
+    #Returns the list of result dictionaries from calibrate_now.
+    pairs = pair_files(lamp_files,spec_files)
+    stackzpoint = (fit_zpoint == 'yes' and zzceti == 'yes')
+    if stackzpoint:
+        pair_zpoint = 'no'
+    else:
+        pair_zpoint = fit_zpoint
+    jobs = [(x, y, pair_zpoint, zzceti, offset_file, overwrite, identify) for x, y in pairs]
+    if processes == 1 or len(jobs) < 2:
+        results = [_calibrate_pair(job) for job in jobs]
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        results = pool.map(_calibrate_pair,jobs)
+        pool.close()
+        pool.join()
+    if stackzpoint:
+        stack_zero_points(results)
+
+    for result in results:
+        if 'error' in result:
+            continue
+        par = [result['fr'], result['fd'], result['zpoint']]
+        if np.isfinite(result['specpoint']):
+            specpoint = result['specpoint']
+        else:
+            specpoint = None
+        save_solution(result['lamp'],fitsaccess.read_header(result['lamp']),par,result['fl'],result['rms'],specpoint=specpoint,
+                      centers_in_pix=result['lines'][0],known_waves=result['lines'][1])
+
+    #Summary table
+    if identify:
+        offset_source = 'identify'
+    elif offset_file is None:
+        offset_source = 'crosscorr'
+    else:
+        offset_source = offset_file
+    now = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M")
+    newfile = not os.path.isfile(summaryfile)
+    with open(summaryfile,'a') as handle:
+        if newfile:
+            handle.write('#lamp\tspectrum\tdate\toffset\tLINDEN\tCAMFUD\tFOCLEN\tZPOINT\tspecZPOINT\tRMS\tlines\tstatus\n')
+        for result in results:
+            if 'error' in result:
+                row = [result['lamp'], str(result['spectrum']), now, offset_source] + ['nan']*7 + ['failed: ' + result['error']]
+            else:
+                row = [result['lamp'], str(result['spectrum']), now, offset_source, '%.6f' % result['fr'], '%.6f' % result['fd'],
+                       '%.1f' % result['fl'], '%.4f' % result['zpoint'], '%.4f' % result['specpoint'], '%.5f' % result['rms'],
+                       '%i' % result['nlines'], 'wrote %s, %s' % (result['lampfile'], result['specfile'])]
+            handle.write('\t'.join(row) + '\n')
+    print 'Wrote %i wavelength solutions to %s' % (len(results), summaryfile)
+    return results
+
 # ==========================================================================
 
 if __name__ == '__main__':
@@ -0,0 +1,176 @@
+'''
+Written for the ZZ Ceti pipeline.
+
+Local store of the calibration files used by flux_calibration.py: the master response curves (polynomial coefficients, *resp*.npy) and the standard star fluxes (m*.dat). These live on the group AFS directories. Each file is copied into the store the first time it is needed, with the standard star tables parsed from text into .npy, and listed in a JSON manifest. After that, flux calibration reads the manifest and small local .npy files instead of searching and parsing files on the network file system. Files are only loaded when they are first used, and are then kept in memory.
+
+The store lives in the directory given by the ZZCETI_CALIBRATION environment variable, or ~/.zzceti_calibration if that is not set.
+
+Response curves are indexed by arm (blue/red) and ADC status (IN/OUT), standard stars by the name of their flux file. Two response curves that give the same arm and ADC status are an error. Whenever AFS can be reached, the modification time of the source file is checked each time an entry is first looked up, and a changed file is imported again. To import every file again regardless, use refresh=True:
+
+    assets = calibration_assets.AssetStore()
+    assets.import_responses(refresh=True)
+    blue_in = assets.response('blue','IN') #np.poly1d
+    std = assets.standard('mltt3218.dat') #spectools.standard
+
+'''
+
+import os
+import json
+import datetime
+from glob import glob
+import numpy as np
+import spectools as st
+
+ASSET_ENV = 'ZZCETI_CALIBRATION'
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'),'.zzceti_calibration')
+
+RESPONSE_SOURCE = '/afs/cas.unc.edu/depts/physics_astronomy/clemens/students/group/standards/response_curves/'
+STANDARD_SOURCE = '/afs/cas.unc.edu/depts/physics_astronomy/clemens/students/group/standards'
+
+#Arm and ADC status of the response curves in sorted filename order, for files whose names do not say
+RESPONSE_ORDER = [('blue','IN'),('blue','OUT'),('red','IN'),('red','OUT')]
+
+#===========================================
+def asset_directory():
+    return os.environ.get(ASSET_ENV,DEFAULT_DIRECTORY)
+
+#===========================================
+def response_key(arm,adcstat):
+    #Manifest key of a response curve, e.g. 'blue|IN'
+    return '%s|%s' % (arm.lower(),adcstat.upper())
+
+#===========================================
+def response_setup(filename,position):
+    #Arm and ADC status of a response curve file. Taken from the name if it has them, otherwise from position in sorted order.
+    name = os.path.basename(filename).lower()
+    arm, adcstat = RESPONSE_ORDER[position % len(RESPONSE_ORDER)]
+    if 'blue' in name:
+        arm = 'blue'
+    elif 'red' in name:
+        arm = 'red'
+    tokens = name.replace('.','_').replace('-','_').split('_')
+    if 'in' in tokens or 'adcin' in tokens:
+        adcstat = 'IN'
+    elif 'out' in tokens or 'adcout' in tokens:
+        adcstat = 'OUT'
+    return arm, adcstat
+
+#===========================================
+def source_changed(entry):
+    #True if the file a manifest entry was imported from can be reached and has been modified since.
+    #If AFS cannot be reached the stored copy is used.
+    source = entry['source']
+    return os.path.isfile(source) and os.path.getmtime(source) != entry['mtime']
+
+#===========================================
+class AssetStore(object):
+    def __init__(self,directory=None):
+        if directory is None:
+            directory = asset_directory()
+        self.directory = directory
+        self.manifestfile = os.path.join(directory,'manifest.json')
+        self._manifest = None
+        self._loaded = {}
+
+    def manifest(self):
+        #Read the manifest the first time it is needed.
+        if self._manifest is None:
+            if os.path.isfile(self.manifestfile):
+                with open(self.manifestfile,'r') as handle:
+                    self._manifest = json.load(handle)
+            else:
+                self._manifest = {}
+            self._manifest.setdefault('responses',{})
+            self._manifest.setdefault('standards',{})
+        return self._manifest
+
+    def save_manifest(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        tmpfile = self.manifestfile + '.tmp'
+        with open(tmpfile,'w') as handle:
+            json.dump(self.manifest(),handle,indent=1,sort_keys=True)
+        os.rename(tmpfile,self.manifestfile)
+
+    def _save(self,kind,name,array,source):
+        #Save array as a .npy file in the store and return its manifest entry
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        filename = os.path.join(self.directory,'%s_%s.npy' % (kind,name.replace('|','_')))
+        np.save(filename,array)
+        self._loaded.pop(filename,None)
+        return {'file':filename,'source':source,'mtime':os.path.getmtime(source),
+                'added':datetime.datetime.now().strftime("%Y-%m-%dT%H:%M")}
+
+    def _load(self,entry):
+        filename = entry['file']
+        if filename not in self._loaded:
+            self._loaded[filename] = np.load(filename)
+        return self._loaded[filename]
+
+    def import_responses(self,source=RESPONSE_SOURCE,refresh=False):
+        #Copy the response curves in source into the store. Files already in the store are skipped unless they have
+        #changed since, or refresh is set. Returns the manifest keys imported.
+        files = sorted(glob(os.path.join(source,'*resp*.npy')))
+        keys = [response_key(*response_setup(filename,position)) for position, filename in enumerate(files)]
+        for key in set(keys):
+            if keys.count(key) > 1:
+                raise ValueError('Response curves %s all give %s. Rename them so each arm and ADC status has one file.' % (', '.join([files[x] for x in range(len(files)) if keys[x] == key]),key))
+        responses = self.manifest()['responses']
+        imported = []
+        for key, filename in zip(keys,files):
+            entry = responses.get(key)
+            if not refresh and entry is not None and entry['source'] == filename and os.path.isfile(entry['file']) and os.path.getmtime(filename) == entry['mtime']:
+                continue
+            responses[key] = self._save('response',key,np.load(filename),filename)
+            imported.append(key)
+        if imported:
+            self.save_manifest()
+        return imported
+
+    def response_entry(self,arm,adcstat):
+        #Manifest entry of a response curve. The source directory is only searched if the store does not have it,
+        #or the file it came from can be reached and has changed.
+        key = response_key(arm,adcstat)
+        responses = self.manifest()['responses']
+        if key not in responses or not os.path.isfile(responses[key]['file']) or source_changed(responses[key]):
+            self.import_responses()
+        if key not in responses:
+            raise KeyError('No response curve for %s in %s' % (key,RESPONSE_SOURCE))
+        return responses[key]
+
+    def response(self,arm,adcstat):
+        #Master response curve for arm and ADC status as a polynomial in wavelength
+        return np.poly1d(self._load(self.response_entry(arm,adcstat)))
+
+    def response_name(self,arm,adcstat):
+        #Filename the response curve was imported from, for headers and logs
+        return os.path.basename(self.response_entry(arm,adcstat)['source'])
+
+    def import_standard(self,stdfile,source=STANDARD_SOURCE,refresh=False):
+        #Parse the flux file stdfile (wavelength, AB magnitude, bin width) in source and save it in the store.
+        #A stored file is used unless the source can be reached and has changed, or refresh is set.
+        standards = self.manifest()['standards']
+        filename = os.path.join(source,stdfile)
+        entry = standards.get(stdfile)
+        if not refresh and entry is not None and entry['source'] == filename and os.path.isfile(entry['file']) and not source_changed(entry):
+            return entry
+        table = np.array(np.genfromtxt(filename,unpack=True),dtype=float)
+        standards[stdfile] = self._save('standard',os.path.splitext(stdfile)[0],table,filename)
+        self.save_manifest()
+        return standards[stdfile]
+
+    def standard(self,stdfile):
+        #Standard star fluxes as a spectools.standard. The arrays are copies, so they can be changed.
+        warr, magarr, wbin = self._load(self.import_standard(stdfile))
+        return st.standard(warr.copy(),magarr.copy(),wbin.copy())
+
+#===========================================
+_default = None
+
+def default_store():
+    #AssetStore shared by every call in this process, so each file is loaded at most once
+    global _default
+    if _default is None or _default.directory != asset_directory():
+        _default = AssetStore()
+    return _default
@@ -27,6 +27,7 @@ import scipy.interpolate as inter
 #import pyfits as fits
 import astropy.io.fits as fits
 import spectools as st
+import grating_equation as ge
 import os
 import sys
 import datetime
@@ -39,7 +40,7 @@ from scipy.interpolate import UnivariateSpline
 def normalize_now(filenameblue,filenamered,redfile,plotall=True,extinct_correct=False):
     #Read in the observed spectrum
     obs_spectrablue,airmass,exptime,dispersion = st.readspectrum(filenameblue)
-    datalistblue = fits.open(filenameblue)
+    header1 = st.readheader(filenameblue)
 
     if redfile:
         obs_spectrared, airmassred,exptimered,dispersionred = st.readspectrum(filenamered)
@@ -49,26 +50,20 @@ def normalize_now(filenameblue,filenamered,redfile,plotall=True,extinct_correct=
         print 'Extinction correcting spectra.'
         plt.clf()
         plt.plot(obs_spectrablue.warr,obs_spectrablue.opfarr)
-        obs_spectrablue.opfarr = st.extinction_correction(obs_spectrablue.warr,obs_spectrablue.opfarr,airmass)
-        obs_spectrablue.farr = st.extinction_correction(obs_spectrablue.warr,obs_spectrablue.farr,airmass)
-        obs_spectrablue.sky = st.extinction_correction(obs_spectrablue.warr,obs_spectrablue.sky,airmass)
-        obs_spectrablue.sigma = st.extinction_correction(obs_spectrablue.warr,obs_spectrablue.sigma,airmass)
+        obs_spectrablue.correct_extinction(airmass)
         plt.plot(obs_spectrablue.warr,obs_spectrablue.opfarr)
         plt.show()
         
         if redfile:
             plt.clf()
             plt.plot(obs_spectrared.warr,obs_spectrared.opfarr)
-            obs_spectrared.opfarr = st.extinction_correction(obs_spectrared.warr,obs_spectrared.opfarr,airmassred)
-            obs_spectrared.farr = st.extinction_correction(obs_spectrared.warr,obs_spectrared.farr,airmassred)
-            obs_spectrared.sky = st.extinction_correction(obs_spectrared.warr,obs_spectrared.sky,airmassred)
-            obs_spectrared.sigma = st.extinction_correction(obs_spectrared.warr,obs_spectrared.sigma,airmassred)
+            obs_spectrared.correct_extinction(airmassred)
             plt.plot(obs_spectrared.warr,obs_spectrared.opfarr)
             plt.show()
     
 
     #Read in measured FWHM from header. This is used to convolve the model spectrum.
-    FWHMpix = datalistblue[0].header['specfwhm']
+    FWHMpix = header1['specfwhm']
     FWHM = FWHMpix * (obs_spectrablue.warr[-1] - obs_spectrablue.warr[0])/len(obs_spectrablue.warr)
 
     #Read in DA model
@@ -183,17 +178,11 @@ def normalize_now(filenameblue,filenamered,redfile,plotall=True,extinct_correct=
         plt.show()
 
     #Divide by the fit to the response function to get the continuum normalized spectra. Divide every extension by the same polynomial
-    fcorr_wd_blue_opfarr = obs_spectrablue.opfarr / response_fit_blue(obs_spectrablue.warr)
-    fcorr_wd_blue_farr = obs_spectrablue.farr / response_fit_blue(obs_spectrablue.warr)
-    fcorr_wd_blue_sky = obs_spectrablue.sky / response_fit_blue(obs_spectrablue.warr)
-    fcorr_wd_blue_sigma = obs_spectrablue.sigma / response_fit_blue(obs_spectrablue.warr)
+    fcorr_wd_blue_opfarr, fcorr_wd_blue_farr, fcorr_wd_blue_sky, fcorr_wd_blue_sigma = obs_spectrablue.divide(response_fit_blue(obs_spectrablue.warr)).bands
 
 
     if redfile:
-        fcorr_wd_red_opfarr = obs_spectrared.opfarr / response_fit_red(obs_spectrared.warr)
-        fcorr_wd_red_farr = obs_spectrared.farr / response_fit_red(obs_spectrared.warr)
-        fcorr_wd_red_sky = obs_spectrared.sky / response_fit_red(obs_spectrared.warr)
-        fcorr_wd_red_sigma = obs_spectrared.sigma / response_fit_red(obs_spectrared.warr)
+        fcorr_wd_red_opfarr, fcorr_wd_red_farr, fcorr_wd_red_sky, fcorr_wd_red_sigma = obs_spectrared.divide(response_fit_red(obs_spectrared.warr)).bands
     
     if plotall:
         plt.clf()
@@ -246,7 +235,6 @@ def normalize_now(filenameblue,filenamered,redfile,plotall=True,extinct_correct=
     Ny = 1. #All 1D spectra
 
     #Update header
-    header1 = st.readheader(filenameblue)
     header1.set('STANDARD',dafile,'DA Model for Continuum Calibration')
     header1.set('RESPPOLY',response_poly_order_blue,'Polynomial order for Response Function')
     header1.set('DATENORM',datetime.datetime.now().strftime("%Y-%m-%d"),'Date of Continuum Normalization')
@@ -278,6 +266,7 @@ def normalize_now(filenameblue,filenamered,redfile,plotall=True,extinct_correct=
             exists = False
     print 'Writing ', newname1
     newim1 = fits.PrimaryHDU(data=data1,header=header1)
+    newim1 = fits.HDUList([newim1,ge.wave_hdu(header1,Nx1)])
     newim1.writeto(newname1,clobber=clob)
 
 
@@ -313,6 +302,7 @@ def normalize_now(filenameblue,filenamered,redfile,plotall=True,extinct_correct=
                 exists = False
         print 'Writing ', newname2
         newim2 = fits.PrimaryHDU(data=data2,header=header2)
+        newim2 = fits.HDUList([newim2,ge.wave_hdu(header2,Nx2)])
         newim2.writeto(newname2,clobber=clob)
 
 
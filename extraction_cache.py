@@ -0,0 +1,79 @@
+'''
+Written for the ZZ Ceti pipeline.
+
+Content-addressed cache of spectral extractions. Re-running reduceall after fixing a later step (wavelength or flux calibration) would otherwise re-extract every spectrum. Each extraction is recorded under a key built from the checksums of every input file (2D spectrum, trace, FWHM polynomial, lamps) and the parameters passed to superExtract. A later request with the same key returns the stored .ms.fits files instead of extracting again. Changing any input gives a new key, so stale results are never reused.
+
+:OUTPUTS:
+    extraction_cache.json: index of cached extractions in the working directory. Each entry lists the output files and their checksums. An entry is ignored if any of its outputs has been deleted or modified since it was stored.
+
+'''
+
+import os
+import json
+import hashlib
+import datetime
+
+CACHE_FILE = 'extraction_cache.json'
+
+#===========================================
+def file_checksum(filename,blocksize=2**20):
+    #Return the md5 checksum of a file, or None if no file is given.
+    if not filename:
+        return None
+    md5 = hashlib.md5()
+    with open(filename,'rb') as handle:
+        block = handle.read(blocksize)
+        while block:
+            md5.update(block)
+            block = handle.read(blocksize)
+    return md5.hexdigest()
+
+#===========================================
+def cache_key(specfile,tracefile,FWHMfile,lamps,params):
+    #Build the key for one extraction from the checksums of its inputs and the extraction parameters.
+    #lamps is a list of lamp filenames (empty if no lamp is extracted). params is a dictionary of the settings given to superExtract.
+    contents = {'spec':file_checksum(specfile),
+                'trace':file_checksum(tracefile),
+                'fwhm':file_checksum(FWHMfile),
+                'lamps':[file_checksum(x) for x in lamps],
+                'params':sorted([(str(k),repr(v)) for k,v in params.items()])}
+    return hashlib.sha1(json.dumps(contents,sort_keys=True).encode('utf-8')).hexdigest()
+
+#===========================================
+def read_cache(cachefile=CACHE_FILE):
+    if not os.path.isfile(cachefile):
+        return {}
+    try:
+        with open(cachefile,'r') as handle:
+            return json.load(handle)
+    except ValueError:
+        print('Could not read %s. Starting a new extraction cache.' % cachefile)
+        return {}
+
+#===========================================
+def lookup(key,cachefile=CACHE_FILE):
+    #Return the cached entry for key, or None if there is no valid entry.
+    #An entry is only valid if every output file still exists and is unchanged.
+    entry = read_cache(cachefile).get(key)
+    if entry is None:
+        return None
+    for name, checksum in entry['outputs']:
+        if not os.path.isfile(name) or file_checksum(name) != checksum:
+            return None
+    return entry
+
+#===========================================
+def store(keys,specfile,outputs,info=None,cachefile=CACHE_FILE):
+    #Record the output files of an extraction under one or more keys.
+    #outputs is a list of filenames, the .ms.fits of the spectrum first. info is an optional dictionary saved with the entry.
+    if isinstance(keys,str):
+        keys = [keys]
+    cache = read_cache(cachefile)
+    entry = {'specfile':specfile,
+             'outputs':[(name,file_checksum(name)) for name in outputs],
+             'date':datetime.datetime.now().strftime("%Y-%m-%dT%H:%M"),
+             'info':info or {}}
+    for key in keys:
+        cache[key] = entry
+    with open(cachefile,'w') as handle:
+        json.dump(cache,handle,indent=1,sort_keys=True)
@@ -0,0 +1,118 @@
+'''
+Written for the ZZ Ceti pipeline.
+
+Shared access to FITS files. Each file is opened once, with memory mapping, and the header and data are returned together. The header cards that are not uniform in Goodman (param0, param61, param62, param63) are removed when the file is opened if they contain the badly coded degree symbol that pyfits will not write, as Fix_Header does, so the functions that use these do not need Fix_Header or readheader.
+
+Outside a stage, read() opens the file, takes the header and data, and closes it again. Inside a stage, files are kept open and reused until the stage ends, so reading the same file twice (for example, a lamp whose header is needed for the solution store and again for the fit) does not open it twice. Headers are always returned as copies, so they can be changed and written without changing the cached file.
+
+    with fitsaccess.stage():
+        header, data = fitsaccess.read('tFe_ZZCeti_blue.fits')
+        ...
+
+Data is memory mapped copy-on-write, so changing it in place never changes the file. Inside a stage, the change is seen by later reads of the same file, so copy it (np.array) first if the original is needed again.
+
+'''
+
+import os
+import astropy.io.fits as fits
+
+BAD_KEYS = ['param0', 'param61', 'param62', 'param63']
+
+_stages = []
+
+#===========================================
+def clean_header(header):
+    #Delete the parts of the header that are not uniform in Goodman: the BAD_KEYS cards whose comment contains the degree symbol '\xb0'.
+    #Keys that are already gone are skipped, so this can be called on any header.
+    for key in BAD_KEYS:
+        if key in header and '\xb0' in header.comments[key]:
+            del header[key]
+    return header
+
+#===========================================
+def _open(filename):
+    hdulist = fits.open(filename, memmap=True)
+    clean_header(hdulist[0].header)
+    return hdulist
+
+#===========================================
+class stage(object):
+    #Keeps every file opened with open_fits or read until the end of the with block, then closes them all.
+    #Stages can be nested. Files are only shared within the innermost one.
+    #A file written again during the stage is opened again, so a stage can cover steps that write files it has read.
+    def __init__(self):
+        self.handles = {}
+        self.mtimes = {}
+        self.replaced = []
+
+    def __enter__(self):
+        _stages.append(self)
+        return self
+
+    def __exit__(self, *args):
+        _stages.remove(self)
+        self.close()
+        return False
+
+    def open(self, filename):
+        mtime = os.path.getmtime(filename)
+        if filename in self.handles and self.mtimes[filename] != mtime:
+            #Arrays from the old file may still be in use, so it is only closed at the end of the stage
+            self.replaced.append(self.handles.pop(filename))
+        if filename not in self.handles:
+            self.handles[filename] = _open(filename)
+            self.mtimes[filename] = mtime
+        return self.handles[filename]
+
+    def close(self):
+        for hdulist in list(self.handles.values()) + self.replaced:
+            hdulist.close()
+        self.handles = {}
+        self.mtimes = {}
+        self.replaced = []
+
+#===========================================
+def open_fits(filename):
+    #HDUList of filename with a clean primary header. Inside a stage, the same HDUList is returned each time
+    #and is closed at the end of the stage. Outside one, the caller must close it.
+    if _stages:
+        return _stages[-1].open(filename)
+    return _open(filename)
+
+#===========================================
+def release(hdulist):
+    #Close an HDUList from open_fits, unless it belongs to a stage, which closes it at the end.
+    #Memory mapped arrays taken from it stay valid.
+    for current in _stages:
+        if any([hdulist is handle for handle in current.handles.values()]):
+            return
+    hdulist.close()
+
+#===========================================
+def read(filename, ext=0):
+    #Header and data of one extension of filename, from a single open. The header is a copy.
+    if _stages:
+        hdu = open_fits(filename)[ext]
+        return hdu.header.copy(), hdu.data
+    hdulist = _open(filename)
+    try:
+        hdu = hdulist[ext]
+        #The data must be read before closing. Memory mapped arrays stay valid after the file is closed.
+        return hdu.header.copy(), hdu.data
+    finally:
+        hdulist.close()
+
+#===========================================
+def read_header(filename, ext=0):
+    #Clean header of filename without reading the data. The header is a copy.
+    if _stages:
+        return open_fits(filename)[ext].header.copy()
+    hdulist = _open(filename)
+    try:
+        return hdulist[ext].header.copy()
+    finally:
+        hdulist.close()
+
+#===========================================
+def read_data(filename, ext=0):
+    return read(filename, ext)[1]
@@ -15,7 +15,7 @@ python flux_calibration.py GD1212.ms.fits --usemaster True
     spec_list: either single *.fits file or text file containing list of files to flux calibrate.
 
 :OPTIONS:
-    --flux_list: string, file containing standard star fluxes. These are typically m*.dat.
+    --flux_list: string, file containing standard star fluxes. These are typically m*.dat. They are read from the group standards directory once and then from the local calibration store (calibration_assets.py).
 
     --stan_list: string, file with list of 1D standard star spectra
 
@@ -23,11 +23,19 @@ python flux_calibration.py GD1212.ms.fits --usemaster True
 
     --extinct: boolean, Option to extinction correct spectra. Default: True
 
+    --jointsens: boolean, Option to fit all of the standards on each arm together, with an airmass term, and evaluate that at the airmass of each spectrum. If False, the standard closest in airmass is used. Default: True
+
+    --auto: boolean, Option to fit the sensitivity functions with no user interaction. Regions are masked from sensitivity_masks.txt (or the Balmer and telluric defaults), the polynomial order is chosen from the clipped residuals, and existing output files are overwritten. See sensitivity.py. Default: False
+
 :OUTPUTS: 
         flux calibrated files (_flux is added to the filename). User will be prompted if file will overwrite existing file.
 
         sensitivity_params.txt:  File is updated everytime spec_sens.py is run. Contains information used in the flux calibration. Columns are: input observed spectrum, date/time program was run, observed standard spectrum used for calibration, flux calibration file (m*dat), pixel regions excluded in fit, order of polynomial to flux standard, width in Angstroms used for rebinning, output spectrum filename
 
+        sensitivity_model.npz: With --jointsens, the joint sensitivity model of the night and the fit to each standard. Used again while the standards are unchanged.
+
+        *_sensfit.npz: With --auto, the fit to each standard spectrum. Used again on the next automatic run.
+
         sens_fits_DATE.txt: File for diagnostics. Columns are: wavelength, observed flux, polynomial fit, and residuals for each standard listed above. There are extra zeros at the bottom of some columns. 
 
 
@@ -65,6 +73,10 @@ import numpy as np
 #import pyfits as fits
 import astropy.io.fits as fits
 import spectools as st
+import grating_equation as ge
+import extinction
+import sensitivity
+import calibration_assets
 import datetime
 from glob import glob
 import matplotlib.pyplot as plt
@@ -100,27 +112,22 @@ def onclick(event):
 #=============================================
 
 
-def flux_calibrate_now(stdlist,fluxlist,speclist,extinct_correct=False,masterresp=False):
+def flux_calibrate_now(stdlist,fluxlist,speclist,extinct_correct=False,masterresp=False,auto=False,jointsens=True):
+    #auto fits the sensitivity functions without plots or prompts, and overwrites existing output files (see sensitivity.py)
+    #jointsens fits all standards on each arm together with an airmass term, instead of using the one closest in airmass
     if extinct_correct:
         extinctflag = 0
     else:
         extinctflag = -1
     if masterresp: #Use the master response function
-        #Read in master response function and use that.
-        cwd = os.getcwd()
-        os.chdir('/afs/cas.unc.edu/depts/physics_astronomy/clemens/students/group/standards/response_curves/')
-        standards = sorted(glob('*resp*.npy'))
-
-        master_response_blue_in = np.load(standards[0])
-        master_response_blue_in_pol = np.poly1d(master_response_blue_in)
-        master_response_blue_out = np.load(standards[1])
-        master_response_blue_out_pol = np.poly1d(master_response_blue_out)
-        master_response_red_in = np.load(standards[2])
-        master_response_red_in_pol = np.poly1d(master_response_red_in)
-        master_response_red_out = np.load(standards[3])
-        master_response_red_out_pol = np.poly1d(master_response_red_out)
-
-        os.chdir(cwd)
+        #Read in master response function and use that. The curves come from the local calibration store (see calibration_assets.py)
+        assets = calibration_assets.default_store()
+        master_response_blue_in_pol = assets.response('blue','IN')
+        master_response_blue_out_pol = assets.response('blue','OUT')
+        master_response_red_in_pol = assets.response('red','IN')
+        master_response_red_out_pol = assets.response('red','OUT')
+        #Names in the order blue in, blue out, red in, red out, for the headers and sensitivity_params.txt
+        standards = [assets.response_name(arm,adcstat) for arm, adcstat in calibration_assets.RESPONSE_ORDER]
 
         airstd = np.ones([4])
         #airstd[0] = 1.1
@@ -182,11 +189,50 @@ def flux_calibrate_now(stdlist,fluxlist,speclist,extinct_correct=False,masterres
         senspolys = []
         airstd = np.zeros([len(standards)])
         allexcluded = [[None] for i in range(len(standards))]
+        fitarrays = []
+        stdfits = []
+        assets = calibration_assets.default_store()
+
+        #The night's joint model is saved with the fit to each standard. In auto mode, if nothing it depends on has changed, nothing is fit again.
+        #Interactive runs always fit again, so the masks and orders can be chosen.
+        stdfluxes = [stdflux[x//2] for x in range(len(standards))]
+        masksigs = [sensitivity.mask_signature(sensitivity.choose_mask(stdfluxes[x],sensitivity.spectrum_arm(standards[x]),auto=auto)) for x in range(len(standards))]
+        nightfits = None
+        if jointsens and auto:
+            saved_models = sensitivity.load_models(standards,stdfluxes,masksigs,extinct_correct)
+            if saved_models is not None:
+                print 'Using saved sensitivity model: ', sensitivity.MODEL_FILE
+                nightfits, models = saved_models
         
         #Calculating the sensitivity function of each standard star
         cucumber = 0
         for stdspecfile in standards:
             print stdspecfile
+            placeholder = cucumber // 2
+            stdfile = stdflux[placeholder]
+            #Choose the mask first, since saved fits are only used if they were made with the same one (see sensitivity.py)
+            std_mask = sensitivity.choose_mask(stdfile,sensitivity.spectrum_arm(stdspecfile),auto=auto)
+            masksig = masksigs[cucumber]
+
+            #Use the fit saved with the night's model, or by an earlier automatic run, if nothing it depends on has changed since
+            if nightfits is not None:
+                saved = nightfits[cucumber]
+            elif auto:
+                saved = sensitivity.load_fit(stdspecfile,stdfile,extinct_correct,masksig)
+            else:
+                saved = None
+            if saved is not None:
+                print 'Using saved fit.'
+                airstd[cucumber] = saved['airmass']
+                allexcluded[cucumber] = saved['excluded']
+                orderused[cucumber] = saved['order']
+                f = np.poly1d(saved['coeffs'])
+                senspolys.append(f)
+                stdfits.append(saved)
+                smooth_sens = f(saved['lambdasfit'])
+                fitarrays.append([saved['lambdasfit'],saved['fluxesfit'],smooth_sens,saved['fluxesfit']-smooth_sens])
+                cucumber += 1
+                continue
             #Read in the observed spectrum of the standard star
             obs_spectra,airmass,exptime,dispersion = st.readspectrum(stdspecfile) #obs_spectra is an object containing opfarr,farr,sky,sigma,warr
             airstd[cucumber] = airmass
@@ -197,21 +243,16 @@ def flux_calibrate_now(stdlist,fluxlist,speclist,extinct_correct=False,masterres
             #Do the extinction correction
             if extinct_correct:
                 print 'Extinction correcting spectra.'
-                plt.clf()
-                plt.plot(obs_spectra.warr,obs_spectra.opfarr)
-                obs_spectra.opfarr = st.extinction_correction(obs_spectra.warr,obs_spectra.opfarr,airmass)
-                plt.plot(obs_spectra.warr,obs_spectra.opfarr)
-                #plt.show()
-
-            #Change to the standard star directory
-            cwd = os.getcwd()
-            os.chdir('/afs/cas.unc.edu/depts/physics_astronomy/clemens/students/group/standards')
-
-            #read in the standard file
-            placeholder = cucumber // 2
-            stdfile = stdflux[placeholder]
-            std_spectra = st.readstandard(stdfile)
-            os.chdir(cwd)
+                if not auto:
+                    plt.clf()
+                    plt.plot(obs_spectra.warr,obs_spectra.opfarr)
+                obs_spectra.opfarr = extinction.correct(obs_spectra.warr,obs_spectra.opfarr,airmass)
+                if not auto:
+                    plt.plot(obs_spectra.warr,obs_spectra.opfarr)
+                    #plt.show()
+
+            #read in the standard file from the local calibration store (see calibration_assets.py)
+            std_spectra = assets.standard(stdfile)
             #plt.clf()
             #plt.plot(std_spectra.warr,std_spectra.magarr,'.')
             #plt.show()
@@ -248,7 +289,7 @@ def flux_calibrate_now(stdlist,fluxlist,speclist,extinct_correct=False,masterres
             wavenew = np.linspace(low,high,num=num) #wavelength of each new bin
 
             #Now do the rebinning using Ian Crossfield's rebinning package
-            binflux = st.resamplespec(wavenew,obs_spectra.warr,obs_spectra.opfarr,200.) #200 is the oversampling factor
+            binflux = st.rebinspec(wavenew,obs_spectra.warr,obs_spectra.opfarr) #Same as resamplespec with infinite oversampling
             print 'Done rebinning. Now summing the spectrum into new bins to match', stdfile
             #plt.clf()
             #plt.plot(obs_spectra.warr,obs_spectra.opfarr)
@@ -272,13 +313,9 @@ def flux_calibrate_now(stdlist,fluxlist,speclist,extinct_correct=False,masterres
             #Fit a low order polynomial to this function so that it is smooth.
             #The sensitivity function is in units of 2.5 * log10[counts/sec/Ang / ergs/cm2/sec/Ang]
             #Choose regions to not include in fit, first by checking if a mask file exists, and if not the prompt for user interaction.
-            if 'blue' in stdspecfile.lower():
-                std_mask = stdfile[0:-4] + '_blue_maskasdf.dat'
-            if 'red' in stdspecfile.lower():
-                std_mask = stdfile[0:-4] + '_red_maskasdf.dat'
-            std_mask2 = glob(std_mask)
-            if len(std_mask2) == 1.:
-                print 'Found mask file.\n'
+            #std_mask is the mask made by hand, or in auto mode the one saved by an earlier run if it is newer than the mask table
+            if std_mask is not None:
+                print 'Found mask file: ', std_mask, '\n'
                 mask = np.ones(len(std_spectra.warr))
                 excluded_wave = np.genfromtxt(std_mask) #Read in wavelengths to exclude
                 #print excluded_wave
@@ -300,6 +337,22 @@ def flux_calibrate_now(stdlist,fluxlist,speclist,extinct_correct=False,masterres
                 indices = np.where(mask !=0.)
                 lambdasfit = std_spectra.warr[indices]
                 fluxesfit = sens_function[indices]
+            elif auto:
+                print 'No mask found. Masking the regions in the mask table.\n'
+                mask = sensitivity.region_mask(std_spectra.warr,sensitivity.read_mask_table())
+                excluded = sensitivity.excluded_edges(mask)
+                allexcluded[cucumber] = excluded
+                lambdasfit = std_spectra.warr[mask]
+                fluxesfit = sens_function[mask]
+
+                #Save masked wavelengths
+                if 'blue' in stdspecfile.lower():
+                    std_mask_name = stdfile[0:-4] + '_blue_mask.dat'
+                if 'red' in stdspecfile.lower():
+                    std_mask_name = stdfile[0:-4] + '_red_mask.dat'
+                np.savetxt(std_mask_name,std_spectra.warr[excluded])
+                masksig = sensitivity.mask_signature(std_mask_name)
+                masksigs[cucumber] = masksig
             else:
                 print 'No mask found. User interaction required.\n'
                 
@@ -348,6 +401,7 @@ def flux_calibrate_now(stdlist,fluxlist,speclist,extinct_correct=False,masterres
                 if 'red' in stdspecfile.lower():
                     std_mask_name = stdfile[0:-4] + '_red_mask.dat'
                 np.savetxt(std_mask_name,np.transpose(np.array(lambdasnotfit)))
+                masksigs[cucumber] = sensitivity.mask_signature(std_mask_name)
                 #exit()
 
             ##Move back to directory with observed spectra
@@ -362,6 +416,14 @@ def flux_calibrate_now(stdlist,fluxlist,speclist,extinct_correct=False,masterres
             print 'Fitting the sensitivity funtion now.'
             order = 4
             repeat = 'yes'
+            if auto:
+                order, p, used, bic = sensitivity.fit_order(lambdasfit,fluxesfit)
+                f = np.poly1d(p)
+                smooth_sens = f(lambdasfit)
+                residual = fluxesfit - smooth_sens
+                print 'Polynomial order: ', order
+                sensitivity.save_fit(stdspecfile,airmass,lambdasfit,fluxesfit,order,p,allexcluded[cucumber],stdfile,extinct_correct,masksig)
+                repeat = 'no'
             while repeat == 'yes':
                 p = np.polyfit(lambdasfit,fluxesfit,order)
                 f = np.poly1d(p)
@@ -402,19 +464,20 @@ def flux_calibrate_now(stdlist,fluxlist,speclist,extinct_correct=False,masterres
 
             orderused[cucumber] = order
             senspolys.append(f)
+            stdfits.append({'airmass':airmass,'order':int(order),'coeffs':f.coeffs,'lambdasfit':lambdasfit,
+                            'fluxesfit':fluxesfit,'excluded':allexcluded[cucumber]})
 
             #Save arrays for diagnostic plots
-            if cucumber == 0:
-                bigarray = np.zeros([len(lambdasfit),4.*len(standards)])
-                artichoke = 0
-            bigarray[0:len(lambdasfit),artichoke] = lambdasfit
-            bigarray[0:len(fluxesfit),artichoke+1] = fluxesfit
-            bigarray[0:len(smooth_sens),artichoke+2] = smooth_sens
-            bigarray[0:len(residual),artichoke+3] = residual
-            artichoke += 4
+            fitarrays.append([lambdasfit,fluxesfit,smooth_sens,residual])
                    
             cucumber += 1
 
+        bigarray = np.zeros([max([len(x[0]) for x in fitarrays]),4*len(standards)])
+        for artichoke in range(len(fitarrays)):
+            for column in range(4):
+                values = fitarrays[artichoke][column]
+                bigarray[0:len(values),4*artichoke+column] = values
+
         #Save fit and residuals into text file for diagnostic plotting later.
         #Need to save lambdasfit,fluxesfit,smooth_sens,residual for each standard
         #List of standards is found as standards
@@ -423,6 +486,12 @@ def flux_calibrate_now(stdlist,fluxlist,speclist,extinct_correct=False,masterres
             header = str(standards) + '\n Set of four columns correspond to wavelength, observed flux, polynomial fit, \n and residuals for each standard listed above. \n You will probably need to strip zeros from the bottoms of some columns.'
             np.savetxt(handle,bigarray,fmt='%f',header = header)    
 
+        #Fit all the standards on each arm together, with an airmass term (see sensitivity.py)
+        if jointsens and nightfits is None:
+            print 'Fitting the joint sensitivity model.'
+            models = sensitivity.fit_models(standards,stdfits)
+            sensitivity.save_models(standards,stdfluxes,masksigs,stdfits,models,extinct_correct)
+
     #Outline for next steps:
     #Read in both red and blue files
     #compute airmass and compare to airstd
@@ -463,20 +532,14 @@ def flux_calibrate_now(stdlist,fluxlist,speclist,extinct_correct=False,masterres
             print 'Extinction correcting spectra.'
             #plt.clf()
             #plt.plot(WD_spectra1.warr,WD_spectra1.opfarr)
-            WD_spectra1.opfarr = st.extinction_correction(WD_spectra1.warr,WD_spectra1.opfarr,airmass1)
-            WD_spectra1.farr = st.extinction_correction(WD_spectra1.warr,WD_spectra1.farr,airmass1)
-            WD_spectra1.sky = st.extinction_correction(WD_spectra1.warr,WD_spectra1.sky,airmass1)
-            WD_spectra1.sigma = st.extinction_correction(WD_spectra1.warr,WD_spectra1.sigma,airmass1)
+            WD_spectra1.correct_extinction(airmass1) #opfarr, farr, sky, and sigma together
             #plt.plot(WD_spectra1.warr,WD_spectra1.opfarr)
             #plt.show()
 
             if redfile:
                 #plt.clf()
                 #plt.plot(WD_spectra2.warr,WD_spectra2.opfarr)
-                WD_spectra2.opfarr = st.extinction_correction(WD_spectra2.warr,WD_spectra2.opfarr,airmass2)
-                WD_spectra2.farr = st.extinction_correction(WD_spectra2.warr,WD_spectra2.farr,airmass2)
-                WD_spectra2.sky = st.extinction_correction(WD_spectra2.warr,WD_spectra2.sky,airmass2)
-                WD_spectra2.sigma = st.extinction_correction(WD_spectra2.warr,WD_spectra2.sigma,airmass2)
+                WD_spectra2.correct_extinction(airmass2)
 
 
                 #zaplt.plot(WD_spectra2.warr,WD_spectra2.opfarr)
@@ -548,6 +611,10 @@ def flux_calibrate_now(stdlist,fluxlist,speclist,extinct_correct=False,masterres
                     else:
                         sens_wave2 = sens_wave2_unscale + (red_mean_tonight - red_mean_stan)
                     choice2 = 3
+        elif jointsens:
+            sens_wave1 = models[sensitivity.spectrum_arm(specfile[avocado])](WD_spectra1.warr,airmass1)
+            if redfile:
+                sens_wave2 = models[sensitivity.spectrum_arm(specfile[avocado+1])](WD_spectra2.warr,airmass2)
         else:
             sens_wave1 = senspolys[choice](WD_spectra1.warr)
             if redfile:
@@ -557,16 +624,10 @@ def flux_calibrate_now(stdlist,fluxlist,speclist,extinct_correct=False,masterres
         print 'Doing the final flux calibration.'
         #np.savetxt('response_g60-54_extinction_2016-03-17.txt',np.transpose([WD_spectra1.warr,(exptime1 * dispersion1 * 10.**(sens_wave1/2.5))]))#,WD_spectra2.warr,(exptime2 * dispersion2 * 10.**(sens_wave2/2.5))]))
         #exit()
-        star_opflux1 = st.cal_spec(WD_spectra1.opfarr,sens_wave1,exptime1,dispersion1)
-        star_flux1 = st.cal_spec(WD_spectra1.farr,sens_wave1,exptime1,dispersion1)
-        sky_flux1 = st.cal_spec(WD_spectra1.sky,sens_wave1,exptime1,dispersion1)
-        sigma_flux1 = st.cal_spec(WD_spectra1.sigma,sens_wave1,exptime1,dispersion1)
+        star_opflux1, star_flux1, sky_flux1, sigma_flux1 = WD_spectra1.calibrate(sens_wave1,exptime1,dispersion1).bands
 
         if redfile:
-            star_opflux2 = st.cal_spec(WD_spectra2.opfarr,sens_wave2,exptime2,dispersion2)
-            star_flux2 = st.cal_spec(WD_spectra2.farr,sens_wave2,exptime2,dispersion2)
-            sky_flux2 = st.cal_spec(WD_spectra2.sky,sens_wave2,exptime2,dispersion2)
-            sigma_flux2 = st.cal_spec(WD_spectra2.sigma,sens_wave2,exptime2,dispersion2)
+            star_opflux2, star_flux2, sky_flux2, sigma_flux2 = WD_spectra2.calibrate(sens_wave2,exptime2,dispersion2).bands
         
         #plt.clf()
         #plt.plot(WD_spectra.warr,star_opflux)
@@ -600,7 +661,11 @@ def flux_calibrate_now(stdlist,fluxlist,speclist,extinct_correct=False,masterres
         header1.set('EX-FLAG',extinctflag) #Extiction correction? 0=yes, -1=no
         header1.set('CA-FLAG',0) #Calibrated to flux scale? 0=yes, -1=no
         header1.set('BUNIT','erg/cm2/s/A') #physical units of the array value
-        header1.set('STANDARD',str(standards[choice]),'Flux standard used') #flux standard used for flux-calibration
+        if jointsens and not masterresp:
+            header1.set('STANDARD',sensitivity.MODEL_FILE,'Joint sensitivity model of all standards') #sensitivity model used for flux-calibration
+            header1.set('STDLIST',','.join(stdflux),'Flux standards in the model')
+        else:
+            header1.set('STANDARD',str(standards[choice]),'Flux standard used') #flux standard used for flux-calibration
         if masterresp:
             header1.set('STDOFF',str(flux_tonight_list[0]),'Night offset used')
         
@@ -612,6 +677,9 @@ def flux_calibrate_now(stdlist,fluxlist,speclist,extinct_correct=False,masterres
             if masterresp:
                 header2.set('STANDARD',str(standards[choice2]),'Flux standard used') #flux standard used for flux-calibration
                 header1.set('STDOFF',str(flux_tonight_list[1]),'Night offset used')
+            elif jointsens:
+                header2.set('STANDARD',sensitivity.MODEL_FILE,'Joint sensitivity model of all standards') #sensitivity model used for flux-calibration
+                header2.set('STDLIST',','.join(stdflux),'Flux standards in the model')
             else:
                 header2.set('STANDARD',str(standards[choice+1]),'Flux standard used') #flux standard used for flux-calibration
 
@@ -645,7 +713,9 @@ def flux_calibrate_now(stdlist,fluxlist,speclist,extinct_correct=False,masterres
         mylist = [True for f in os.listdir('.') if f == newname1]
         exists = bool(mylist)
 
-        if exists:
+        if exists and auto:
+            clob = True
+        elif exists:
             print 'File %s already exists.' % newname1
             nextstep = raw_input('Do you want to overwrite or designate a new name (overwrite/new)? ')
             if nextstep == 'overwrite':
@@ -658,6 +728,7 @@ def flux_calibrate_now(stdlist,fluxlist,speclist,extinct_correct=False,masterres
                 exists = False
         print 'Saving: ', newname1
         newim1 = fits.PrimaryHDU(data=data1,header=header1)
+        newim1 = fits.HDUList([newim1,ge.wave_hdu(header1,Nx1)])
         newim1.writeto(newname1,clobber=clob)
 
         if redfile:
@@ -670,7 +741,9 @@ def flux_calibrate_now(stdlist,fluxlist,speclist,extinct_correct=False,masterres
             mylist = [True for f in os.listdir('.') if f == newname2]
             exists = bool(mylist)
 
-            if exists:
+            if exists and auto:
+                clob = True
+            elif exists:
                 print 'File %s already exists.' % newname2
                 nextstep = raw_input('Do you want to overwrite or designate a new name (overwrite/new)? ')
                 if nextstep == 'overwrite':
@@ -683,6 +756,7 @@ def flux_calibrate_now(stdlist,fluxlist,speclist,extinct_correct=False,masterres
                     exists = False
 
             newim2 = fits.PrimaryHDU(data=data2,header=header2)
+            newim2 = fits.HDUList([newim2,ge.wave_hdu(header2,Nx2)])
             newim2.writeto(newname2,clobber=clob)
             print 'Saving: ', newname2
 
@@ -692,11 +766,18 @@ def flux_calibrate_now(stdlist,fluxlist,speclist,extinct_correct=False,masterres
         now = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M")
         if masterresp:
             newinfo1 = specfile[avocado] + '\t' + now + '\t' + standards[choice] + '\t' + stdflux[0] + '\t' + str(allexcluded[choice]) + '\t' + str(orderused[choice]) + '\t' + str(size) + '\t' + newname1
+        elif jointsens:
+            #The model in place of the standard, with the flux files, masks, and orders of all the standards on this arm
+            arm1 = [x for x in range(len(standards)) if sensitivity.spectrum_arm(standards[x]) == sensitivity.spectrum_arm(specfile[avocado])]
+            newinfo1 = specfile[avocado] + '\t' + now + '\t' + sensitivity.MODEL_FILE + '\t' + ','.join([stdfluxes[x] for x in arm1]) + '\t' + str([allexcluded[x] for x in arm1]) + '\t' + str([orderused[x] for x in arm1]) + '\t' + str(size) + '\t' + newname1
         else:
             newinfo1 = specfile[avocado] + '\t' + now + '\t' + standards[choice] + '\t' + stdflux[choice//2] + '\t' + str(allexcluded[choice]) + '\t' + str(orderused[choice]) + '\t' + str(size) + '\t' + newname1
         if redfile:
             if masterresp:
                 newinfo2 = specfile[avocado+1] + '\t' + now + '\t' + standards[choice2] + '\t' + stdflux[0] + '\t' + str(allexcluded[choice+1]) + '\t' + str(orderused[choice+1]) + '\t' + str(size) + '\t' + newname2
+            elif jointsens:
+                arm2 = [x for x in range(len(standards)) if sensitivity.spectrum_arm(standards[x]) == sensitivity.spectrum_arm(specfile[avocado+1])]
+                newinfo2 = specfile[avocado+1] + '\t' + now + '\t' + sensitivity.MODEL_FILE + '\t' + ','.join([stdfluxes[x] for x in arm2]) + '\t' + str([allexcluded[x] for x in arm2]) + '\t' + str([orderused[x] for x in arm2]) + '\t' + str(size) + '\t' + newname2
             else:
                 newinfo2 = specfile[avocado+1] + '\t' + now + '\t' + standards[choice+1] + '\t' + stdflux[choice//2] + '\t' + str(allexcluded[choice+1]) + '\t' + str(orderused[choice+1]) + '\t' + str(size) + '\t' + newname2
             f.write(newinfo1 + "\n" + newinfo2 + "\n")
@@ -723,6 +804,8 @@ if __name__ == '__main__':
     parser.add_argument('--stan_list',default=None)
     parser.add_argument('--usemaster',type=str2bool,nargs='?',const=False,default=False,help='Activate nice mode.')
     parser.add_argument('--extinct',type=str2bool,nargs='?',const=True,default=True,help='Activate nice mode.')
+    parser.add_argument('--auto',type=str2bool,nargs='?',const=True,default=False,help='Fit sensitivity functions with no user interaction.')
+    parser.add_argument('--jointsens',type=str2bool,nargs='?',const=True,default=True,help='Fit all standards together with an airmass term.')
     args = parser.parse_args()
     #print args.stand_list
-    flux_calibrate_now(args.stan_list,args.flux_list,args.spec_list,extinct_correct=args.extinct,masterresp=args.usemaster)
+    flux_calibrate_now(args.stan_list,args.flux_list,args.spec_list,extinct_correct=args.extinct,masterresp=args.usemaster,auto=args.auto,jointsens=args.jointsens)
@@ -0,0 +1,164 @@
+'''
+Written for the ZZ Ceti pipeline.
+
+The grating equation for the Goodman spectrograph, shared by Wavelength_Calibration.py, spectools.py, and plotspec.py. All functions work on whole arrays at once.
+
+Parameters used throughout:
+    alpha = grating angle in degrees (GRT_TARG)
+    theta = camera angle in degrees (CAM_TARG)
+    fr = fringe density of grating (LINDEN)
+    fd = camera angle correction factor (CAMFUD)
+    fl = focal length (FOCLEN)
+    zPnt = zero point pixel (ZPOINT)
+
+Pixels are unbinned pixel numbers on the full CCD, as returned by header_pixels.
+
+fit_grating fits fr, fd, and zPnt to lamp lines. It uses no module globals, so several solutions can be fit at the same time.
+
+When a solution is applied, the wavelength of each pixel and the wavelength step to it from the pixel before are saved as a (2, nx) image extension named WAVE (wave_hdu). read_wavelengths uses that extension, and only recomputes from the header for older files without it, or if the header parameters have changed since it was written.
+
+'''
+
+import numpy as np
+import astropy.io.fits as fits
+
+WAVE_EXTNAME = 'WAVE'
+WAVE_KEYS = ['GRT_TARG','CAM_TARG','LINDEN','CAMFUD','FOCLEN','ZPOINT']
+
+#===========================================
+def wavelengths(pixels, alpha, theta, fr, fd, fl, zPnt):
+    #Wavelength in Angstroms of each pixel
+    pixels = np.asarray(pixels, dtype=float)
+    beta = np.arctan( (pixels-zPnt)*15./fl ) + (fd*theta*np.pi/180.) - (alpha*np.pi/180.)
+    return (10**6.)*( np.sin(beta) + np.sin(alpha*np.pi/180.) )/fr
+
+#===========================================
+def pixels(waves, alpha, theta, fr, fd, fl, zPnt):
+    #Pixel number of each wavelength in Angstroms. Inverse of wavelengths.
+    waves = np.asarray(waves, dtype=float)
+    beta = np.arcsin( (waves*fr/1000000.0) - np.sin(alpha*np.pi/180.) )
+    return np.tan((beta + (alpha*np.pi/180.)) - (fd*theta*np.pi/180.)) * (fl/15.) + zPnt
+
+#===========================================
+def dispersion(pixels, alpha, theta, fr, fd, fl, zPnt):
+    #Derivative of wavelength with respect to pixel number, in Angstroms per unbinned pixel.
+    #Multiply by the binning for Angstroms per binned pixel.
+    pixels = np.asarray(pixels, dtype=float)
+    u = (pixels-zPnt)*15./fl
+    beta = np.arctan(u) + (fd*theta*np.pi/180.) - (alpha*np.pi/180.)
+    return (10**6.)*np.cos(beta)/fr * (15./fl)/(1. + u**2.)
+
+#===========================================
+def zero_point(pixel, wave, alpha, theta, fr, fd, fl):
+    #Zero point that puts wavelength wave at pixel, with the other parameters fixed. Exact inverse of wavelengths for zPnt.
+    return np.asarray(pixel, dtype=float) - pixels(wave, alpha, theta, fr, fd, fl, 0.)
+
+#===========================================
+def header_pixels(header, nx):
+    #Unbinned pixel numbers of the nx columns of a spectrum, using the trim section and binning in the header.
+    trim_sec= header["CCDSEC"]
+    trim_offset= float( trim_sec[1:len(trim_sec)-1].split(':')[0] )-1
+    try:
+        bining= float( header["PARAM18"] )
+    except:
+        bining= float( header["PG3_2"] )
+    return bining*(np.arange(0,nx,1)+trim_offset)
+
+#===========================================
+def header_parameters(header):
+    #Grating equation parameters saved in the header by Wavelength_Calibration.py
+    alpha = float(header['GRT_TARG'])
+    theta = float(header['CAM_TARG'])
+    fr = float(header['LINDEN'])
+    fd = float(header['CAMFUD'])
+    fl = float(header['FOCLEN'])
+    zPnt = float(header['ZPOINT'])
+    return alpha, theta, fr, fd, fl, zPnt
+
+#===========================================
+def header_wavelengths(header, nx):
+    #Wavelengths of the nx columns of a wavelength calibrated spectrum
+    return wavelengths(header_pixels(header, nx), *header_parameters(header))
+
+#===========================================
+def header_steps(waves):
+    #Wavelength step to each pixel from the one before it. The first pixel uses the step to the second.
+    steps = np.diff(waves)
+    return np.concatenate(([steps[0]],steps))
+
+#===========================================
+def wave_hdu(header, nx):
+    #Image extension holding the wavelengths (row 0) and wavelength steps (row 1) of the nx columns of a spectrum.
+    #The grating equation parameters are copied to its header so read_wavelengths can tell if the solution changed.
+    waves = header_wavelengths(header, nx)
+    hdu = fits.ImageHDU(data=np.array([waves, header_steps(waves)]), name=WAVE_EXTNAME)
+    for key in WAVE_KEYS:
+        hdu.header.set(key, header[key])
+    return hdu
+
+#===========================================
+def read_wavelengths(hdulist, nx):
+    #Wavelengths and wavelength steps of a spectrum opened with fits.open.
+    #Uses the WAVE extension if it matches the primary header. Otherwise they are computed from the header.
+    header = hdulist[0].header
+    try:
+        wavehdu = hdulist[WAVE_EXTNAME]
+    except KeyError:
+        wavehdu = None
+    if wavehdu is not None:
+        if wavehdu.header['NAXIS1'] == nx and all([wavehdu.header.get(key) == header.get(key) for key in WAVE_KEYS]):
+            return wavehdu.data[0], wavehdu.data[1]
+    waves = header_wavelengths(header, nx)
+    return waves, header_steps(waves)
+
+#===========================================
+def pixel_derivatives(waves, alpha, theta, fr, fd, fl, zPnt):
+    #Derivatives of pixels() with respect to fr, fd, and zPnt. Shape (len(waves), 3).
+    waves = np.asarray(waves, dtype=float)
+    arg = (waves*fr/1000000.0) - np.sin(alpha*np.pi/180.)
+    beta = np.arcsin(arg)
+    g = (beta + (alpha*np.pi/180.)) - (fd*theta*np.pi/180.)
+    dpixdg = (fl/15.)/np.cos(g)**2.
+    dfr = dpixdg * (waves/1000000.0)/np.sqrt(1. - arg**2.)
+    dfd = -dpixdg * theta*np.pi/180.
+    return np.transpose([dfr, dfd, np.ones(waves.shape)])
+
+#===========================================
+def fit_grating(known_pix, known_wave, alpha, theta, Param, sigma=3., maxpass=5, minlines=6):
+    #Fit fr, fd, and zPnt to lines with known pixel positions and wavelengths. The focal length is held at Param[2].
+    #Param is the starting [fr, fd, fl, zPnt]. Uses analytic derivatives.
+    #After each fit, lines more than sigma times the RMS from the solution are rejected and the fit is repeated,
+    #up to maxpass times, never keeping fewer than minlines lines.
+    #Returns:
+    #   par: fitted [fr, fd, zPnt]
+    #   errors: 1-sigma uncertainties of par from the covariance matrix
+    #   rms: RMS of the residuals of the lines kept, in pixels
+    #   residuals: known_pix - fitted pixel for every line
+    #   used: bool array, True for lines kept in the final fit
+    from scipy.optimize import leastsq
+    known_pix = np.asarray(known_pix, dtype=float)
+    known_wave = np.asarray(known_wave, dtype=float)
+    fr, fd, fl, zPnt = Param
+    p0 = np.array([fr, fd, zPnt], dtype=float)
+    used = np.isfinite(known_pix) & np.isfinite(known_wave)
+
+    def resid(p, pix, wave):
+        return pixels(wave, alpha, theta, p[0], p[1], fl, p[2]) - pix
+    def jac(p, pix, wave):
+        return pixel_derivatives(wave, alpha, theta, p[0], p[1], fl, p[2])
+
+    for npass in range(maxpass+1):
+        par, cov, info, mesg, ier = leastsq(resid, p0, args=(known_pix[used], known_wave[used]), Dfun=jac, full_output=True)
+        residuals = known_pix - pixels(known_wave, alpha, theta, par[0], par[1], fl, par[2])
+        rms = np.sqrt(np.mean(residuals[used]**2.))
+        reject = used & (np.abs(residuals) > sigma*rms)
+        if npass == maxpass or not reject.any() or (used.sum() - reject.sum()) < minlines:
+            break
+        used = used & ~reject
+        p0 = par
+    dof = max(used.sum() - len(par), 1)
+    if cov is None:
+        errors = np.zeros(len(par)) + np.nan
+    else:
+        errors = np.sqrt(np.diag(cov) * np.sum(residuals[used]**2.)/dof)
+    return par, errors, rms, residuals, used
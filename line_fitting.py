@@ -0,0 +1,255 @@
+'''
+Written for the ZZ Ceti pipeline.
+
+Fit many spectral lines at once. Each line is a window of points (x, y); all windows must have the same number of points and are stacked into 2D arrays with one line per row. Every line is fit by its own Levenberg-Marquardt solve, but all of the solves are done together with array operations, so fitting 50 lines costs about the same as fitting one.
+
+Models:
+    fit_gaussians: y = a*exp(-(x-c)**2/(2*w**2)) + b (same parameter order as Wavelength_Calibration.Gauss), for lamp lines
+    fit_pseudogausscubic: pseudo-Gaussian plus cubic (same as Wavelength_Calibration.pseudogausscubic), for Balmer lines in a stack of spectra
+    fit_template_shift: shift and scale of a pseudo-Gaussian plus cubic fitted once, for Balmer lines in many low signal to noise spectra
+
+'''
+
+import numpy as np
+
+#===========================================
+def gauss_model(x,p):
+    #x is (nlines, npoints). p is (nlines, 4) with columns amplitude, center, width, background.
+    a, c, w, b = [p[:,i].reshape(-1,1) for i in range(4)]
+    e = np.exp(-(x-c)**2./(2.*w**2.))
+    return a*e + b
+
+#===========================================
+def gauss_jacobian(x,p):
+    #Derivatives of gauss_model with respect to each parameter. Shape (nlines, npoints, 4).
+    a, c, w, b = [p[:,i].reshape(-1,1) for i in range(4)]
+    dx = x - c
+    e = np.exp(-dx**2./(2.*w**2.))
+    return np.dstack((e, a*e*dx/w**2., a*e*dx**2./w**3., np.ones(x.shape)))
+
+#===========================================
+def gauss_guess(x,y,width=3.0*0.42):
+    #Starting values: peak of the window for the center, median for the background, and a fixed width in x units.
+    imax = np.argmax(y,axis=1)
+    rows = np.arange(y.shape[0])
+    back = np.median(y,axis=1)
+    p0 = np.zeros((y.shape[0],4))
+    p0[:,0] = y[rows,imax] - back
+    p0[:,1] = x[rows,imax]
+    p0[:,2] = width
+    p0[:,3] = back
+    return p0
+
+#===========================================
+def levmar(x,y,p0,model,jacobian,sigma=None,maxiter=200,ftol=1e-10):
+    #Levenberg-Marquardt fit of model to every row of y at the same time.
+    #model(x,p) returns (nlines, npoints); jacobian(x,p) returns (nlines, npoints, nparams).
+    #sigma is the uncertainty of each point of y (same shape as y). If None, all points count equally.
+    #Returns p, covariance (scaled by reduced chi-square), chi-square, and a bool array that is True where the fit converged.
+    p = np.array(p0,dtype=float,copy=True)
+    nlines, nparams = p.shape
+    npoints = y.shape[1]
+    if sigma is not None:
+        #Fit y/sigma with the model and derivatives divided by sigma
+        sigma = np.asarray(sigma,dtype=float)*np.ones(y.shape)
+        y = y/sigma
+        unweighted_model, unweighted_jacobian = model, jacobian
+        model = lambda xx,pp,ss: unweighted_model(xx,pp)/ss
+        jacobian = lambda xx,pp,ss: unweighted_jacobian(xx,pp)/ss[:,:,np.newaxis]
+    else:
+        sigma = np.ones(y.shape)
+        unweighted_model, unweighted_jacobian = model, jacobian
+        model = lambda xx,pp,ss: unweighted_model(xx,pp)
+        jacobian = lambda xx,pp,ss: unweighted_jacobian(xx,pp)
+    lam = np.ones(nlines) * 1e-3
+    resid = y - model(x,p,sigma)
+    chisq = np.sum(resid**2.,axis=1)
+    converged = np.zeros(nlines,dtype=bool)
+    for iteration in range(maxiter):
+        active = ~converged
+        if not active.any():
+            break
+        J = jacobian(x[active],p[active],sigma[active])
+        alpha = np.einsum('kni,knj->kij',J,J)
+        beta = np.einsum('kni,kn->ki',J,resid[active])
+        diag = np.einsum('kii->ki',alpha)
+        diag = np.maximum(diag,1e-12*np.maximum(diag.max(axis=1),1e-300).reshape(-1,1))
+        damped = alpha.copy()
+        idx = np.arange(nparams)
+        damped[:,idx,idx] = diag*(1.+lam[active].reshape(-1,1))
+        step = np.linalg.solve(damped,beta[:,:,np.newaxis])[:,:,0]
+        ptrial = p[active] + step
+        rtrial = y[active] - model(x[active],ptrial,sigma[active])
+        ctrial = np.sum(rtrial**2.,axis=1)
+        better = np.isfinite(ctrial) & (ctrial <= chisq[active])
+        #Accept improved steps and relax the damping. Otherwise increase it.
+        rows = np.nonzero(active)[0]
+        done = better & ((chisq[active]-ctrial) <= ftol*np.maximum(chisq[active],1e-300))
+        take = rows[better]
+        p[take] = ptrial[better]
+        resid[take] = rtrial[better]
+        chisq[take] = ctrial[better]
+        lam[take] = lam[take]/10.
+        lam[rows[~better]] = lam[rows[~better]]*10.
+        converged[rows[done]] = True
+        #Damping this large means no step can improve the fit, so we are at the minimum.
+        converged[rows[~better & (lam[rows] > 1e10)]] = True
+    J = jacobian(x,p,sigma)
+    alpha = np.einsum('kni,knj->kij',J,J)
+    dof = max(npoints - nparams,1)
+    try:
+        covar = np.linalg.inv(alpha) * (chisq/dof).reshape(-1,1,1)
+    except np.linalg.LinAlgError:
+        #At least one fit is singular. Invert one at a time and leave those as nan.
+        covar = np.zeros(alpha.shape) + np.nan
+        for k in range(nlines):
+            try:
+                covar[k] = np.linalg.inv(alpha[k]) * chisq[k]/dof
+            except np.linalg.LinAlgError:
+                pass
+    return p, covar, chisq, converged
+
+#===========================================
+def fit_gaussians(x,y,p0=None,width=3.0*0.42,maxiter=200):
+    #Fit a Gaussian plus constant background to each row of y.
+    #x and y are (nlines, npoints). If p0 is not given, starting values come from gauss_guess.
+    #Returns:
+    #   params: (nlines, 4) amplitude, center, width, background
+    #   errors: (nlines, 4) 1-sigma uncertainties from the covariance matrix
+    #   good: (nlines,) True if the fit converged to a positive line inside its window with a sensible width
+    x = np.asarray(x,dtype=float)
+    y = np.asarray(y,dtype=float)
+    if p0 is None:
+        p0 = gauss_guess(x,y,width=width)
+    params, covar, chisq, converged = levmar(x,y,p0,gauss_model,gauss_jacobian,maxiter=maxiter)
+    params[:,2] = np.abs(params[:,2])
+    errors = np.sqrt(np.abs(np.einsum('kii->ki',covar)))
+    span = x.max(axis=1) - x.min(axis=1)
+    good = (converged & np.all(np.isfinite(params),axis=1) & np.all(np.isfinite(errors),axis=1)
+            & (params[:,0] > 0.) & (params[:,1] >= x.min(axis=1)) & (params[:,1] <= x.max(axis=1))
+            & (params[:,2] > 0.) & (params[:,2] < span/2.) & (errors[:,1] < span/4.))
+    return params, errors, good
+
+#===========================================
+def line_windows(x,y,centers,halfwidth):
+    #Cut a window of 2*halfwidth points around each index in centers.
+    #Windows that would run off the end are shifted inside; inside is False for those lines.
+    x = np.asarray(x,dtype=float)
+    y = np.asarray(y,dtype=float)
+    centers = np.asarray(centers,dtype=int)
+    start = centers - halfwidth
+    inside = (start >= 0) & (centers + halfwidth <= len(x))
+    start = np.clip(start,0,len(x)-2*halfwidth)
+    index = start.reshape(-1,1) + np.arange(2*halfwidth)
+    return x[index], y[index], inside
+
+#===========================================
+#Pseudo-Gaussian plus cubic continuum, with the same parameters as Wavelength_Calibration.pseudogausscubic:
+#   y = p[0] + p[1]*x + p[2]*x**2 + p[7]*x**3 + p[3]*exp(-(|x-p[4]|/(sqrt(2)*p[5]))**p[6])
+#Used to center the Balmer lines of many spectra at once.
+
+def pseudogausscubic(x,p):
+    #x is (nspec, npoints) or (npoints,). p is (nspec, 8). Returns (nspec, npoints).
+    x = np.asarray(x,dtype=float)
+    p = np.atleast_2d(p)
+    col = lambda i: p[:,i].reshape(-1,1)
+    z = np.abs(x-col(4))/(np.sqrt(2.)*col(5))
+    return col(0) + col(1)*x + col(2)*x**2. + col(7)*x**3. + col(3)*np.exp(-z**col(6))
+
+#===========================================
+def pseudogausscubic_jacobian(x,p):
+    #Derivatives of pseudogausscubic with respect to each parameter. Shape (nspec, npoints, 8).
+    x = np.asarray(x,dtype=float)*np.ones((p.shape[0],1))
+    col = lambda i: p[:,i].reshape(-1,1)
+    dx = x - col(4)
+    z = np.abs(dx)/(np.sqrt(2.)*col(5))
+    zk = z**col(6)
+    G = np.exp(-zk)
+    positive = z > 0.
+    safez = np.where(positive,z,1.)
+    dGdc = np.where(positive, G*col(6)*zk/safez*np.sign(dx)/(np.sqrt(2.)*col(5)), 0.)
+    dGdw = G*col(6)*zk/col(5)
+    dGdk = np.where(positive, -G*zk*np.log(safez), 0.)
+    return np.dstack((np.ones(x.shape), x, x**2., G, col(3)*dGdc, col(3)*dGdw, col(3)*dGdk, x**3.))
+
+#===========================================
+def _shift_matrix(x0,s):
+    #M such that the cubic with increasing-order coefficients c in x = x0 + s*u has coefficients dot(c,M) in u.
+    from math import factorial
+    M = np.zeros((4,4))
+    for j in range(4):
+        for k in range(j+1):
+            M[j,k] = factorial(j)/(factorial(k)*factorial(j-k)) * x0**(j-k) * s**k
+    return M
+
+def _rescale(p,x0,s):
+    #Parameters for x to parameters for u = (x-x0)/s
+    p = np.array(p,dtype=float,copy=True)
+    poly = np.dot(p[:,[0,1,2,7]],_shift_matrix(x0,s))
+    p[:,[0,1,2,7]] = poly
+    p[:,4] = (p[:,4]-x0)/s
+    p[:,5] = p[:,5]/s
+    return p
+
+def _unscale(p,x0,s):
+    #Parameters for u = (x-x0)/s back to parameters for x
+    return _rescale(p,-x0/s,1./s)
+
+#===========================================
+def fit_pseudogausscubic(x,y,err,p0,maxiter=200):
+    #Fit pseudogausscubic to each row of y (nspec, npoints) on the shared pixel grid x (npoints,).
+    #err is the sigma of each point. p0 is (8,) to start every spectrum from the same values, or (nspec, 8).
+    #The fit is done in a scaled pixel coordinate so the cubic terms stay well conditioned.
+    #Returns params (nspec, 8), errors (nspec, 8), and good (nspec,), True where the fit converged to an absorption line inside the window.
+    x = np.asarray(x,dtype=float)
+    y = np.atleast_2d(np.asarray(y,dtype=float))
+    err = np.atleast_2d(np.asarray(err,dtype=float))*np.ones(y.shape)
+    p0 = np.atleast_2d(np.asarray(p0,dtype=float))*np.ones((y.shape[0],1))
+    x0 = 0.5*(x.max()+x.min())
+    s = 0.5*(x.max()-x.min())
+    u = (x-x0)/s
+    uu = u*np.ones(y.shape)
+    pu, covar, chisq, converged = levmar(uu,y,_rescale(p0,x0,s),pseudogausscubic,pseudogausscubic_jacobian,sigma=err,maxiter=maxiter)
+    params = _unscale(pu,x0,s)
+    params[:,5] = np.abs(params[:,5])
+    #Scale the errors back to pixels. The cubic terms mix, so only the line parameters are converted.
+    uerr = np.sqrt(np.abs(np.einsum('kii->ki',covar)))
+    errors = np.zeros(params.shape) + np.nan
+    errors[:,3] = uerr[:,3]
+    errors[:,4] = uerr[:,4]*s
+    errors[:,5] = uerr[:,5]*s
+    errors[:,6] = uerr[:,6]
+    good = (converged & np.all(np.isfinite(params),axis=1) & (params[:,3] < 0.)
+            & (params[:,4] >= x.min()) & (params[:,4] <= x.max()) & np.isfinite(errors[:,4]))
+    return params, errors, good
+
+#===========================================
+def fit_template_shift(x,y,err,template,maxiter=100):
+    #Center a line in each row of y by shifting and scaling a template fitted once with fit_pseudogausscubic.
+    #Model: y = scale*T(x-shift) + a + b*(x-x0), where T is pseudogausscubic with parameters template (8,).
+    #Only 4 parameters are fit per spectrum, so this is fast and stable at low signal to noise.
+    #Returns centers (template center + shift), errors on the centers, and good flags.
+    x = np.asarray(x,dtype=float)
+    y = np.atleast_2d(np.asarray(y,dtype=float))
+    err = np.atleast_2d(np.asarray(err,dtype=float))*np.ones(y.shape)
+    template = np.asarray(template,dtype=float).reshape(1,8)
+    x0 = 0.5*(x.max()+x.min())
+    T = lambda xx: pseudogausscubic(xx,template)
+    def dTdx(xx):
+        J = pseudogausscubic_jacobian(xx,template)
+        poly = template[0,1] + 2.*template[0,2]*xx + 3.*template[0,7]*xx**2.
+        return poly - J[:,:,4]
+    def model(xx,p):
+        col = lambda i: p[:,i].reshape(-1,1)
+        return col(0)*T(xx-col(1)) + col(2) + col(3)*(xx-x0)
+    def jacobian(xx,p):
+        col = lambda i: p[:,i].reshape(-1,1)
+        shifted = xx - col(1)
+        return np.dstack((T(shifted), -col(0)*dTdx(shifted), np.ones(xx.shape), xx-x0))
+    p0 = np.zeros((y.shape[0],4))
+    p0[:,0] = 1.
+    p, covar, chisq, converged = levmar(x*np.ones(y.shape),y,p0,model,jacobian,sigma=err,maxiter=maxiter)
+    centers = template[0,4] + p[:,1]
+    errors = np.sqrt(np.abs(covar[:,1,1]))
+    good = converged & np.isfinite(centers) & np.isfinite(errors) & (p[:,0] > 0.) & (centers >= x.min()) & (centers <= x.max())
+    return centers, errors, good
@@ -12,23 +12,7 @@ import astropy.io.fits as fits
 import numpy as np
 import matplotlib.pyplot as plt
 from sys import argv
-
-def DispCalc(Pixels, alpha, theta, fr, fd, fl, zPnt):
-    # This is the Grating Equation used to calculate the wavelenght of a pixel
-    # based on the fitted parameters and angle set up.
-    # Inputs: 
-    # Pixels= Vector of Pixel Numbers
-    # alpha=  of Grating Angle
-    # aheta=  Camera Angle
-    # fr= fringe density of grating
-    # fd= Camera Angle Correction Factor
-    # zPnt= Zero point pixel 
-    Wavelengths= [] # Vector to store calculated wavelengths 
-    for pix in Pixels:    
-        beta = np.arctan( (pix-zPnt)*15./fl ) + (fd*theta*np.pi/180.) - (alpha*np.pi/180.) 
-        wave = (10**6.)*( np.sin(beta) + np.sin(alpha*np.pi/180.) )/fr
-        Wavelengths.append(wave)
-    return Wavelengths
+import grating_equation as ge
 
 if len(argv) == 2:
     script, specname = argv[0], argv[1]
@@ -38,28 +22,14 @@ else:
     print 'Too many inputs. Please try again.'
     exit()
 
-spec_data= fits.getdata(specname)
-spec_header= fits.getheader(specname)
+spec_hdulist= fits.open(specname)
+spec_data= spec_hdulist[0].data
+spec_header= spec_hdulist[0].header
 
 #See if wavelength solution exists. If so, use it. Otherwise, use pixel numbers
 try:
-    alpha = float(spec_header['GRT_TARG'])
-    theta = float(spec_header['CAM_TARG'])
-    fr = float(spec_header['LINDEN'])
-    fd = float(spec_header['CAMFUD'])
-    fl = float(spec_header['FOCLEN'])
-    zPnt = float(spec_header['ZPOINT'])
-    
-    trim_sec= spec_header["CCDSEC"]
-    trim_offset= float( trim_sec[1:len(trim_sec)-1].split(':')[0] )-1
-    try:
-        bining= float( spec_header["PARAM18"] ) 
-    except:
-        bining= float( spec_header["PG3_2"] ) 
     nx= np.size(spec_data[0])
-    Pixels= bining*(np.arange(0,nx,1)+trim_offset)
-    
-    WDwave = DispCalc(Pixels, alpha, theta, fr, fd, fl, zPnt)
+    WDwave = ge.read_wavelengths(spec_hdulist, nx)[0]
 except:
     if 'fe_' in specname.lower():
         WDwave = np.arange(len(spec_data[0,:]))
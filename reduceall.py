@@ -22,6 +22,7 @@ import Wavelength_Calibration
 import continuum_normalization
 import flux_calibration
 import diagnostics
+import fitsaccess
 from glob import glob
 
 
@@ -50,40 +51,34 @@ lamp_file_blue = sorted(glob('tFe*blue*fits'))
 lamp_file_red = sorted(glob('tFe*red*fits'))
 
 
-#Search for FWHM and trace file for each spectrum. If it does not exist, these go to None and will be fit and saved during the extraction.
-trace_files = []
-FWHM_files = []
-for x in spec_files:
-    trace_name = '*' + x[5:-5] + '*trace.npy'
-    new_trace = glob(trace_name)
-    if len(new_trace) == 0:
-        trace_files.append(None)
-    else:
-        trace_files.append(new_trace[0])
-    fwhm_name = '*' + x[5:-5] + '*poly.npy'
-    new_fwhm = glob(fwhm_name)
-    if len(new_fwhm) == 0:
-        FWHM_files.append(None)
-    else:
-        FWHM_files.append(new_fwhm[0])
-
-
-for x in spec_files:
-    if 'blue' in x.lower():
-        lamp_file = lamp_file_blue[0]
-    elif 'red' in x.lower():
-        lamp_file = lamp_file_red[0]
-    FWHM_thisfile = FWHM_files[spec_files.index(x)]
-    trace_thisfile = trace_files[spec_files.index(x)]
-    if trace_thisfile != None:
-        trace_exist_file = True
-    else:
-        trace_exist_file = False
-    print ''
-    print x, lamp_file,trace_thisfile, FWHM_thisfile
-    #Must add in option of not have trace file or FWHM file
-    #if no FWHMfile, FWHMfile=None
-    spectral_extraction.extract_now(x,lamp_file,FWHMfile=FWHM_thisfile,tracefile=trace_thisfile,trace_exist=trace_exist_file)
+#Search for FWHM and trace file for each spectrum. Saved solutions for the same target, setup, and night come from the database (see solution_store.py). Files from reductions done before the database existed are added to it the first time this directory is reduced. If there is no saved solution, these go to None and will be fit and saved during the extraction.
+#Each stage opens every file once, and closes them all when it is done (see fitsaccess.py).
+with fitsaccess.stage():
+    spectral_extraction.import_legacy_solutions(spec_files)
+    trace_files = []
+    FWHM_files = []
+    for x in spec_files:
+        new_trace, new_fwhm = spectral_extraction.find_prior_solutions(x)
+        trace_files.append(new_trace)
+        FWHM_files.append(new_fwhm)
+
+
+    for x in spec_files:
+        if 'blue' in x.lower():
+            lamp_file = lamp_file_blue[0]
+        elif 'red' in x.lower():
+            lamp_file = lamp_file_red[0]
+        FWHM_thisfile = FWHM_files[spec_files.index(x)]
+        trace_thisfile = trace_files[spec_files.index(x)]
+        if trace_thisfile != None:
+            trace_exist_file = True
+        else:
+            trace_exist_file = False
+        print ''
+        print x, lamp_file,trace_thisfile, FWHM_thisfile
+        #Must add in option of not have trace file or FWHM file
+        #if no FWHMfile, FWHMfile=None
+        spectral_extraction.extract_now(x,lamp_file,FWHMfile=FWHM_thisfile,tracefile=trace_thisfile,trace_exist=trace_exist_file)
 
 
 #=========================
@@ -98,23 +93,10 @@ if len(offset_file) == 0:
 else:
     offset_file = offset_file[0]
 
-#print spec_files
-#print lamp_files
-#Need to carefully match up the correct lamp and spectrum files. This seems to work well.
-for x in lamp_files:
-    if 'blue' in x.lower():
-        lamp_color = 'blue'
-    elif 'red' in x.lower():
-        lamp_color = 'red'
-    for y in spec_files:
-        ###if (y[5:y.find('_930')] in x) and (y[y.find('_930'):y.find('_930')+8] in x):
-        if (lamp_color in y.lower()) and (y[5:y.find('_930')] in x):
-            print x, y, offset_file
-            if offset_file == None:
-                plotalot = True
-            else:
-                plotalot = False
-            Wavelength_Calibration.calibrate_now(x,y,'no','yes',offset_file,plotall=plotalot)
+#Lamps are matched to the spectrum whose trace they were extracted with (REF in the lamp header) and calibrated in parallel.
+#Existing w* files are overwritten. The solutions are listed in wavelength_solutions.txt.
+#Without an offset file, the offset is found by cross correlation, so no plots are needed.
+Wavelength_Calibration.calibrate_batch(lamp_files,spec_files,offset_file=offset_file,fit_zpoint='no',zzceti='yes',overwrite='overwrite')
 
 #=========================
 #Begin Continuum Normalization
@@ -122,26 +104,28 @@ for x in lamp_files:
 print '\n Begin continuum normalization.'
 continuum_files = sorted(glob('wcftb*ms.fits'))
 #print continuum_files
-x = 0
-while x < len(continuum_files):
-    if x == len(continuum_files)-1:
-        #print continuum_files[x]
-        continuum_normalization.normalize_now(continuum_files[x],None,False,plotall=False)
-        x += 1
-    elif continuum_files[x][0:continuum_files[x].find('930')] == continuum_files[x+1][0:continuum_files[x].find('930')]:
-        #print continuum_files[x],continuum_files[x+1]
-        continuum_normalization.normalize_now(continuum_files[x],continuum_files[x+1],True,plotall=False)
-        x += 2
-    else:
-        #print continuum_files[x]
-        continuum_normalization.normalize_now(continuum_files[x],None,False,plotall=False)
-        x += 1
+with fitsaccess.stage():
+    x = 0
+    while x < len(continuum_files):
+        if x == len(continuum_files)-1:
+            #print continuum_files[x]
+            continuum_normalization.normalize_now(continuum_files[x],None,False,plotall=False)
+            x += 1
+        elif continuum_files[x][0:continuum_files[x].find('930')] == continuum_files[x+1][0:continuum_files[x].find('930')]:
+            #print continuum_files[x],continuum_files[x+1]
+            continuum_normalization.normalize_now(continuum_files[x],continuum_files[x+1],True,plotall=False)
+            x += 2
+        else:
+            #print continuum_files[x]
+            continuum_normalization.normalize_now(continuum_files[x],None,False,plotall=False)
+            x += 1
 
 
 #=========================
 #Begin Flux Calibration
 #=========================
 print '\nBegin flux calibration.'
+#auto=True runs with no plots or prompts, so the night can be flux calibrated with no display.
 #We should use the same files are for the continuum normalization. But if you want to change that for some reason, adjust below.
 '''
 continuum_files = sorted(glob('wcftb*ms.fits'))
@@ -156,7 +140,8 @@ continuum_files = sorted(continuum_files)
 '''
 stdlist = None
 fluxlist = None
-flux_calibration.flux_calibrate_now(stdlist,fluxlist,continuum_files,extinct_correct=True,masterresp=True)
+with fitsaccess.stage():
+    flux_calibration.flux_calibrate_now(stdlist,fluxlist,continuum_files,extinct_correct=True,masterresp=True,auto=True)
 
 #=========================
 #Begin Flux Calibration
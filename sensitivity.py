@@ -0,0 +1,291 @@
+'''
+Written for the ZZ Ceti pipeline.
+
+Automatic fitting of sensitivity functions for flux_calibration.py, so a night can be flux calibrated with no display (flux_calibrate_now(...,auto=True)).
+
+Masks: the regions left out of the fit are read from sensitivity_masks.txt in the working directory, with three columns: lowest and highest wavelength in Angstroms, and a name with no spaces. If that file does not exist, MASK_REGIONS is used, which covers the Balmer lines and the strongest telluric bands. The mask used for each standard is saved in the same format as the ones made by clicking (*_mask.dat), so it can be checked or edited.
+
+Which mask is used for a standard (choose_mask):
+    1. A mask made by hand, *_maskasdf.dat, always.
+    2. Otherwise, in automatic mode, the saved *_mask.dat, unless sensitivity_masks.txt has been changed since it was written. So whichever of the two was edited last is used, and editing the table makes new masks for every standard.
+    3. Otherwise the table (or MASK_REGIONS), in automatic mode. Interactive runs ask for the regions to be clicked.
+
+Polynomial order: each order in ORDERS is fit with sigma clipping, and the one with the lowest Bayesian information criterion is kept. The scatter is measured with the median absolute deviation of the residuals of all points, so orders that clip different points can be compared.
+
+Fits: the fit to each standard spectrum is saved next to it as *_sensfit.npz, with the airmass, the points fit, the polynomial, and the excluded pixels. It is used again only if it is newer than the spectrum, and was made with the same flux file, the same extinction correction, and the same mask (compared by the name and contents of the mask file or table, mask_signature).
+
+Joint model: instead of using the single standard closest in airmass, all of the night's standards on each arm are fit together with S(lambda, X) = P(lambda) + X*Q(lambda), where X is the airmass, P has the highest order chosen for any of the standards, and Q is linear. The airmass term is left out if the standards all have about the same airmass. The model is evaluated at each science spectrum's own airmass, limited to the range of airmass the standards cover, since the airmass term is not constrained outside it. It is saved in sensitivity_model.npz with the fit to each standard. Automatic runs use it again while the list of standards, the flux file of each, the mask of each (mask_signature), the extinction correction, and the standard spectra are unchanged. Interactive runs always fit the standards again, so the masks and orders can be chosen.
+
+'''
+
+import os
+import hashlib
+import numpy as np
+
+MASK_FILE = 'sensitivity_masks.txt'
+MODEL_FILE = 'sensitivity_model.npz'
+
+#lowest wavelength, highest wavelength, name
+MASK_REGIONS = [(3780., 3815., 'H10'),
+                (3815., 3855., 'H9'),
+                (3865., 3910., 'H8'),
+                (3940., 4000., 'Hepsilon'),
+                (4060., 4145., 'Hdelta'),
+                (4290., 4395., 'Hgamma'),
+                (4800., 4930., 'Hbeta'),
+                (6490., 6640., 'Halpha'),
+                (6860., 6960., 'B_band'),
+                (7160., 7340., 'water'),
+                (7590., 7700., 'A_band')]
+
+#Polynomial orders tried by fit_order
+ORDERS = range(2,9)
+
+#===========================================
+def read_mask_table(filename=MASK_FILE):
+    #Regions to leave out of the fit, as a list of (low, high, name). MASK_REGIONS if filename does not exist.
+    if not os.path.isfile(filename):
+        return list(MASK_REGIONS)
+    table = np.genfromtxt(filename,dtype=None,names=['low','high','name'],usecols=(0,1,2),autostrip=True)
+    table = np.atleast_1d(table)
+    return [(float(row['low']), float(row['high']), str(row['name'])) for row in table]
+
+#===========================================
+def region_mask(warr, regions):
+    #True for the wavelengths in warr that are outside every region
+    warr = np.asarray(warr)
+    mask = np.ones(len(warr), dtype=bool)
+    for low, high, name in regions:
+        mask &= ~((warr >= low) & (warr <= high))
+    return mask
+
+#===========================================
+def excluded_edges(mask):
+    #First and last index of each run of excluded points, flattened as [start1, end1, start2, end2, ...].
+    #This is the format flux_calibration.py saves for the regions clicked by hand.
+    padded = np.concatenate(([0], (~np.asarray(mask)).astype(int), [0]))
+    changes = np.diff(padded)
+    starts = np.where(changes == 1)[0]
+    ends = np.where(changes == -1)[0] - 1
+    return np.ravel(np.transpose([starts, ends])).tolist()
+
+#===========================================
+def clipped_polyfit(x, y, order, sigma=3., maxiter=5):
+    #Polynomial fit, repeated with points more than sigma times the RMS from the fit left out.
+    #Returns the coefficients and a bool array of the points kept.
+    used = np.isfinite(x) & np.isfinite(y)
+    for i in range(maxiter+1):
+        coeffs = np.polyfit(x[used], y[used], order)
+        residual = y - np.polyval(coeffs, x)
+        rms = np.sqrt(np.mean(residual[used]**2.))
+        reject = used & (np.abs(residual) > sigma*rms)
+        if i == maxiter or not reject.any() or (used.sum() - reject.sum()) <= 2*(order+1):
+            break
+        used = used & ~reject
+    return coeffs, used
+
+#===========================================
+def fit_order(x, y, orders=ORDERS, sigma=3., maxiter=5):
+    #Fit each order in orders and keep the one with the lowest BIC, n*log(s**2) + (order+1)*log(n),
+    #where s is the median absolute deviation of the residuals of all n points, scaled to a standard deviation.
+    #Returns the order, the coefficients, the points kept by the clipping, and the BIC of every order.
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = np.sum(np.isfinite(x) & np.isfinite(y))
+    bic = np.zeros(len(orders)) + np.inf
+    fits = []
+    for i, order in enumerate(orders):
+        coeffs, used = clipped_polyfit(x, y, order, sigma=sigma, maxiter=maxiter)
+        residual = (y - np.polyval(coeffs, x))[np.isfinite(y)]
+        s = 1.4826*np.median(np.abs(residual - np.median(residual)))
+        if s > 0:
+            bic[i] = n*np.log(s**2.) + (order+1)*np.log(n)
+        fits.append((coeffs, used))
+    best = int(np.argmin(bic))
+    return orders[best], fits[best][0], fits[best][1], bic
+
+#===========================================
+def mask_files(stdfile, arm):
+    #Mask made by hand and mask saved by earlier runs for the flux file stdfile (m*.dat) on arm
+    return stdfile[0:-4] + '_' + arm + '_maskasdf.dat', stdfile[0:-4] + '_' + arm + '_mask.dat'
+
+#===========================================
+def choose_mask(stdfile, arm, auto=True, maskfile=MASK_FILE):
+    #Mask file to read for a standard, or None to make the mask from the table (auto) or by clicking. See the top of this file.
+    handmask, savedmask = mask_files(stdfile, arm)
+    if os.path.isfile(handmask):
+        return handmask
+    if not auto or not os.path.isfile(savedmask):
+        return None
+    if os.path.isfile(maskfile) and os.path.getmtime(maskfile) > os.path.getmtime(savedmask):
+        return None
+    return savedmask
+
+#===========================================
+def mask_signature(source, maskfile=MASK_FILE):
+    #Name and contents of the mask used, as a hash. source is the mask file read, or None for the table.
+    if source is None:
+        text = 'table:' + repr(read_mask_table(maskfile))
+    else:
+        with open(source, 'rb') as handle:
+            text = os.path.basename(source) + ':' + repr(handle.read())
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+#===========================================
+def fit_name(stdspecfile):
+    #File the fit to stdspecfile is saved in
+    return os.path.splitext(stdspecfile)[0] + '_sensfit.npz'
+
+#===========================================
+def save_fit(stdspecfile, airmass, lambdasfit, fluxesfit, order, coeffs, excluded, stdfile, extinct, masksig):
+    #stdfile, extinct, and masksig (mask_signature of the mask used) are checked by load_fit
+    np.savez(fit_name(stdspecfile), airmass=airmass, lambdasfit=lambdasfit, fluxesfit=fluxesfit,
+             order=order, coeffs=coeffs, excluded=np.array(excluded, dtype=int),
+             stdfile=stdfile, extinct=bool(extinct), masksig=masksig)
+
+#===========================================
+def load_fit(stdspecfile, stdfile, extinct, masksig):
+    #Saved fit to stdspecfile as a dictionary, or None if there is none, it is older than the spectrum,
+    #or it was made with another flux file, extinction correction, or mask.
+    name = fit_name(stdspecfile)
+    if not os.path.isfile(name):
+        return None
+    if os.path.getmtime(name) < os.path.getmtime(stdspecfile):
+        return None
+    saved = np.load(name)
+    fit = dict([(key, saved[key]) for key in saved.files])
+    saved.close()
+    if 'masksig' not in fit or str(fit['stdfile']) != stdfile or bool(fit['extinct']) != bool(extinct) or str(fit['masksig']) != masksig:
+        return None
+    fit['order'] = int(fit['order'])
+    fit['airmass'] = float(fit['airmass'])
+    fit['excluded'] = fit['excluded'].tolist()
+    return fit
+
+#===========================================
+# Joint model of all of a night's standards
+#===========================================
+
+#Standards must span at least this range of airmass to fit the airmass term
+MIN_AIRMASS_RANGE = 0.05
+
+#===========================================
+def spectrum_arm(filename):
+    if 'blue' in filename.lower():
+        return 'blue'
+    elif 'red' in filename.lower():
+        return 'red'
+    return 'unknown'
+
+#===========================================
+class SensitivityModel(object):
+    #Sensitivity S(lambda, X) = P(t) + X*Q(t), with t = (lambda - center)/scale and X the airmass.
+    #coeffs and aircoeffs are the coefficients of P and Q, highest power first as for np.polyval. aircoeffs is empty with no airmass term.
+    #airrange is the lowest and highest airmass of the standards fit.
+    def __init__(self, coeffs, aircoeffs, center, scale, airrange):
+        self.coeffs = np.asarray(coeffs, dtype=float)
+        self.aircoeffs = np.asarray(aircoeffs, dtype=float)
+        self.center = float(center)
+        self.scale = float(scale)
+        self.airrange = (float(airrange[0]), float(airrange[1]))
+
+    def __call__(self, warr, airmass):
+        #Sensitivity at wavelengths warr for airmass. If airmass is an array, returns one row per airmass.
+        #Airmasses outside airrange are moved to the nearest end of it, with a warning, instead of extrapolating the airmass term.
+        airmass = np.asarray(airmass, dtype=float)
+        clipped = np.clip(airmass, self.airrange[0], self.airrange[1])
+        if len(self.aircoeffs) > 0 and np.any(clipped != airmass):
+            print 'Warning: airmass %s is outside the range of the standards (%.3f to %.3f). Using %s.' % (airmass, self.airrange[0], self.airrange[1], clipped)
+        airmass = clipped
+        t = (np.asarray(warr, dtype=float) - self.center)/self.scale
+        sens = np.polyval(self.coeffs, t)
+        if len(self.aircoeffs) == 0:
+            airterm = np.zeros(t.shape)
+        else:
+            airterm = np.polyval(self.aircoeffs, t)
+        return sens + np.multiply.outer(airmass, airterm)
+
+#===========================================
+def fit_joint(lambdas, fluxes, airmasses, order, airorder=1, sigma=3., maxiter=5):
+    #Fit one SensitivityModel to the sensitivity functions of several standards (lists of lambdasfit and fluxesfit arrays, one per star).
+    #P has order order and Q has order airorder. Q is left out if the airmasses span less than MIN_AIRMASS_RANGE.
+    #Points more than sigma times the RMS from the fit are rejected and the fit repeated, up to maxiter times.
+    #Returns the model and a bool array of the points kept, in the order of np.concatenate(lambdas).
+    x = np.concatenate(lambdas).astype(float)
+    y = np.concatenate(fluxes).astype(float)
+    X = np.concatenate([np.zeros(len(l)) + a for l, a in zip(lambdas, airmasses)])
+    if np.ptp(airmasses) < MIN_AIRMASS_RANGE:
+        airorder = -1
+    center = 0.5*(np.max(x) + np.min(x))
+    scale = 0.5*(np.max(x) - np.min(x))
+    t = (x - center)/scale
+    design = np.transpose([t**i for i in range(order, -1, -1)] + [X*t**i for i in range(airorder, -1, -1)])
+    used = np.isfinite(x) & np.isfinite(y)
+    for i in range(maxiter+1):
+        solution = np.linalg.lstsq(design[used], y[used], rcond=-1)[0]
+        residual = y - np.dot(design, solution)
+        rms = np.sqrt(np.mean(residual[used]**2.))
+        reject = used & (np.abs(residual) > sigma*rms)
+        if i == maxiter or not reject.any():
+            break
+        used = used & ~reject
+    return SensitivityModel(solution[0:order+1], solution[order+1:], center, scale, (np.min(airmasses), np.max(airmasses))), used
+
+#===========================================
+def fit_models(standards, stdfits):
+    #One joint model per arm. stdfits has the fit to each file in standards, as returned by load_fit.
+    #The wavelength polynomial uses the highest order chosen for any of the arm's standards.
+    models = {}
+    for arm in set([spectrum_arm(x) for x in standards]):
+        fits = [fit for x, fit in zip(standards, stdfits) if spectrum_arm(x) == arm]
+        order = max([fit['order'] for fit in fits])
+        models[arm], used = fit_joint([fit['lambdasfit'] for fit in fits], [fit['fluxesfit'] for fit in fits],
+                                      [fit['airmass'] for fit in fits], order)
+    return models
+
+#===========================================
+def save_models(standards, stdfluxes, masksigs, stdfits, models, extinct, filename=MODEL_FILE):
+    #Save the night's models with the fit to each standard, so neither needs to be redone.
+    #stdfluxes and masksigs are the flux file and mask_signature of each standard. They are checked by load_models.
+    arrays = {'standards':np.array(standards), 'stdfluxes':np.array(stdfluxes), 'masksigs':np.array(masksigs),
+              'extinct':bool(extinct), 'arms':np.array(sorted(models))}
+    for i, fit in enumerate(stdfits):
+        for key in ['airmass', 'order', 'coeffs', 'lambdasfit', 'fluxesfit']:
+            arrays['%s_%d' % (key, i)] = fit[key]
+        arrays['excluded_%d' % i] = np.array([x for x in fit['excluded'] if x is not None], dtype=int)
+    for arm in models:
+        arrays[arm + '_coeffs'] = models[arm].coeffs
+        arrays[arm + '_aircoeffs'] = models[arm].aircoeffs
+        arrays[arm + '_range'] = [models[arm].center, models[arm].scale]
+        arrays[arm + '_airrange'] = models[arm].airrange
+    np.savez(filename, **arrays)
+
+#===========================================
+def load_models(standards, stdfluxes, masksigs, extinct, filename=MODEL_FILE):
+    #Saved fits and models for this list of standards, as (stdfits, models), or None if there are none,
+    #they were made from other standards, flux files, masks, or extinction correction, or any standard spectrum is newer.
+    if not os.path.isfile(filename):
+        return None
+    mtime = os.path.getmtime(filename)
+    if any([os.path.getmtime(x) > mtime for x in standards]):
+        return None
+    saved = np.load(filename)
+    try:
+        if 'masksigs' not in saved.files or any([arm + '_airrange' not in saved.files for arm in saved['arms']]):
+            return None
+        if list(saved['standards']) != list(standards) or bool(saved['extinct']) != bool(extinct):
+            return None
+        if list(saved['stdfluxes']) != list(stdfluxes) or list(saved['masksigs']) != list(masksigs):
+            return None
+        stdfits = []
+        for i in range(len(standards)):
+            stdfits.append({'airmass':float(saved['airmass_%d' % i]), 'order':int(saved['order_%d' % i]),
+                            'coeffs':saved['coeffs_%d' % i], 'lambdasfit':saved['lambdasfit_%d' % i],
+                            'fluxesfit':saved['fluxesfit_%d' % i], 'excluded':saved['excluded_%d' % i].tolist()})
+        models = {}
+        for arm in saved['arms']:
+            center, scale = saved[arm + '_range']
+            models[str(arm)] = SensitivityModel(saved[arm + '_coeffs'], saved[arm + '_aircoeffs'], center, scale, saved[arm + '_airrange'])
+    finally:
+        saved.close()
+    return stdfits, models
@@ -0,0 +1,149 @@
+'''
+Written for the ZZ Ceti pipeline.
+
+Database of solutions (traces, FWHM models, wavelength solutions) that persists across nights. Each solution is saved as one or more .npy files and recorded in a JSON index. The index is grouped by a key built from the target and setup, so finding the nearest solution reads one small file instead of searching directories.
+
+The database lives in the directory given by the ZZCETI_SOLUTIONS environment variable, or ~/.zzceti_solutions if that is not set. Each kind of solution ('trace', 'fwhm', ...) has its own index file, KIND_index.json.
+
+Keys are dictionaries, for example {'target':'WD1422+095','arm':'blue','binning':2}. Dates are 'YYYY-MM-DD' strings (DATE-OBS).
+
+:EXAMPLE:
+    store = SolutionStore('trace')
+    store.add({'target':'WD1422+095','arm':'blue','binning':2},'2016-05-26',{'trace':trace})
+    entry = store.nearest({'target':'WD1422+095','arm':'blue','binning':2},'2016-06-01')
+    trace = store.load(entry,'trace')
+
+    #Zero point of every wavelength solution for a setup, in date order
+    dates, zpoints = SolutionStore('wavelength').history(grating_keys(lampfile,header),'zpoint')
+
+'''
+
+import os
+import json
+import hashlib
+import datetime
+import numpy as np
+
+STORE_ENV = 'ZZCETI_SOLUTIONS'
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'),'.zzceti_solutions')
+
+#===========================================
+def store_directory():
+    return os.environ.get(STORE_ENV,DEFAULT_DIRECTORY)
+
+#===========================================
+def key_string(keys):
+    #Index key for a dictionary of keys, e.g. 'arm=blue|binning=2|target=WD1422+095'
+    return '|'.join(['%s=%s' % (k,keys[k]) for k in sorted(keys)])
+
+#===========================================
+def date_number(date):
+    #Days since year 1 for a DATE-OBS string. Only the date part is used.
+    return datetime.datetime.strptime(str(date)[0:10],'%Y-%m-%d').toordinal()
+
+#===========================================
+def setup_keys(specfile,header,target=True):
+    #Keys for a spectrum: target (OBJECT), arm (blue/red from the filename), and binning.
+    #With target=False, only the setup is returned so solutions from other targets can be found.
+    if 'blue' in specfile.lower():
+        arm = 'blue'
+    elif 'red' in specfile.lower():
+        arm = 'red'
+    else:
+        arm = 'unknown'
+    try:
+        bining = int(float(header['PARAM18']))
+    except:
+        bining = int(float(header['PG3_2']))
+    keys = {'arm':arm,'binning':bining}
+    if target:
+        keys['target'] = str(header['OBJECT']).strip().replace(' ','')
+    return keys
+
+#===========================================
+def grating_keys(specfile,header):
+    #Keys for a wavelength solution: arm, grating angle (GRT_TARG), camera angle (CAM_TARG), and binning.
+    keys = setup_keys(specfile,header,target=False)
+    keys['grating'] = '%.2f' % float(header['GRT_TARG'])
+    keys['camera'] = '%.2f' % float(header['CAM_TARG'])
+    return keys
+
+#===========================================
+class SolutionStore(object):
+    def __init__(self,kind,directory=None):
+        if directory is None:
+            directory = store_directory()
+        self.kind = kind
+        self.directory = directory
+        self.indexfile = os.path.join(directory,kind + '_index.json')
+        self._index = None
+
+    def index(self):
+        #Read the index the first time it is needed.
+        if self._index is None:
+            if os.path.isfile(self.indexfile):
+                with open(self.indexfile,'r') as handle:
+                    self._index = json.load(handle)
+            else:
+                self._index = {}
+        return self._index
+
+    def save_index(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        tmpfile = self.indexfile + '.tmp'
+        with open(tmpfile,'w') as handle:
+            json.dump(self.index(),handle,indent=1,sort_keys=True)
+        os.rename(tmpfile,self.indexfile)
+
+    def add(self,keys,date,arrays,info=None,source=None):
+        #Save arrays (a dictionary of name: numpy array) under keys and date. Replaces any solution with the same keys, date, and source.
+        #info is a dictionary of extra values (polynomial order, rms, ...) saved in the index.
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        keystring = key_string(keys)
+        date = str(date)[0:10]
+        label = hashlib.sha1((keystring + date + str(source)).encode('utf-8')).hexdigest()[0:16]
+        files = {}
+        for name in arrays:
+            filename = os.path.join(self.directory,'%s_%s_%s.npy' % (self.kind,label,name))
+            np.save(filename,np.asarray(arrays[name]))
+            files[name] = filename
+        entry = {'keys':keys,'date':date,'source':source,'files':files,'info':info or {},
+                 'added':datetime.datetime.now().strftime("%Y-%m-%dT%H:%M")}
+        entries = [x for x in self.index().get(keystring,[]) if not (x['date'] == date and x['source'] == source)]
+        entries.append(entry)
+        self.index()[keystring] = entries
+        self.save_index()
+        return entry
+
+    def find(self,keys,partial=False):
+        #All solutions saved under exactly these keys.
+        #With partial=True, all solutions whose keys include these keys (e.g. the same setup for any target).
+        if partial:
+            entries = [x for group in self.index().values() for x in group if all([x['keys'].get(k) == keys[k] for k in keys])]
+        else:
+            entries = self.index().get(key_string(keys),[])
+        return [x for x in entries if all([os.path.isfile(f) for f in x['files'].values()])]
+
+    def nearest(self,keys,date,maxdays=None,partial=False):
+        #Solution saved under keys with the date closest to date, or None. Ties go to the earlier night.
+        #If maxdays is set, solutions more than maxdays away are ignored (maxdays=0 means same night only).
+        entries = self.find(keys,partial=partial)
+        if len(entries) == 0:
+            return None
+        target = date_number(date)
+        distances = [(abs(date_number(x['date'])-target),date_number(x['date'])) for x in entries]
+        best = min(range(len(entries)),key=lambda i: distances[i])
+        if maxdays is not None and distances[best][0] > maxdays:
+            return None
+        return entries[best]
+
+    def load(self,entry,name):
+        return np.load(entry['files'][name])
+
+    def history(self,keys,name,partial=False):
+        #Dates and the info value name of every solution saved under keys, sorted by date. Used to follow drifts across nights.
+        entries = [x for x in self.find(keys,partial=partial) if name in x['info']]
+        entries.sort(key=lambda x: (x['date'],x['added']))
+        return [x['date'] for x in entries], np.array([x['info'][name] for x in entries],dtype=float)
@@ -12,19 +12,85 @@ import astropy.io.fits as fits
 import ReduceSpec_tools as rt
 import numpy as np
 import scipy
+import scipy.sparse
 from scipy.interpolate import InterpolatedUnivariateSpline as interpo
 from scipy.interpolate import UnivariateSpline
 import os
+import hashlib
+from collections import OrderedDict
+import grating_equation as ge
+import extinction
+import fitsaccess
+
+#Number of resampling matrices kept by resample_operator
+RESAMPLE_CACHE_SIZE = 16
+_resample_cache = OrderedDict()
 
 class spectrum(object):
+    #The four bands of an extracted spectrum (optimal extraction, raw extraction, sky, sigma) are rows of one (4, N) array, bands.
+    #opfarr, farr, sky, and sigma are views of those rows. The band-wide methods change all four with one array operation.
+    #readspectrum gives each spectrum its own copy of the FITS data, so writing to a band never changes the data other reads of the file share.
+    #The band-wide methods replace bands with a new array instead of writing to it.
+    __slots__ = ['_bands','warr']
+    bandnames = ['opfarr','farr','sky','sigma']
 
     def __init__(self,opfarr,farr,sky,sigma,warr):
-        self.opfarr = opfarr
-        self.farr = farr
-        self.sky = sky
-        self.sigma = sigma
+        self._bands = np.array([opfarr,farr,sky,sigma])
         self.warr = warr
 
+    @classmethod
+    def from_bands(cls,bands,warr):
+        #Spectrum using the (4, N) array bands without copying it
+        new = cls.__new__(cls)
+        new._bands = bands
+        new.warr = warr
+        return new
+
+    @property
+    def bands(self):
+        return self._bands
+
+    @bands.setter
+    def bands(self,value):
+        self._bands = np.asarray(value)
+
+    def _getband(self,n):
+        return self._bands[n]
+
+    def _setband(self,n,value):
+        #Copy first if bands is read-only or is not double precision
+        if not self._bands.flags.writeable or self._bands.dtype != np.float64:
+            self._bands = np.array(self._bands,dtype=np.float64)
+        self._bands[n] = value
+
+    opfarr = property(lambda self: self._getband(0), lambda self, value: self._setband(0,value))
+    farr = property(lambda self: self._getband(1), lambda self, value: self._setband(1,value))
+    sky = property(lambda self: self._getband(2), lambda self, value: self._setband(2,value))
+    sigma = property(lambda self: self._getband(3), lambda self, value: self._setband(3,value))
+
+    def copy(self):
+        return spectrum.from_bands(np.array(self._bands),np.array(self.warr))
+
+    def scale(self,factor):
+        #Multiply every band by factor (a number or one value per pixel). Returns the spectrum.
+        self._bands = self._bands*factor
+        return self
+
+    def divide(self,response):
+        #Divide every band by response (a number or one value per pixel), e.g. a response function. Returns the spectrum.
+        self._bands = self._bands/response
+        return self
+
+    def calibrate(self,sens,exptime,disp):
+        #Flux calibrate every band with a sensitivity function (see cal_spec). Returns the spectrum.
+        self._bands = cal_spec(self._bands,sens,exptime,disp)
+        return self
+
+    def correct_extinction(self,airmass,site=extinction.DEFAULT_SITE):
+        #Extinction correct every band (see extinction.py). Returns the spectrum.
+        self._bands = extinction.correct(self.warr,self._bands,airmass,site=site)
+        return self
+
 # ===========================================================================
 
 class standard(object):
@@ -43,52 +109,33 @@ def readspectrum(specfile):
     opfar(optimally extracted spectrum),farr(raw extracted spectrum),sky(background),sigma(sigma spectrum)
     """
 
-    spec = fits.open(specfile)
-    opfarr = spec[0].data[0,0,:]
-    farr = spec[0].data[1,0,:]
-    sky = spec[0].data[2,0,:]
-    sigma = spec[0].data[3,0,:]
-
-    #Read in header info
-    airmass = spec[0].header['airmass']
-    exptime = spec[0].header['exptime']
-    '''
-    #Set up wavelengths using linear dispersion
-    specwav0 = spec[0].header['crval1'] #Grab the leftmost wavelength coordinate
-    specdeltawav = spec[0].header['cd1_1'] #Grab the delta coordinate
-    warr = np.zeros(len(farr)) #Fill an array with appropriate wavelength values
-    warr[0] = specwav0
-    ival = np.arange(1,len(farr))
-    for i in ival:
-        warr[i] = warr[i-1] + specdeltawav
-    '''
-    #Set up wavelengths using grating equation
-    
-    alpha = float(spec[0].header['GRT_TARG'])
-    theta = float(spec[0].header['CAM_TARG'])
-    fr = float(spec[0].header['LINDEN'])
-    fd = float(spec[0].header['CAMFUD'])
-    fl = float(spec[0].header['FOCLEN'])
-    zPnt = float(spec[0].header['ZPOINT'])
-    
-    trim_sec= spec[0].header["CCDSEC"]
-    trim_offset= float( trim_sec[1:len(trim_sec)-1].split(':')[0] )-1
+    spec = fitsaccess.open_fits(specfile)
     try:
-        bining= float( spec[0].header["PARAM18"] ) 
-    except:
-        bining= float( spec[0].header["PG3_2"] )
-    nx= np.size(opfarr)#spec_data[0]
-    Pixels= bining*(np.arange(0,nx,1)+trim_offset)
-
-    WDwave = DispCalc(Pixels, alpha, theta, fr, fd, fl, zPnt)
-    warr = np.asarray(WDwave)
-    specdeltawav = np.zeros(len(warr))
-    specdeltawav[0] = warr[1] - warr[0]
-    for i in range(1,len(warr)):
-        specdeltawav[i] = warr[i] - warr[i-1]
-    
-
-    result = spectrum(opfarr,farr,sky,sigma,warr)
+        #The data are a copy-on-write memory map that later reads of this file in the same stage share, so the bands are copied
+        bands = np.array(spec[0].data[:,0,:],dtype=np.float64)
+        opfarr = bands[0]
+
+        #Read in header info
+        airmass = spec[0].header['airmass']
+        exptime = spec[0].header['exptime']
+        '''
+        #Set up wavelengths using linear dispersion
+        specwav0 = spec[0].header['crval1'] #Grab the leftmost wavelength coordinate
+        specdeltawav = spec[0].header['cd1_1'] #Grab the delta coordinate
+        warr = np.zeros(len(farr)) #Fill an array with appropriate wavelength values
+        warr[0] = specwav0
+        ival = np.arange(1,len(farr))
+        for i in ival:
+            warr[i] = warr[i-1] + specdeltawav
+        '''
+        #Set up wavelengths using grating equation. These are saved in the WAVE extension when the solution is applied.
+        nx= np.size(opfarr)#spec_data[0]
+        warr, specdeltawav = ge.read_wavelengths(spec, nx)
+        warr, specdeltawav = np.array(warr,dtype=np.float64), np.array(specdeltawav,dtype=np.float64)
+    finally:
+        fitsaccess.release(spec) #Closes the file unless a stage is using it
+
+    result = spectrum.from_bands(bands,warr)
     return result,airmass,exptime,specdeltawav
 
 # ===========================================================================
@@ -97,34 +144,16 @@ def readspectrum(specfile):
 
 def DispCalc(Pixels, alpha, theta, fr, fd, fl, zPnt):
     # This is the Grating Equation used to calculate the wavelenght of a pixel
-    # based on the fitted parameters and angle set up.
-    # Inputs: 
-    # Pixels= Vector of Pixel Numbers
-    # alpha=  of Grating Angle
-    # aheta=  Camera Angle
-    # fr= fringe density of grating
-    # fd= Camera Angle Correction Factor
-    # zPnt= Zero point pixel 
-    Wavelengths= [] # Vector to store calculated wavelengths 
-    for pix in Pixels:    
-        beta = np.arctan( (pix-zPnt)*15./fl ) + (fd*theta*np.pi/180.) - (alpha*np.pi/180.) 
-        wave = (10**6.)*( np.sin(beta) + np.sin(alpha*np.pi/180.) )/fr
-        Wavelengths.append(wave)
-    return Wavelengths
+    # based on the fitted parameters and angle set up. See grating_equation.py
+    return ge.wavelengths(Pixels, alpha, theta, fr, fd, fl, zPnt)
 
 
 
 # ===========================================================================
 
 def readheader(specfile):
-    spec = fits.open(specfile)
-    #Delete the parts of the header that are not uniform in Goodman. These are primarily the parts that contain degree symbols.
-    header = spec[0].header
-    del header['param0']
-    del header['param61']
-    del header['param62']
-    del header['param63']
-    return header
+    #The parts of the header that are not uniform in Goodman are deleted when the file is opened. See fitsaccess.py
+    return fitsaccess.read_header(specfile)
 
 # ===========================================================================
 
@@ -137,16 +166,14 @@ def readstandard(stdfile):
 # ===========================================================================
 def applywavelengths(wavefile,applyfile,newname):
     #Read in file with wavelength solution and get header info
-    wave = fits.open(wavefile)
-    n_fr = float(wave[0].header['LINDEN'])
-    n_fd = float(wave[0].header['CAMFUD'])
-    fl = float(wave[0].header['FOCLEN'])
-    zPnt = float(wave[0].header['ZPOINT'])
+    wave_header = fitsaccess.read_header(wavefile)
+    n_fr = float(wave_header['LINDEN'])
+    n_fd = float(wave_header['CAMFUD'])
+    fl = float(wave_header['FOCLEN'])
+    zPnt = float(wave_header['ZPOINT'])
 
     #Read in file to apply wavelength solution and update header
-    spec_data= fits.getdata(applyfile)
-    spec_header= fits.getheader(applyfile)
-    rt.Fix_Header(spec_header)
+    spec_header, spec_data= fitsaccess.read(applyfile)
     spec_header.append( ('LINDEN', n_fr,'Line Desity for Grating Eq.'), 
                        useblanks= True, bottom= True )
     spec_header.append( ('CAMFUD', n_fd,'Camera Angle Correction Factor for Grat. Eq.'), 
@@ -194,31 +221,40 @@ def fnutofwave(warr,farr):
 # ===========================================================================
 
 
+def bandpass_sums(spec_warr,spec_farr,low,high,return_counts=False):
+    #Sum of spec_farr over the points with low <= spec_warr <= high, for every bandpass at once.
+    #spec_warr must be increasing. low and high are arrays of bandpass edges.
+    #spec_farr can be 2D with one spectrum per row (all on spec_warr), giving one row of sums per spectrum.
+    #If return_counts is True, the number of points in each bandpass is also returned.
+    spec_warr = np.asarray(spec_warr,dtype=float)
+    spec_farr = np.asarray(spec_farr,dtype=float)
+    cumulative = np.concatenate((np.zeros(spec_farr.shape[:-1] + (1,)),np.cumsum(spec_farr,axis=-1)),axis=-1)
+    first = np.searchsorted(spec_warr,low,side='left') #first point >= low
+    last = np.searchsorted(spec_warr,high,side='right') #first point > high
+    sums = cumulative[...,last] - cumulative[...,first]
+    if return_counts:
+        return sums, last - first
+    return sums
+
+# ===========================================================================
+
+def synthetic_photometry(spec_warr,spec_farr,centers,widths):
+    #Mean flux density of a spectrum in bandpasses of the given centers and full widths (Angstroms).
+    #Bandpasses with no points give nan. Same bandpass rules as bandpass_sums.
+    centers = np.asarray(centers,dtype=float)
+    widths = np.asarray(widths,dtype=float)
+    sums, counts = bandpass_sums(spec_warr,spec_farr,centers-widths/2.,centers+widths/2.,return_counts=True)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        return np.where(counts > 0,sums/np.maximum(counts,1),np.nan)
+
+# ===========================================================================
+
 def sum_std(std_warr,wbin,spec_warr,spec_farr):
     #Sum the standard star spectrum into the same bins as the flux
-    #calibration file.
-    n = 0
-    for lambdas in std_warr:
-        low = lambdas - wbin[n]/2.
-        high = lambdas + wbin[n]/2.
-        #print low,high
-        c = np.where(spec_warr >= low)
-        d = np.where(spec_warr <= high)
-        lowflux = np.asarray(c)
-        highflux = np.asarray(d)
-        index = np.intersect1d(lowflux,highflux)
-        fluxnew = spec_farr[index]
-        wavenew = spec_warr[index]
-        #print wavenew[0],wavenew[-1]
-        total = np.sum(fluxnew)
-        if n == 0:
-            result = [total]
-        if n > 0:
-            result.append(total)
-        #blah = np.asarray(result)
-        #print blah[n]
-        n += 1.
-    return np.asarray(result)
+    #calibration file. Points on the edge of a bin are counted in it.
+    std_warr = np.asarray(std_warr,dtype=float)
+    wbin = np.asarray(wbin,dtype=float)
+    return bandpass_sums(spec_warr,spec_farr,std_warr-wbin/2.,std_warr+wbin/2.)
 
 # ===========================================================================
 
@@ -250,42 +286,13 @@ def cal_spec(counts,sens,exptime,disp):
 
 def extinction_correction(lams, flux, airmass):
     '''
-    Extinction correction based on Strizinger et. al. 2005 values for CTIO
+    Extinction correction based on Strizinger et. al. 2005 values for CTIO.
+    The curve and its spline are kept in extinction.py, so they are only
+    computed once for each wavelength grid.
     '''
     # Function inputs are wavelengths and flux values for the spectrum as well 
     # as the airmass the spectrum was measured at
-    
-    # wavelength-dependent extinction coefficients from CTIO
-    # Strizinger et. al. 2005
-    ctio_lams = [3050.0, 3084.6500000000001, 3119.3099999999999, 3153.96, 3188.6100000000001, 3223.27, 3257.9200000000001, 3292.5700000000002, 3327.23, 3361.8800000000001, 3396.54, 3431.1900000000001, 3465.8400000000001, 3500.5, 3535.1500000000001, 3569.8000000000002, 3604.46, 3639.1100000000001, 3673.7600000000002, 3708.4200000000001, 3743.0700000000002, 3777.7199999999998, 3812.3800000000001, 3847.0300000000002, 3881.6900000000001, 3916.3400000000001, 3950.9899999999998, 3985.6500000000001, 4020.3000000000002, 4054.9499999999998, 4089.6100000000001, 4124.2600000000002, 4158.9099999999999, 4193.5699999999997, 4228.2200000000003, 4262.8699999999999, 4297.5299999999997, 4332.1800000000003, 4366.8299999999999, 4401.4899999999998, 4436.1400000000003, 4470.79, 4505.4499999999998, 4540.1000000000004, 4574.7600000000002, 4609.4099999999999, 4644.0600000000004, 4678.7200000000003, 4713.3699999999999, 4748.0200000000004, 4782.6800000000003, 4817.3299999999999, 4851.9799999999996, 4886.6400000000003, 4921.29, 4955.9399999999996, 4990.6000000000004, 5025.25, 5059.9099999999999, 5094.5600000000004, 5129.21, 5163.8699999999999, 5198.5200000000004, 5233.1700000000001, 5267.8299999999999, 5302.4799999999996, 5337.1300000000001, 5371.79, 5406.4399999999996, 5441.0900000000001, 5475.75, 5510.3999999999996, 5545.0500000000002, 5579.71, 5614.3599999999997, 5649.0200000000004, 5683.6700000000001, 5718.3199999999997, 5752.9799999999996, 5787.6300000000001, 5822.2799999999997, 5856.9399999999996, 5891.5900000000001, 5926.2399999999998, 5960.8999999999996, 5995.5500000000002, 6030.1999999999998, 6064.8599999999997, 6099.5100000000002, 6134.1700000000001, 6168.8199999999997, 6203.4700000000003, 6238.1300000000001, 6272.7799999999997, 6307.4300000000003, 6342.0900000000001, 6376.7399999999998, 6411.3900000000003, 6446.0500000000002, 6480.6999999999998, 6482.8500000000004, 6535.3800000000001, 6587.9099999999999, 6640.4399999999996, 6692.96, 6745.4899999999998, 6798.0200000000004, 6850.5500000000002, 6903.0699999999997, 6955.6000000000004, 7008.1300000000001, 7060.6499999999996, 7113.1800000000003, 7165.71, 7218.2399999999998, 7270.7600000000002, 7323.29, 7375.8199999999997, 7428.3500000000004, 7480.8699999999999, 7533.3999999999996, 7585.9300000000003, 7638.4499999999998, 7690.9799999999996, 7743.5100000000002, 7796.04, 7848.5600000000004, 7901.0900000000001, 7953.6199999999999, 8006.1499999999996, 8058.6700000000001, 8111.1999999999998, 8163.7299999999996, 8216.25, 8268.7800000000007, 8321.3099999999995, 8373.8400000000001, 8426.3600000000006, 8478.8899999999994, 8531.4200000000001, 8583.9500000000007, 8636.4699999999993, 8689.0, 8741.5300000000007, 8794.0499999999993, 8846.5799999999999, 8899.1100000000006, 8951.6399999999994, 9004.1599999999999, 9056.6900000000005, 9109.2199999999993, 9161.75, 9214.2700000000004, 9266.7999999999993, 9319.3299999999999, 9371.8500000000004, 9424.3799999999992, 9476.9099999999999, 9529.4400000000005, 9581.9599999999991, 9634.4899999999998, 9687.0200000000004, 9739.5499999999993, 9792.0699999999997, 9844.6000000000004, 9897.1299999999992, 9949.6499999999996, 10002.200000000001, 10054.700000000001, 10107.200000000001, 10159.799999999999, 10212.299999999999, 10264.799999999999, 10317.299999999999, 10369.9, 10422.4, 10474.9, 10527.5, 10580.0, 10632.5, 10685.0, 10737.6, 10790.1, 10842.6, 10895.1, 10947.700000000001, 11000.200000000001]
-    ctio_ext = [1.395, 1.2830000000000001, 1.181, 1.0880000000000001, 1.004, 0.92900000000000005, 0.86099999999999999, 0.80099999999999993, 0.748, 0.69999999999999996, 0.65900000000000003, 0.623, 0.59099999999999997, 0.56399999999999995, 0.54000000000000004, 0.52000000000000002, 0.502, 0.48700000000000004, 0.47299999999999998, 0.46000000000000002, 0.44799999999999995, 0.436, 0.42499999999999999, 0.41399999999999998, 0.40200000000000002, 0.39100000000000001, 0.38100000000000001, 0.37, 0.35999999999999999, 0.34899999999999998, 0.33899999999999997, 0.33000000000000002, 0.32100000000000001, 0.313, 0.30399999999999999, 0.29600000000000004, 0.28899999999999998, 0.28100000000000003, 0.27399999999999997, 0.26700000000000002, 0.26000000000000001, 0.254, 0.247, 0.24100000000000002, 0.23600000000000002, 0.23000000000000001, 0.22500000000000001, 0.22, 0.215, 0.20999999999999999, 0.20600000000000002, 0.20199999999999999, 0.19800000000000001, 0.19399999999999998, 0.19, 0.187, 0.184, 0.18100000000000002, 0.17800000000000002, 0.17600000000000002, 0.17300000000000001, 0.17100000000000001, 0.16899999999999998, 0.16699999999999998, 0.16600000000000001, 0.16399999999999998, 0.16300000000000001, 0.16200000000000001, 0.16, 0.159, 0.158, 0.158, 0.157, 0.156, 0.155, 0.155, 0.154, 0.153, 0.153, 0.152, 0.151, 0.151, 0.14999999999999999, 0.14899999999999999, 0.14899999999999999, 0.14800000000000002, 0.14699999999999999, 0.14599999999999999, 0.14400000000000002, 0.14300000000000002, 0.14199999999999999, 0.14000000000000001, 0.13800000000000001, 0.13600000000000001, 0.13400000000000001, 0.13200000000000001, 0.129, 0.126, 0.12300000000000001, 0.12, 0.12, 0.115, 0.111, 0.107, 0.10300000000000001, 0.099000000000000005, 0.096000000000000002, 0.091999999999999998, 0.088000000000000009, 0.085000000000000006, 0.08199999999999999, 0.078, 0.074999999999999997, 0.072000000000000008, 0.069000000000000006, 0.066000000000000003, 0.064000000000000001, 0.060999999999999999, 0.057999999999999996, 0.055999999999999994, 0.052999999999999999, 0.050999999999999997, 0.049000000000000002, 0.047, 0.044999999999999998, 0.042999999999999997, 0.040999999999999995, 0.039, 0.037000000000000005, 0.035000000000000003, 0.034000000000000002, 0.032000000000000001, 0.029999999999999999, 0.028999999999999998, 0.027999999999999997, 0.026000000000000002, 0.025000000000000001, 0.024, 0.023, 0.022000000000000002, 0.02, 0.019, 0.019, 0.018000000000000002, 0.017000000000000001, 0.016, 0.014999999999999999, 0.014999999999999999, 0.013999999999999999, 0.013000000000000001, 0.013000000000000001, 0.012, 0.011000000000000001, 0.011000000000000001, 0.011000000000000001, 0.01, 0.01, 0.0090000000000000011, 0.0090000000000000011, 0.0090000000000000011, 0.0080000000000000002, 0.0080000000000000002, 0.0080000000000000002, 0.0069999999999999993, 0.0069999999999999993, 0.0069999999999999993, 0.0069999999999999993, 0.0069999999999999993, 0.0060000000000000001, 0.0060000000000000001, 0.0060000000000000001, 0.0060000000000000001, 0.0060000000000000001, 0.0060000000000000001, 0.0050000000000000001, 0.0050000000000000001, 0.0050000000000000001, 0.0050000000000000001, 0.0050000000000000001, 0.0050000000000000001, 0.0040000000000000001, 0.0040000000000000001, 0.0040000000000000001, 0.0040000000000000001, 0.0030000000000000001, 0.0030000000000000001, 0.0030000000000000001]
-
-    smooth_param = 0.001
-    spline_fit = UnivariateSpline(ctio_lams, ctio_ext, s=smooth_param, k=3)
-
-    a_lambda = spline_fit(lams)
-
-    corrected_flux = flux*(10.0**(.4*a_lambda*(airmass)))    
-    
-    xx = np.linspace(np.min(ctio_lams), np.max(ctio_lams), 1000)
-    yy = spline_fit(xx)
-    '''
-    plt.figure()
-    plt.scatter(ctio_lams, ctio_ext, label=smooth_param)
-    plt.axvline(np.min(lams), color='g')
-    plt.axvline(np.max(lams), color='g')
-    plt.plot(xx, yy)
-    plt.xlabel('Wavelength')
-    plt.ylabel('Extinction Coefficient')
-    plt.title('Gemini Extinction Coefficient Fit')
-    '''
-    '''
-    plt.figure()
-    plt.plot(lams,flux)
-    plt.plot(lams,corrected_flux)
-    plt.show()
-    '''
-    return corrected_flux
+    return extinction.correct(lams, flux, airmass, site='ctio')
 
 
 
@@ -339,6 +346,56 @@ def resamplespec(w1, w0, spec0, oversamp=100):
     return spec1
 
 # ===========================================================================
+def rebinspec(w1, w0, spec0):
+    """
+    Resample a spectrum while conserving flux density. Gives the same result
+    as resamplespec in the limit of infinite oversampling, without building
+    the oversampled spectrum.
+
+    Like resamplespec, the spectrum is taken to be linear between the old
+    pixel centers, and each new pixel gets the integral of the spectrum, in
+    units of old pixels, between the midpoints of the new wavelength grid.
+    The integral is computed exactly from the cumulative integral at the old
+    pixel centers, so the cost is O(N + M) for N old and M new pixels.
+
+    :INPUTS:
+      w1 : sequence
+        new wavelength grid (i.e., center wavelength of each pixel)
+
+      w0 : sequence
+        old wavelength grid, increasing (i.e., center wavelength of each pixel)
+
+      spec0 : sequence
+        old spectrum (e.g., flux density or photon counts)
+
+    :NOTE:
+      Format is the same as :func:`numpy.interp`
+
+    """
+    w1 = np.asarray(w1, dtype=float)
+    w0 = np.asarray(w0, dtype=float)
+    spec0 = np.asarray(spec0, dtype=float)
+    nlam = len(w0)
+    x0 = np.arange(nlam, dtype=float)
+
+    # Cumulative integral of the spectrum at each old pixel center
+    cumulative = np.concatenate(([0.], np.cumsum(0.5*(spec0[1:] + spec0[:-1]))))
+
+    # Same bin edges as resamplespec, converted to old pixel coordinates.
+    # Edges outside the old grid are clipped to its ends, so they add nothing.
+    maxdiffw1 = np.diff(w1).max()
+    w1bins = np.concatenate(([w1[0] - maxdiffw1],
+                             .5*(w1[1::] + w1[0:-1]),
+                             [w1[-1] + maxdiffw1]))
+    xbins = np.interp(w1bins, w0, x0)
+
+    # Integral up to each edge: whole pixels from the cumulative sum, plus the part of the pixel it falls in
+    j = np.clip(np.floor(xbins).astype(int), 0, nlam-2)
+    t = xbins - j
+    integral = cumulative[j] + spec0[j]*t + 0.5*(spec0[j+1] - spec0[j])*t**2.
+    return np.diff(integral)
+
+# ===========================================================================
 
 
 
@@ -416,6 +473,10 @@ def errxy(x,y,xbins, xmode='mean', ymode='mean', xerr='minmax', yerr='sdom', cle
        Data 'x' are determined to be in a bin with sides (L, R) when
           satisfying the condition (x>L) and (x<=R)
 
+       When clean is None, all bins are computed at once from
+          contiguous segments of the x-sorted data (numpy reduceat),
+          with no Python loop over bins.
+
     :SEE ALSO:  matplotlib.pyplot.errorbar, :func:`analysis.removeoutliers`
 
     :REQUIREMENTS:  :doc:`numpy`, :doc:`analysis`
@@ -498,6 +559,56 @@ def errxy(x,y,xbins, xmode='mean', ymode='mean', xerr='minmax', yerr='sdom', cle
 
         return ret
 
+    def segreduce(ufunc, data):
+        """ufunc.reduceat over the bins. Empty bins give nan. Helper function."""
+        ret = np.zeros(nbins) + np.nan
+        full = counts > 0
+        if full.any():
+            # Consecutive starts of the non-empty bins delimit them, since the
+            # empty bins in between have no data. Data past the last bin are cut.
+            ret[full] = ufunc.reduceat(data[0:inds2[full][-1,1]], inds2[full][:,0])
+        return ret
+
+    def segmedian(data):
+        """Median of each bin from one sort of the data by bin, then value. Helper function."""
+        binid = np.repeat(np.arange(nbins), counts)
+        sdata = data[inds2[0,0]:inds2[-1,1]][np.lexsort((data[inds2[0,0]:inds2[-1,1]], binid))]
+        starts = np.cumsum(counts) - counts
+        ret = np.zeros(nbins) + np.nan
+        full = counts > 0
+        lo = starts[full] + (counts[full]-1)//2
+        hi = starts[full] + counts[full]//2
+        ret[full] = 0.5*(sdata[lo] + sdata[hi])
+        return ret
+
+    def segcenter(data, cmode):
+        """Data center of every bin based on mode. Helper function."""
+        if cmode is None:
+            ret = np.zeros(nbins)
+        elif cmode=='mean':
+            ret = segreduce(np.add, data)/counts
+        elif cmode=='median':
+            ret = segmedian(data)
+        elif cmode=='sum':
+            ret = np.where(counts > 0, segreduce(np.add, data), 0.)
+        return ret
+
+    def segerr(data, emode, cmode, center):
+        """Errorbar of every bin. Helper function."""
+        if emode is None:
+            ret = np.array([])
+        elif emode=='std' or emode=='sdom':
+            mean = segreduce(np.add, data)/counts
+            binid = np.repeat(np.arange(nbins), counts)
+            resid = np.zeros(len(data))
+            resid[inds2[0,0]:inds2[-1,1]] = (data[inds2[0,0]:inds2[-1,1]] - mean[binid])**2
+            ret = np.sqrt(segreduce(np.add, resid)/counts)
+            if emode=='sdom':
+                ret = ret/np.sqrt(counts)
+        elif emode=='minmax':
+            ret = np.transpose([center - segreduce(np.minimum, data), segreduce(np.maximum, data) - center])
+        return ret
+
     if timing:
         print "%1.3f sec since starting function; helpers defined" % (time.time() - tic)
 
@@ -559,8 +670,8 @@ def errxy(x,y,xbins, xmode='mean', ymode='mean', xerr='minmax', yerr='sdom', cle
 
     if timing: tic1 = time.time()
     #inds = np.digitize(x, xbins)
-    inds2 = [[x.searchsorted(xbins[ii], side='left'), \
-                  x.searchsorted(xbins[ii+1], side='left')] for ii in range(nbins)]
+    edges = x.searchsorted(xbins, side='left')
+    inds2 = np.transpose([edges[0:nbins], edges[1:nbins+1]])
     if timing: setuptime += (time.time() - tic1)
     #pdb.set_trace()
     #bin_means = [data[digitized == i].mean() for i in range(1, len(bins))]
@@ -573,24 +684,14 @@ def errxy(x,y,xbins, xmode='mean', ymode='mean', xerr='minmax', yerr='sdom', cle
     doey = yerr is not None 
 
     if clean is None:
+        # All bins at once: the data are sorted by x, so each bin is a
+        # contiguous segment and numpy reduceat gives the per-bin sums.
         if timing: tic3 = time.time()
-        if dox: exec ('xfunc = np.%s' % xmode) in locals()
-        if doy: exec ('yfunc = np.%s' % ymode) in locals()
-        for ii in range(nbins):
-            #index = inds==(ii+1)
-            if dox:
-                #xx[ii] = xfunc(x[index])
-                xx[ii] = xfunc(x[inds2[ii][0]:inds2[ii][1]])
-            if doy:
-                #yy[ii] = yfunc(y[index])
-                yy[ii] = yfunc(y[inds2[ii][0]:inds2[ii][1]])
-            if doex:
-                #exx.append(geterr(x[index], xerr, xmode))
-                exx.append(geterr(x[inds2[ii][0]:inds2[ii][1]], xerr, xmode))
-            if doey:
-                #eyy.append(geterr(y[index], yerr, ymode))
-                eyy.append(geterr(y[inds2[ii][0]:inds2[ii][1]], yerr, ymode))
-
+        counts = inds2[:,1] - inds2[:,0]
+        if dox: xx = segcenter(x, xmode)
+        if doy: yy = segcenter(y, ymode)
+        if doex: exx = segerr(x, xerr, xmode, xx)
+        if doey: eyy = segerr(y, yerr, ymode, yy)
         if timing: statstime += (time.time() - tic3)
         #pdb.set_trace()
     else:
@@ -784,46 +885,80 @@ def resample(old_dispersion, new_dispersion):
         :class:`numpy.array`
     """
 
-    data = []
-    old_px_indices = []
-    new_px_indices = []
-    for i, new_wl_i in enumerate(new_dispersion):
-
-        # These indices should span just over the new wavelength pixel.
-        indices = np.unique(np.clip(
-            old_dispersion.searchsorted(new_dispersion[i:i + 2], side="left") \
-                + [-1, +1], 0, old_dispersion.size - 1))
-        N = np.ptp(indices)
-
-        if N == 0:
-            # 'Fake' pixel.
-            data.append(np.nan)
-            new_px_indices.append(i)
-            old_px_indices.extend(indices)
-            continue
-
-        # Sanity checks.
-        assert (old_dispersion[indices[0]] <= new_wl_i \
-            or indices[0] == 0)
-        assert (new_wl_i <= old_dispersion[indices[1]] \
-            or indices[1] == old_dispersion.size - 1)
-
-        fractions = np.ones(N)
-
-        # Edges are handled as fractions between rebinned pixels.
-        _ = np.clip(i + 1, 0, new_dispersion.size - 1)
-        lhs = old_dispersion[indices[0]:indices[0] + 2]
-        rhs = old_dispersion[indices[-1] - 1:indices[-1] + 1]
-        fractions[0]  = (lhs[1] - new_dispersion[i])/np.ptp(lhs)
-        fractions[-1] = (new_dispersion[_] - rhs[0])/np.ptp(rhs)
-
-        # Being binned to a single pixel. Prevent overflow from fringe cases.
-        fractions = np.clip(fractions, 0, 1)
-        fractions /= fractions.sum()
-
-        data.extend(fractions) 
-        new_px_indices.extend([i] * N) # Mark the new pixel indices affected.
-        old_px_indices.extend(np.arange(*indices)) # And the old pixel indices.
+    old_dispersion = np.asarray(old_dispersion)
+    new_dispersion = np.asarray(new_dispersion)
+    nold = old_dispersion.size
+    nnew = new_dispersion.size
+    inew = np.arange(nnew)
+
+    # These indices should span just over each new wavelength pixel.
+    # The last new pixel only has its own wavelength to search with.
+    found = old_dispersion.searchsorted(new_dispersion, side="left")
+    first = np.clip(found - 1, 0, nold - 1)
+    last = np.clip(np.concatenate((found[1:], found[-1:])) + 1, 0, nold - 1)
+    N = last - first
+
+    # 'Fake' pixels.
+    fake = N == 0
+    real = ~fake
+
+    # Sanity checks.
+    assert np.all((old_dispersion[first[real]] <= new_dispersion[real]) | (first[real] == 0))
+    assert np.all((new_dispersion[real] <= old_dispersion[last[real]]) | (last[real] == nold - 1))
+
+    # One entry for each old pixel under each new pixel
+    counts = N[real]
+    starts = np.cumsum(counts) - counts
+    new_px_indices = np.repeat(inew[real], counts)
+    old_px_indices = np.repeat(first[real] - starts, counts) + np.arange(counts.sum())
+    fractions = np.ones(counts.sum())
+
+    # Edges are handled as fractions between rebinned pixels.
+    # For a new pixel over a single old pixel, the right edge fraction is used.
+    nextwave = new_dispersion[np.clip(inew + 1, 0, nnew - 1)][real]
+    lfirst, llast = first[real], last[real]
+    fractions[starts] = (old_dispersion[lfirst + 1] - new_dispersion[real])/(old_dispersion[lfirst + 1] - old_dispersion[lfirst])
+    fractions[starts + counts - 1] = (nextwave - old_dispersion[llast - 1])/(old_dispersion[llast] - old_dispersion[llast - 1])
+
+    # Being binned to a single pixel. Prevent overflow from fringe cases.
+    fractions = np.clip(fractions, 0, 1)
+    if len(fractions) > 0:
+        fractions /= np.repeat(np.add.reduceat(fractions, starts), counts)
+
+    data = np.concatenate((fractions, np.zeros(fake.sum()) + np.nan))
+    old_px_indices = np.concatenate((old_px_indices, first[fake]))
+    new_px_indices = np.concatenate((new_px_indices, inew[fake]))
 
     return scipy.sparse.csc_matrix((data, (old_px_indices, new_px_indices)),
         shape=(old_dispersion.size, new_dispersion.size))
+
+# ===========================================================================
+
+def grid_fingerprint(grid):
+    #Hash of the values of a wavelength grid, used to recognize the same grid again.
+    grid = np.ascontiguousarray(grid, dtype=float)
+    return '%i_%s' % (grid.size, hashlib.sha1(grid.tobytes()).hexdigest())
+
+# ===========================================================================
+
+def resample_operator(old_dispersion, new_dispersion):
+    #The matrix from resample, kept in a cache of the RESAMPLE_CACHE_SIZE most recently used pairs of grids.
+    #Every exposure of one setup uses the same grids, so the matrix is only built once. Do not modify the result.
+    key = (grid_fingerprint(old_dispersion), grid_fingerprint(new_dispersion))
+    if key in _resample_cache:
+        operator = _resample_cache.pop(key)
+    else:
+        operator = resample(old_dispersion, new_dispersion)
+    _resample_cache[key] = operator
+    while len(_resample_cache) > RESAMPLE_CACHE_SIZE:
+        _resample_cache.popitem(last=False)
+    return operator
+
+# ===========================================================================
+
+def resample_spectra(old_dispersion, new_dispersion, fluxes):
+    #Resample one spectrum, or several with one per row, from old_dispersion to new_dispersion while conserving total flux.
+    #All spectra are done with one sparse matrix product.
+    operator = resample_operator(old_dispersion, new_dispersion)
+    fluxes = np.asarray(fluxes, dtype=float)
+    return np.asarray(operator.T.dot(fluxes.T).T)
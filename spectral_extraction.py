@@ -16,14 +16,18 @@ python spec_extract.py tnb.0526.WD1422p095_930_blue.fits
         Name of file you want to extract.
 
 :OPTIONS:
-    lamp file : string, optional
-        You will be prompted for this. If you want to extract a lamp using the same trace as the spectral filename, provide this. 
+    lamp file : string or list of strings, optional
+        You will be prompted for this. If you want to extract a lamp using the same trace as the spectral filename, provide this. A list of lamps from the same setup is extracted against the one trace in a single pass.
 
 :OUTPUTS:
     Extracted 1D spectrum. .ms.fits is added to the end of the file. User will be prompted before overwriting existing image. Extensions in order are optimally extracted spectrum, raw extracted spectrum, background, sigma spectrum
 
     extraction_params.txt: text file containing date/time of extraction, extraction radius, background radius, and new filename
 
+    spectrum_quality.txt: S/N per resolution element, continuum RMS, sky level, and trace RMS for each extracted spectrum (see spectrum_quality.py). These are also saved to the header.
+
+    extraction_cache.json: index of extractions already done (see extraction_cache.py). If the 2D spectrum, trace, FWHM file, lamps, and extraction settings are unchanged, extract_now returns the saved .ms.fits files without extracting again. The cache is only used when both a trace and an FWHM file are given, since otherwise the fit asks for choices. Use usecache=False to force a new extraction.
+
     extraction_ZZCETINAME_DATE.txt: File for diagnostics. ZZCETINAME is name of the ZZ Ceti spectrum supplied. DATE is the current date and time. Columns are: Measured FWHM, pixel value of each FWHM, fit to FWHM measurements, all pixel values, profile pixels, profile position, fit profile positions
 
 extract_radius and  bkg_radii computed automatically. FWHM used for extract_radius
@@ -41,12 +45,14 @@ import astropy.io.fits as fits
 import matplotlib.pyplot as plt
 import datetime
 import mpfit
-from scipy.interpolate import InterpolatedUnivariateSpline
-from scipy.optimize import curve_fit
 
 import spectools as st
+import fitsaccess
+import extraction_cache
+import spectrum_quality
+import solution_store
 import superextract
-from superextract_tools import lampextract
+from superextract_tools import lampextract_multi, rescale_trace
 from ReduceSpec_tools import gauss, fitgauss
 from pylab import *
 
@@ -74,32 +80,115 @@ def SigClip(data_set, lo_sig, hi_sig):
     return cliped_data 
 
 #===========================================
-def line(x,m,b):
-    y = m*x + b
-    return y
+#Settings passed to superExtract. These are part of the extraction cache key, so changing any of them forces a new extraction.
+#pord = order of profile polynomial. Default = 2. This seems appropriate, no change for higher or lower order.
+#tord = degree of spectral-trace polynomial, 1 = line
+#bord = degree of polynomial background fit
+#bsigma = sigma-clipping thresholf for computing background
+#csigma = sigma-clipping threshold for cleaning & cosmic-ray rejection. Default = 5.
+#polyspacing = Marsh's S: the spacing between the polynomials. This should be <= 1. Default = 1. Best to leave at 1.
+#bkgmode = 'rows' fits the background row by row, rejecting one point per iteration. 'multi' fits every row at once, rejecting every point beyond bsigma on each pass.
+extract_params = {'pord':2,'tord':2,'bord':1,'bsigma':2.,'dispaxis':1,'csigma':5.,'polyspacing':1,'bkgmode':'rows'}
+gain = 1.33 #from 2017-06-07
+
 #===========================================
+def import_legacy_solutions(spec_files,directory='.'):
+    #Add the trace (*trace.npy) and FWHM (*poly.npy) files of spec_files left in directory by reductions done before the database existed.
+    #A directory is only imported once. It is then recorded in the 'legacy' index, and solutions are looked up only in the database.
+    legacystore = solution_store.SolutionStore('legacy')
+    dirkeys = {'directory':os.path.abspath(directory)}
+    if legacystore.find(dirkeys):
+        return
+    tracestore = solution_store.SolutionStore('trace')
+    fwhmstore = solution_store.SolutionStore('fwhm')
+    names = sorted(os.listdir(directory))
+    imported = []
+    for specfile in spec_files:
+        header = fitsaccess.read_header(specfile)
+        try:
+            obsdate = header['DATE-OBS']
+        except:
+            continue
+        storekeys = solution_store.setup_keys(specfile,header)
+        target = specfile[5:-5]
+        for suffix, store, arrayname in [('trace.npy',tracestore,'trace'),('poly.npy',fwhmstore,'fwhm')]:
+            matches = [x for x in names if x.endswith(suffix) and target in x]
+            if matches and store.nearest(storekeys,obsdate,maxdays=0) is None:
+                store.add(storekeys,obsdate,{arrayname:np.load(os.path.join(directory,matches[0]))},source=matches[0])
+                imported.append(matches[0])
+    legacystore.add(dirkeys,datetime.datetime.now().strftime("%Y-%m-%d"),{},info={'imported':imported})
+    if imported:
+        print 'Added %i trace and FWHM files from %s to the solution database.' % (len(imported),directory)
 
+#===========================================
+def find_prior_solutions(specfile):
+    #Look up the trace and FWHM files saved in the database for this target and setup on the same night.
+    #Returns tracefile, FWHMfile. Either is None if there is no saved solution.
+    header = fitsaccess.read_header(specfile)
+    storekeys = solution_store.setup_keys(specfile,header)
+    try:
+        obsdate = header['DATE-OBS']
+    except:
+        return None, None
+    tracefile, FWHMfile = None, None
+    traceentry = solution_store.SolutionStore('trace').nearest(storekeys,obsdate,maxdays=0)
+    if traceentry is not None:
+        tracefile = traceentry['files']['trace']
+    fwhmentry = solution_store.SolutionStore('fwhm').nearest(storekeys,obsdate,maxdays=0)
+    if fwhmentry is not None:
+        FWHMfile = fwhmentry['files']['fwhm']
+    return tracefile, FWHMfile
 
 #===========================================
 #Primary Program
 #===========================================
-def extract_now(specfile,lamp,FWHMfile,tracefile,trace_exist=False):
+def extract_now(specfile,lamp,FWHMfile,tracefile,trace_exist=False,usecache=True):
+    #lamp can be 'no', a single lamp filename, or a list of lamps from the same setup.
+    if lamp == 'no':
+        lamps = []
+    elif isinstance(lamp,str):
+        lamps = [lamp]
+    else:
+        lamps = list(lamp)
+    if not trace_exist:
+        tracefile = None
+    locfwhm = specfile.find('.fits')
+
+    #If these exact inputs have been extracted before, return the saved files instead of extracting again.
+    #Without a trace or FWHM file they are fit here, with the FWHM order and trace position chosen interactively, so the cache is not used.
+    interactive = not trace_exist or not FWHMfile
+    cachekey = extraction_cache.cache_key(specfile,tracefile,FWHMfile,lamps,dict(extract_params,gain=gain))
+    if usecache and not interactive:
+        cached = extraction_cache.lookup(cachekey)
+        if cached is not None:
+            outputs = [str(name) for name, checksum in cached['outputs']]
+            print 'Inputs unchanged since last extraction. Using %s' % ', '.join(outputs)
+            return outputs
+
     #Open file and read gain and readnoise
-    datalist = fits.open(specfile)
-    data = datalist[0].data
+    spec_header, data = fitsaccess.read(specfile)
     data = np.transpose(data[0,:,:])
     
     #Since we have combined multiple images, to keep our statistics correct, we need to multiply the values in ADU by the number of images
     try:
-        nimages = float(datalist[0].header['NCOMBINE'])
+        nimages = float(spec_header['NCOMBINE'])
     except:
         nimages = 1.
     
     data = nimages * data
     
-    #gain = datalist[0].header['GAIN']
-    gain = 1.33 #from 2017-06-07
-    rdnoise = np.sqrt(nimages) * datalist[0].header['RDNOISE']
+    #Keys for the trace and FWHM database (see solution_store.py)
+    storekeys = solution_store.setup_keys(specfile,spec_header)
+    setupkeys = solution_store.setup_keys(specfile,spec_header,target=False)
+    try:
+        obsdate = spec_header['DATE-OBS']
+    except:
+        obsdate = datetime.datetime.now().strftime("%Y-%m-%d")
+    tracestore = solution_store.SolutionStore('trace')
+    fwhmstore = solution_store.SolutionStore('fwhm')
+    
+    #gain = spec_header['GAIN'] #Set above
+    rdnoise = np.sqrt(nimages) * spec_header['RDNOISE']
 
     #Calculate the variance of each pixel in ADU
     varmodel = ((nimages*rdnoise**2.) + np.absolute(data)*gain)/gain
@@ -129,30 +218,48 @@ def extract_now(specfile,lamp,FWHMfile,tracefile,trace_exist=False):
     
     if not FWHMfile:
     #Fit using a line, but give user the option to fit with a different order
+    #The nearest prior FWHM model of this target is shown first and can be used as it is. Otherwise the fit starts from its order.
         order = 1
-        repeat = 'yes'
-        while repeat == 'yes':
-            fwhmpolyvalues = np.polyfit(fitpixel,fwhmclipped,order)
-            allpixel = np.arange(0,len(data[:,100]),1)
-            fwhmpoly = np.poly1d(fwhmpolyvalues)
-            plt.clf()
-            plt.plot(fitpixel,fwhmclipped,'^')
-            plt.plot(allpixel,fwhmpoly(allpixel),'g')
-            plt.title(specfile)
-            plt.show()
-            repeat = raw_input('Do you want to try again (yes/no)? ')
-            if repeat == 'yes':
-                order = raw_input('New order for polynomial: ')
+        allpixel = np.arange(0,len(data[:,100]),1)
+        fwhmmodel = None
+        priorfwhm = fwhmstore.nearest(storekeys,obsdate)
+        if priorfwhm is not None:
+            order = int(priorfwhm['info'].get('order',1))
+            priormodel = fwhmstore.load(priorfwhm,'fwhm')
+            if len(priormodel) == len(allpixel):
+                plt.clf()
+                plt.plot(fitpixel,fwhmclipped,'^')
+                plt.plot(allpixel,priormodel,'g')
+                plt.title('%s: FWHM model from %s (%s)' % (specfile,priorfwhm['source'],priorfwhm['date']))
+                plt.show()
+                if raw_input('Use the FWHM model from %s (yes/no)? ' % priorfwhm['date']) == 'yes':
+                    fwhmmodel = priormodel
+                    fwhmpolyvalues = np.polyfit(allpixel,fwhmmodel,order)
+        if fwhmmodel is None:
+            repeat = 'yes'
+            while repeat == 'yes':
+                fwhmpolyvalues = np.polyfit(fitpixel,fwhmclipped,order)
+                fwhmpoly = np.poly1d(fwhmpolyvalues)
+                plt.clf()
+                plt.plot(fitpixel,fwhmclipped,'^')
+                plt.plot(allpixel,fwhmpoly(allpixel),'g')
+                plt.title(specfile)
+                plt.show()
+                repeat = raw_input('Do you want to try again (yes/no)? ')
+                if repeat == 'yes':
+                    order = raw_input('New order for polynomial: ')
+            fwhmmodel = fwhmpoly(allpixel)
         
         
-        locfwhm = specfile.find('.fits')
         print '\n Saving FWHM file.'
-        np.save(specfile[0:locfwhm] + '_poly',fwhmpoly(allpixel))
+        savedFWHMfile = specfile[0:locfwhm] + '_poly.npy'
+        np.save(savedFWHMfile,fwhmmodel)
+        fwhmstore.add(storekeys,obsdate,{'fwhm':fwhmmodel,'coefficients':fwhmpolyvalues},info={'order':int(order)},source=os.path.basename(specfile))
     diagnostics = np.zeros([len(data[:,100]),12])
     diagnostics[0:len(allfwhm),0] = fwhmclipped
     diagnostics[0:len(fitpixel),1] = fitpixel
     if not FWHMfile:
-        diagnostics[0:len(allpixel),2] = fwhmpoly(allpixel)
+        diagnostics[0:len(allpixel),2] = fwhmmodel
         diagnostics[0:len(allpixel),3] = allpixel
     else:
         fwhm_fit = np.load(FWHMfile)
@@ -216,19 +323,26 @@ def extract_now(specfile,lamp,FWHMfile,tracefile,trace_exist=False):
     print 'Starting extraction.'
     if trace_exist:
         trace = np.load(tracefile)
-        output_spec = superextract.superExtract(data,varmodel,gain,rdnoise,trace=trace,pord=2,tord=2,bord=1,bkg_radii=background_radii,bsigma=2.,extract_radius=extraction_rad,dispaxis=1,verbose=False,csigma=5.,polyspacing=1,retall=False)
+        output_spec = superextract.superExtract(data,varmodel,gain,rdnoise,trace=trace,bkg_radii=background_radii,extract_radius=extraction_rad,verbose=False,retall=False,**extract_params)
     else:
-        output_spec = superextract.superExtract(data,varmodel,gain,rdnoise,pord=2,tord=2,bord=1,bkg_radii=background_radii,bsigma=2.,extract_radius=extraction_rad,dispaxis=1,verbose=False,csigma=5.,polyspacing=1,retall=False)
-    #pord = order of profile polynomial. Default = 2. This seems appropriate, no change for higher or lower order.
-    #tord = degree of spectral-trace polynomial, 1 = line
-    #bord = degree of polynomial background fit
+        #Seed the trace from the nearest prior trace of this target, or of any target with this setup. Otherwise the user clicks on the spectrum.
+        priortrace = tracestore.nearest(storekeys,obsdate)
+        if priortrace is None:
+            priortrace = tracestore.nearest(setupkeys,obsdate,partial=True)
+        if priortrace is not None:
+            oldtrace = tracestore.load(priortrace,'trace')
+            seedpix = data.shape[0]/2
+            ordlocs = np.array([[seedpix,np.interp(seedpix,np.arange(len(oldtrace)),oldtrace)]])
+            print 'Starting trace from %s (%s) at %s' % (priortrace['source'],priortrace['date'],ordlocs[0])
+        else:
+            ordlocs = None
+        output_spec = superextract.superExtract(data,varmodel,gain,rdnoise,bkg_radii=background_radii,extract_radius=extraction_rad,verbose=False,retall=False,ordlocs=ordlocs,**extract_params)
+    #See extract_params above for the fixed settings.
     #bkg_radii = inner and outer radii to use in computing background. Goes on both sides of aperture.  
-    #bsigma = sigma-clipping thresholf for computing background
     #extract_radius: radius for spectral extraction. Setting this to be 5*FWHM
-    #csigma = sigma-clipping threshold for cleaning & cosmic-ray rejection. Default = 5.
     #qmode: how to compute Marsh's Q-matrix. 'fast-linear' default and preferred.
     #nreject = number of outlier-pixels to reject at each iteration. Default = 100
-    #polyspacing = Marsh's S: the spacing between the polynomials. This should be <= 1. Default = 1. Best to leave at 1. S/N decreases dramatically if greater than 1. If less than one, slower but final spectrum is the same. Crossfield note: A few cursory tests suggests that the extraction precision (in the high S/N case) scales as S^-2 -- but the code slows down as S^2.
+    #polyspacing: S/N decreases dramatically if greater than 1. If less than one, slower but final spectrum is the same. Crossfield note: A few cursory tests suggests that the extraction precision (in the high S/N case) scales as S^-2 -- but the code slows down as S^2.
     #Verbose=True if you want lots of output
 
     ###########
@@ -241,7 +355,9 @@ def extract_now(specfile,lamp,FWHMfile,tracefile,trace_exist=False):
     print 'Done extracting. Starting to save.'
     if not trace_exist:
         print 'Saving the trace.'
-        np.save(specfile[0:locfwhm] + '_trace',output_spec.trace)
+        savedtracefile = specfile[0:locfwhm] + '_trace.npy'
+        np.save(savedtracefile,output_spec.trace)
+        tracestore.add(storekeys,obsdate,{'trace':output_spec.trace},info={'tord':extract_params['tord'],'seeded':ordlocs is not None},source=os.path.basename(specfile))
     sigSpectrum = np.sqrt(output_spec.varSpectrum)
     #plt.clf()
     #plt.imshow(data)
@@ -276,44 +392,26 @@ def extract_now(specfile,lamp,FWHMfile,tracefile,trace_exist=False):
         header = 'Columns are: 1) Measured FWHM, 2) pixel value of each FWHM, 3) fit to FWHM measurements, 4) all pixel values, 5) profile pixels, 6) profile position, 7) fit profile positions, 8) Pixels values of cut at pixel 1200, 9) Values along column 1200, 10) Pixels of fit to background, 11) Values used for fit, 12) polynomial fit to background'
         np.savetxt(handle,diagnostics,fmt='%f',header=header)
     
-    #Compute the extracted signal to noise and save to header
-    if 'blue' in specfile.lower():
-        low_pixel, high_pixel = 1125., 1175.
-    elif 'red' in specfile.lower():
-        low_pixel, high_pixel = 825., 875.
-    shortspec = output_spec.spectrum[:,0][low_pixel:high_pixel]
-    shortsigma = sigSpectrum[:,0][low_pixel:high_pixel]
-    shortpix = np.linspace(low_pixel,high_pixel,num=(high_pixel-low_pixel),endpoint=False)
-    guessline = np.zeros(2)
-    guessline[0] = (shortspec[-1] - shortspec[0]) / (shortpix[-1]-shortpix[0])
-    guessline[1] = shortspec[0]-guessline[0]*shortpix[0]
-    par, cov = curve_fit(line,shortpix,shortspec,guessline)
-    bestline = line(shortpix,par[0],par[1])
-    
-    signal = np.mean(shortspec)
-    noise = np.sqrt(np.sum((shortspec-bestline)**2.) / float(len(bestline))) #Noise from RMS
-    #noise = np.mean(shortsigma) #noise from sigma spectrum
-    sn_res_ele = signal/noise * np.sqrt(fwhm)
+    #Compute the extracted signal to noise and other quality numbers. Saved to header below.
+    #With a saved trace there are no measured positions to compare to it (tracepos is the trace itself), so TRACERMS is left out.
+    if trace_exist:
+        measuredpos = None
+    else:
+        measuredpos = output_spec.tracepos
+    quality = spectrum_quality.measure(specfile,output_spec.spectrum[:,0],np.ravel(output_spec.background),fwhm,trace=output_spec.trace,tracepos=measuredpos)
+    sn_res_ele = quality['snr']
     print 'Signal to Noise is: ', sn_res_ele
     
-    #plt.clf()
-    #plt.plot(shortpix,shortspec,'b')
-    #plt.plot(shortpix,bestline,'g')
-    #plt.show()
-    
-    #exit()
-
-    #Get the image header and add keywords
-    header = st.readheader(specfile)
+    #Add keywords to the image header, read with the data above
+    header = spec_header
     header.set('BANDID1','Optimally Extracted Spectrum')
     header.set('BANDID2','Raw Extracted Spectrum')
     header.set('BANDID3','Mean Background')
     header.set('BANDID4','Sigma Spectrum')
     header.set('DISPCOR',0) #Dispersion axis of image
     fwhmsave = np.round(fwhm,decimals=4)
-    snrsave = np.round(sn_res_ele,decimals=4)
     header.set('SPECFWHM',fwhmsave,'FWHM of spectrum in pixels') #FWHM of spectrum in pixels
-    header.set('SNR',snrsave,'Signal to Noise per resolution element') 
+    header = spectrum_quality.add_to_header(header,quality)
     header.set('DATEEXTR',datetime.datetime.now().strftime("%Y-%m-%d"),'Date of Spectral Extraction')
     
     #Save the extracted image
@@ -359,82 +457,98 @@ def extract_now(specfile,lamp,FWHMfile,tracefile,trace_exist=False):
     newinfo = specfile + '\t' + now + '\t' + str(extraction_rad) + '\t' + str(background_radii) + '\t' + newname
     f.write(newinfo + "\n")
     f.close()
+    spectrum_quality.write_metrics(newname,quality)
     
     ###########################
     #Extract a lamp spectrum using the trace from above
     ##########################
     
     
-    if lamp != 'no':
-        lamplist = fits.open(lamp)
-        lampdata = lamplist[0].data
-        lampdata = lampdata[0,:,:]
-        lampdata = np.transpose(lampdata)
+    lampnames = []
+    if len(lamps) > 0:
+        #All lamps are extracted against the same trace in one pass.
+        lampframes = []
+        lampheaders = []
+        for lampfile in lamps:
+            lampheader, lampdata = fitsaccess.read(lampfile)
+            lampdata = lampdata[0,:,:]
+            lampframes.append(np.array(np.transpose(lampdata),dtype=float))
+            lampheaders.append(lampheader)
 
         #extraction radius will be the FWHM the star
         #But since the Fe lamps are taken binned by 1 in spectral direction, we need to adjust the trace to match.
-        #We do that by expanding out the trace to match the length of the Fe lamps, then interpolate and read off values for every pixel.
-        bin2size = np.arange(1,len(output_spec.trace)+1)
-        bin1size = np.arange(1,len(lampdata)+1)
-        ratio = float(len(bin1size)) / float(len(bin2size))
-        interpolates = InterpolatedUnivariateSpline(ratio*bin2size,output_spec.trace,k=1)
-        newtrace = interpolates(bin1size)
+        #The rescaled trace is computed once and shared by every lamp.
+        newtrace = rescale_trace(output_spec.trace,len(lampframes[0]))
         
         #Do the extraction here.
         lamp_radius = np.ceil(fwhm) #Make sure that extraction radius is a whole number, otherwise you'll get odd structures.
-        lampspec = lampextract(lampdata,newtrace,lamp_radius)
+        lampspecs = lampextract_multi(lampframes,newtrace,lamp_radius)
         
-        #Save the 1D lamp
-        lampheader = st.readheader(lamp)
-        lampheader.set('BANDID2','Raw Extracted Spectrum')
-        lampheader.set('REF',newname,'Reference Star used for trace')
-        lampheader.set('DATEEXTR',datetime.datetime.now().strftime("%Y-%m-%d"),'Date of Spectral Extraction')
-
-        Ni = 1. #We are writing just 1 1D spectrum
-        Ny = len(lampspec[:,0])
-        lampspectrum = np.empty(shape = (Ni,Ny))
-        lampspectrum[0,:] = lampspec[:,0]
+        for lampfile, lampspec, lampheader in zip(lamps,lampspecs,lampheaders):
+            #Save the 1D lamp
+            lampheader.set('BANDID2','Raw Extracted Spectrum')
+            lampheader.set('REF',newname,'Reference Star used for trace')
+            lampheader.set('DATEEXTR',datetime.datetime.now().strftime("%Y-%m-%d"),'Date of Spectral Extraction')
+
+            Ni = 1 #We are writing just 1 1D spectrum
+            Ny = len(lampspec)
+            lampspectrum = np.empty(shape = (Ni,Ny))
+            lampspectrum[0,:] = lampspec
         
-        #Save the extracted spectra with .ms.fits in the filename
-        #Ask to overwrite if file already exists or provide new name
-        loc2 = lamp.find('.fits')
-        loc3 = newname.find('_930')
-        newname2 = lamp[0:loc2] + '_' + newname[5:loc3]  + '.ms.fits'
-        clob = False
-
-        mylist = [True for f in os.listdir('.') if f == newname2]
-        exists = bool(mylist)
-
-        if exists:
-            print 'File %s already exists.' % newname2
-            nextstep = raw_input('Do you want to overwrite or designate a new name (overwrite/new)? ')
-            if nextstep == 'overwrite':
-                clob = True
-                exists = False
-            elif nextstep == 'new':
-                newname2 = raw_input('New file name: ')
-                exists = False
-            else:
-                exists = False
-
-
-        lampim = fits.PrimaryHDU(data=lampspectrum,header=lampheader)
-        lampim.writeto(newname2,clobber=clob)
-        print 'Wrote %s to file.' % newname2
+            #Save the extracted spectra with .ms.fits in the filename
+            #Ask to overwrite if file already exists or provide new name
+            loc2 = lampfile.find('.fits')
+            loc3 = newname.find('_930')
+            newname2 = lampfile[0:loc2] + '_' + newname[5:loc3]  + '.ms.fits'
+            clob = False
+
+            mylist = [True for f in os.listdir('.') if f == newname2]
+            exists = bool(mylist)
+
+            if exists:
+                print 'File %s already exists.' % newname2
+                nextstep = raw_input('Do you want to overwrite or designate a new name (overwrite/new)? ')
+                if nextstep == 'overwrite':
+                    clob = True
+                    exists = False
+                elif nextstep == 'new':
+                    newname2 = raw_input('New file name: ')
+                    exists = False
+                else:
+                    exists = False
+
+
+            lampim = fits.PrimaryHDU(data=lampspectrum,header=lampheader)
+            lampim.writeto(newname2,clobber=clob)
+            print 'Wrote %s to file.' % newname2
         
-        #Save parameters to a file for future reference. 
-        # specfile,date of extraction, extration_rad,background_radii,newname,newname2
-        background_radii2 = [0,0] #We do not extract a background for the lamp
-        f = open('extraction_params.txt','a')
-        now = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M")
-        newinfo2 = lamp + '\t' + now + '\t' + str(extraction_rad) + '\t' + str(background_radii2) + '\t' + newname2
-        f.write(newinfo2 + "\n")
-        f.close()
+            #Save parameters to a file for future reference. 
+            # specfile,date of extraction, extration_rad,background_radii,newname,newname2
+            background_radii2 = [0,0] #We do not extract a background for the lamp
+            f = open('extraction_params.txt','a')
+            now = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M")
+            newinfo2 = lampfile + '\t' + now + '\t' + str(extraction_rad) + '\t' + str(background_radii2) + '\t' + newname2
+            f.write(newinfo2 + "\n")
+            f.close()
+            lampnames.append(newname2)
         
         #######################
         # End lamp extraction
         #######################
 
+    #Record this extraction in the cache. If the trace or FWHM was fit here, it is stored under the key the saved trace and FWHM files will give,
+    #since those files hold the choices made, and not under the key of the inputs alone.
+    outputs = [newname] + lampnames
+    info = {'extraction_rad':float(extraction_rad),'background_radii':[float(x) for x in background_radii]}
+    if interactive:
+        if not trace_exist:
+            tracefile = savedtracefile
+        if not FWHMfile:
+            FWHMfile = savedFWHMfile
+        cachekey = extraction_cache.cache_key(specfile,tracefile,FWHMfile,lamps,dict(extract_params,gain=gain))
+    extraction_cache.store([cachekey],specfile,outputs,info=info)
+    return outputs
+
         
 #Read in file from command line
 if __name__ == '__main__':
@@ -0,0 +1,124 @@
+'''
+Written for the ZZ Ceti pipeline.
+
+Quality numbers for an extracted spectrum, all computed in closed form (no iterative fitting). Used by spectral_extraction.py after each extraction.
+
+For every window (a range of pixels along the dispersion axis) a straight line is fit to the optimally extracted spectrum by linear least squares. From that fit we get:
+    snr: signal to noise per resolution element, mean(signal)/RMS(residuals) * sqrt(FWHM)
+    contrms: RMS of the residuals divided by the mean signal (fractional continuum scatter)
+    sky: median of the background spectrum in the window
+
+For the whole spectrum we also compute:
+    tracerms: RMS in pixels of the measured trace positions about the fitted trace. Only when the trace was fit in this extraction, not when a saved trace was used.
+
+:OUTPUTS:
+    spectrum_quality.txt: one row per extracted spectrum with the numbers above for each window.
+
+'''
+
+import os
+import datetime
+import numpy as np
+
+#Windows (first pixel, last pixel) used for each setup. The first window of each setup is the one saved as SNR in the header, so it matches the values from earlier reductions.
+windows = {'blue':[(1125,1175),(700,750),(1500,1550)],
+           'red':[(825,875),(400,450),(1300,1350)]}
+
+QUALITY_FILE = 'spectrum_quality.txt'
+
+#===========================================
+def fit_line(x,y):
+    #Closed form least-squares straight line. Returns slope, intercept.
+    x = np.asarray(x,dtype=float)
+    y = np.asarray(y,dtype=float)
+    xmean = x.mean()
+    ymean = y.mean()
+    dx = x - xmean
+    slope = np.sum(dx*(y-ymean)) / np.sum(dx**2.)
+    intercept = ymean - slope*xmean
+    return slope, intercept
+
+#===========================================
+def get_windows(specfile):
+    #Pick the windows for a spectrum from its filename.
+    if 'blue' in specfile.lower():
+        return windows['blue']
+    elif 'red' in specfile.lower():
+        return windows['red']
+    else:
+        return []
+
+#===========================================
+def window_metrics(spectrum,sky,fwhm,low_pixel,high_pixel):
+    #S/N per resolution element, fractional continuum RMS, and sky level in one window.
+    low_pixel, high_pixel = int(low_pixel), int(high_pixel)
+    shortspec = np.asarray(spectrum,dtype=float)[low_pixel:high_pixel]
+    shortpix = np.arange(low_pixel,low_pixel+len(shortspec),dtype=float)
+    slope, intercept = fit_line(shortpix,shortspec)
+    bestline = slope*shortpix + intercept
+
+    signal = np.mean(shortspec)
+    noise = np.sqrt(np.sum((shortspec-bestline)**2.) / float(len(bestline))) #Noise from RMS
+    snr = signal/noise * np.sqrt(fwhm)
+    contrms = noise/signal
+    skylevel = np.median(np.asarray(sky,dtype=float)[low_pixel:high_pixel])
+    return snr, contrms, skylevel
+
+#===========================================
+def trace_rms(tracepos,trace):
+    #RMS of the measured trace positions about the fitted trace. tracepos is [x positions, y positions].
+    xpos = np.asarray(tracepos[0],dtype=float)
+    ypos = np.asarray(tracepos[1],dtype=float)
+    good = np.isfinite(xpos) & np.isfinite(ypos)
+    if not np.any(good):
+        return np.nan
+    fitpos = np.interp(xpos[good],np.arange(len(trace)),trace)
+    return np.sqrt(np.mean((ypos[good]-fitpos)**2.))
+
+#===========================================
+def measure(specfile,spectrum,sky,fwhm,trace=None,tracepos=None,windowlist=None):
+    #Compute all quality numbers for one extracted spectrum. Returns a dictionary.
+    #windowlist overrides the default windows for this setup.
+    if windowlist is None:
+        windowlist = get_windows(specfile)
+    metrics = {'windows':[]}
+    for low_pixel, high_pixel in windowlist:
+        snr, contrms, skylevel = window_metrics(spectrum,sky,fwhm,low_pixel,high_pixel)
+        metrics['windows'].append({'low':int(low_pixel),'high':int(high_pixel),'snr':snr,'contrms':contrms,'sky':skylevel})
+    if len(metrics['windows']) > 0:
+        metrics['snr'] = metrics['windows'][0]['snr']
+        metrics['contrms'] = metrics['windows'][0]['contrms']
+        metrics['sky'] = metrics['windows'][0]['sky']
+    else:
+        metrics['snr'], metrics['contrms'], metrics['sky'] = np.nan, np.nan, np.nan
+    if trace is not None and tracepos is not None:
+        metrics['tracerms'] = trace_rms(tracepos,trace)
+    else:
+        metrics['tracerms'] = np.nan
+    return metrics
+
+#===========================================
+def add_to_header(header,metrics):
+    #Save the quality numbers to a FITS header. SNR is from the first window. SNRn is for window n.
+    header.set('SNR',np.round(metrics['snr'],decimals=4),'Signal to Noise per resolution element')
+    header.set('CONTRMS',np.round(metrics['contrms'],decimals=6),'Fractional continuum RMS')
+    header.set('SKYLEVEL',np.round(metrics['sky'],decimals=4),'Median sky in SNR window')
+    if np.isfinite(metrics['tracerms']):
+        header.set('TRACERMS',np.round(metrics['tracerms'],decimals=4),'RMS of trace positions in pixels')
+    for n, window in enumerate(metrics['windows']):
+        header.set('SNR' + str(n+1),np.round(window['snr'],decimals=4),'S/N per res. element, pixels %i-%i' % (window['low'],window['high']))
+    return header
+
+#===========================================
+def write_metrics(specfile,metrics,filename=QUALITY_FILE):
+    #Append a row for this spectrum to the metrics table.
+    #Columns: spectrum, date, trace RMS, then low pixel, high pixel, S/N, continuum RMS, sky for each window.
+    newfile = not os.path.isfile(filename)
+    now = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M")
+    row = [specfile,now,'%.4f' % metrics['tracerms']]
+    for window in metrics['windows']:
+        row += ['%i' % window['low'],'%i' % window['high'],'%.4f' % window['snr'],'%.6f' % window['contrms'],'%.4f' % window['sky']]
+    with open(filename,'a') as handle:
+        if newfile:
+            handle.write('#spectrum\tdate\ttracerms\t(low\thigh\tsnr\tcontrms\tsky) for each window\n')
+        handle.write('\t'.join(row) + '\n')
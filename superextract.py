@@ -21,6 +21,11 @@ def superExtract(*args, **kw):
          location of spectral trace.  If None, :func:`traceorders` is
          invoked.
 
+       ordlocs : (1 x 2) numpy array
+         (x, y) starting location passed to :func:`traceorders` when
+         'trace' is not given, e.g. taken from a previous trace of the
+         same target.  If None, the user clicks on the spectrum.
+
        goodpixelmask : 2D numpy array
          Equals 0 for bad pixels, 1 for good pixels
 
@@ -54,6 +59,13 @@ def superExtract(*args, **kw):
        bsigma : int >= 0
          Sigma-clipping threshold for computing background.
 
+       bkgmode : str ('rows' or 'multi')
+         How to fit the background.  'rows' (default) calls
+         :func:`polyfitr` on each row, rejecting one point per
+         iteration.  'multi' fits all rows at once with
+         :func:`polyfitr_multi`, rejecting every point beyond bsigma
+         on each pass.
+
        tord : int >= 0
          Degree of spectral-trace polynomial (for trace across frame
          -- not used if 'trace' is input)
@@ -142,7 +154,7 @@ def superExtract(*args, **kw):
 
     from scipy import signal
     from pylab import *
-    from superextract_tools import bfixpix, traceorders, polyfitr, baseObject,message
+    from superextract_tools import bfixpix, traceorders, polyfitr, polyfitr_multi, baseObject,message
 
 
 
@@ -227,6 +239,11 @@ def superExtract(*args, **kw):
         bsigma = 3
         if verbose: message("Setting option 'bsigma' to: " + str(bsigma))
 
+    if kw.has_key('bkgmode'):
+        bkgmode = kw['bkgmode']
+    else:
+        bkgmode = 'rows'
+
     if kw.has_key('csigma'):
         csigma = kw['csigma']
     else:
@@ -273,12 +290,17 @@ def superExtract(*args, **kw):
     else:
         trace = None
 
+    if kw.has_key('ordlocs'):
+        ordlocs = kw['ordlocs']
+    else:
+        ordlocs = None
+
     if trace is None:
         trace = tord
     if not hasattr(trace, '__iter__'):
         #if verbose: print "Tracing not fully tested; dispaxis may need adjustment."
         #pdb.set_trace()
-        tracecoef, xyfits = traceorders(frame, pord=trace, nord=1, verbose=verbose, plotalot=verbose-1, g=gain, rn=readnoise, badpixelmask=True-goodpixelmask, dispaxis=dispaxis, fitwidth=min(fitwidth, 80),retfits=True)
+        tracecoef, xyfits = traceorders(frame, pord=trace, nord=1, verbose=verbose, plotalot=verbose-1, g=gain, rn=readnoise, badpixelmask=True-goodpixelmask, dispaxis=dispaxis, fitwidth=min(fitwidth, 80), ordlocs=ordlocs, retfits=True)
         trace = np.polyval(tracecoef.ravel(), np.arange(nlam))
 
     #xxx = np.arange(-fitwidth/2, fitwidth/2)
@@ -298,31 +320,45 @@ def superExtract(*args, **kw):
     background = 0. * frame
     #background_rms = np.zeros(nlam)
     #bkgrndmask = goodpixelmask
-    for ii in range(nlam):
-        if goodpixelmask[ii, backgroundApertures[ii]].any():
-            fit,fit_chisq,fit_niter = polyfitr(xxx[ii,backgroundApertures[ii]], frame[ii, backgroundApertures[ii]], bord, bsigma, w=(goodpixelmask/variance)[ii, backgroundApertures[ii]], verbose=verbose-1,plotall=False,diag=True)
-            #If you want to plot the fit to the background you can use this. Or set plotall=True above
-            #if ii == 1100:
-            #print ii
-            #    plt.clf()
-            #    plt.plot(xxx[ii,:],frame[ii,:],'k^')
-            #    plt.plot(xxx[ii,backgroundApertures[ii]],frame[ii, backgroundApertures[ii]],'b^')
-            #    plt.plot(xxx[ii,:],np.polyval(fit,xxx[ii,:]))
-            #    plt.show()
-            background[ii, :] = np.polyval(fit, xxx[ii])
-            thisrow = backgroundApertures[ii]
-            #background_rms[ii] = fit_chisq
-            #print background_rms[ii], fit_chisq
-            #plt.show()
-            #Save values
-            if ii == 1100:
-                background_column_pixels = xxx[ii,:]
-                background_column_values = frame[ii,:]
-                background_fit_pixels = xxx[ii,backgroundApertures[ii]]
-                background_fit_values = frame[ii, backgroundApertures[ii]]
-                background_fit_polynomial = np.polyval(fit,xxx[ii,:])
-        else:
-            background[ii] = 0.
+    if bkgmode=='multi':
+        #Fit every row in one call. The fit is done in absolute column number, which spans the same polynomials as the distance from the trace.
+        columns = np.arange(fitwidth)
+        bkgweights = (goodpixelmask/variance) * backgroundApertures
+        bkgfits, bkggood, bkgpasses = polyfitr_multi(columns, frame, bord, bsigma, w=bkgweights, maxpass=10)
+        background = np.dot(bkgfits, columns.reshape(1,fitwidth)**np.arange(bord,-1,-1).reshape(bord+1,1))
+        background[~bkggood] = 0.
+        ii = min(1100, nlam-1)
+        background_column_pixels = xxx[ii,:]
+        background_column_values = frame[ii,:]
+        background_fit_pixels = xxx[ii,backgroundApertures[ii]]
+        background_fit_values = frame[ii, backgroundApertures[ii]]
+        background_fit_polynomial = background[ii,:]
+    else:
+        for ii in range(nlam):
+            if goodpixelmask[ii, backgroundApertures[ii]].any():
+                fit,fit_chisq,fit_niter = polyfitr(xxx[ii,backgroundApertures[ii]], frame[ii, backgroundApertures[ii]], bord, bsigma, w=(goodpixelmask/variance)[ii, backgroundApertures[ii]], verbose=verbose-1,plotall=False,diag=True)
+                #If you want to plot the fit to the background you can use this. Or set plotall=True above
+                #if ii == 1100:
+                #print ii
+                #    plt.clf()
+                #    plt.plot(xxx[ii,:],frame[ii,:],'k^')
+                #    plt.plot(xxx[ii,backgroundApertures[ii]],frame[ii, backgroundApertures[ii]],'b^')
+                #    plt.plot(xxx[ii,:],np.polyval(fit,xxx[ii,:]))
+                #    plt.show()
+                background[ii, :] = np.polyval(fit, xxx[ii])
+                thisrow = backgroundApertures[ii]
+                #background_rms[ii] = fit_chisq
+                #print background_rms[ii], fit_chisq
+                #plt.show()
+                #Save values
+                if ii == 1100:
+                    background_column_pixels = xxx[ii,:]
+                    background_column_values = frame[ii,:]
+                    background_fit_pixels = xxx[ii,backgroundApertures[ii]]
+                    background_fit_values = frame[ii, backgroundApertures[ii]]
+                    background_fit_polynomial = np.polyval(fit,xxx[ii,:])
+            else:
+                background[ii] = 0.
     #plt.clf()
     #plt.plot(range(nlam),background_rms,'b^')
     #plt.show()
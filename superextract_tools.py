@@ -1,6 +1,7 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.optimize as optimize
+from scipy.interpolate import InterpolatedUnivariateSpline
 import pdb
 from pylab import plot, legend, title, figure, arange, cm
 
@@ -813,7 +814,8 @@ def fixval(arr, repval, retarr=False):
 
 
 def polyfitr(x, y, N, s, fev=100, w=None, diag=False, clip='both', \
-                 verbose=False, plotfit=False, plotall=False, eps=1e-13, catchLinAlgError=False):
+                 verbose=False, plotfit=False, plotall=False, eps=1e-13, catchLinAlgError=False, \
+                 reject='single', maxpass=None):
     """Matplotlib's polyfit with weights and sigma-clipping rejection.
 
     :DESCRIPTION:
@@ -837,11 +839,29 @@ def polyfitr(x, y, N, s, fev=100, w=None, diag=False, clip='both', \
         catchLinAlgError : bool
           If True, don't bomb on LinAlgError; instead, return [0, 0, ... 0].
 
+        reject : str
+          'single' -- reject only the worst point on each iteration
+          'batch' -- reject every point beyond 's' sigma on each
+                     iteration.  Every point is tested against each
+                     new fit, so points rejected while outliers pulled
+                     the fit away are restored.  Converges in a few
+                     passes instead of one pass per outlier.
+
+        maxpass : int
+          Maximum number of iterations.  Defaults to 'fev'.
+
     :REQUIREMENTS:
        :doc:`CARSMath`
 
     :NOTES:
-       Iterates so long as n_newrejections>0 AND n_iter<fev. 
+       Iterates so long as n_newrejections>0 AND n_iter<fev (or maxpass). 
+       With reject='batch', iterates until the rejected points no
+       longer change.
+
+       Stops early if fewer than N+1 points would remain.
+
+    :SEE_ALSO:
+       :func:`polyfitr_multi` to fit many series on the same x grid at once.
 
 
      """
@@ -853,6 +873,7 @@ def polyfitr(x, y, N, s, fev=100, w=None, diag=False, clip='both', \
     # 2012-08-20 16:47 IJMC: Major change: now only reject one point per iteration!
     # 2012-08-27 10:44 IJMC: Verbose < 0 now resets to 0
     # 2013-05-21 23:15 IJMC: Added catchLinAlgError
+    # Added 'batch' rejection and maxpass options.
 
     #from CARSMath import polyfitw
     
@@ -869,6 +890,10 @@ def polyfitr(x, y, N, s, fev=100, w=None, diag=False, clip='both', \
     else:
         ww = np.array(w, copy=False)
 
+    if maxpass is None:
+        maxpass = fev
+    batch = (reject=='batch')
+
     ii = 0
     nrej = 1
 
@@ -877,11 +902,15 @@ def polyfitr(x, y, N, s, fev=100, w=None, diag=False, clip='both', \
     else:
         goodind = np.isfinite(xx)*np.isfinite(yy)*np.isfinite(ww)
     
-    xx2 = xx[goodind]
-    yy2 = yy[goodind]
-    ww2 = ww[goodind]
-
-    while (ii<fev and (nrej<>0)):
+    xxg = xx[goodind]
+    yyg = yy[goodind]
+    wwg = ww[goodind]
+    kept = np.ones(xxg.shape, dtype=bool)
+    xx2 = xxg
+    yy2 = yyg
+    ww2 = wwg
+
+    while (ii<maxpass and (nrej<>0)):
         if noweights:
             p = np.polyfit(xx2,yy2,N)
             residual = yy2 - np.polyval(p,xx2)
@@ -900,7 +929,19 @@ def polyfitr(x, y, N, s, fev=100, w=None, diag=False, clip='both', \
             residual = (yy2 - np.polyval(p,xx2)) * np.sqrt(ww2)
             clipmetric = s
 
-        if clip=='both':
+        if batch:
+            # Test every point, not only those still in the fit.
+            residual = yyg - np.polyval(p,xxg)
+            if not noweights:
+                residual = residual * np.sqrt(wwg)
+
+        if batch and clip=='both':
+            ind = (abs(residual) <= clipmetric) + (abs(residual) < eps)
+        elif batch and clip=='above':
+            ind = residual <= clipmetric
+        elif batch and clip=='below':
+            ind = residual >= -clipmetric
+        elif clip=='both':
             worstOffender = abs(residual).max()
             #pdb.set_trace()
             if worstOffender <= clipmetric or worstOffender < eps:
@@ -921,13 +962,28 @@ def polyfitr(x, y, N, s, fev=100, w=None, diag=False, clip='both', \
                 ind = residual > worstOffender
         else:
             ind = np.ones(residual.shape, dtype=bool)
-    
-        xx2 = xx2[ind]
-        yy2 = yy2[ind]
-        if (not noweights):
-            ww2 = ww2[ind]
-        ii = ii + 1
-        nrej = len(residual) - len(xx2)
+
+        if batch:
+            if ind.sum() < N+1:
+                # Not enough points left for another fit; keep this one.
+                ind = kept
+            ii = ii + 1
+            nrej = (ind != kept).sum()
+            kept = ind
+            xx2 = xxg[kept]
+            yy2 = yyg[kept]
+            ww2 = wwg[kept]
+        else:
+            if ind.sum() < N+1:
+                # Not enough points left for another fit; keep this one.
+                ind = np.ones(residual.shape, dtype=bool)
+
+            xx2 = xx2[ind]
+            yy2 = yy2[ind]
+            if (not noweights):
+                ww2 = ww2[ind]
+            ii = ii + 1
+            nrej = len(residual) - len(xx2)
         if plotall:
             allx = np.arange(x[0],x[-1],1)
             figure()
@@ -946,6 +1002,8 @@ def polyfitr(x, y, N, s, fev=100, w=None, diag=False, clip='both', \
         title('Close window to continue....')
 
     if diag:
+        if batch:
+            residual = residual[kept]
         #chisq = ( (residual)**2. / yy2 ).sum()
         chisq = ( (residual)**2. ).sum()
         p = (p, chisq, ii)
@@ -996,32 +1054,28 @@ def polyfitw(x, y, w, ndegree, return_fit=0):
                  Fixed bug with checking number of params, November, 1998, 
                  Mark Rivers.  
                  Python version, May 2002, Mark Rivers
+                 Solved by QR decomposition instead of the normal
+                 equations.
    """
 
    n = min(len(x), len(y)) # size = smaller of x,y
    m = ndegree + 1         # number of elements in coeff vector
-   a = np.zeros((m,m),dtype=float)  # least square matrix, weighted matrix
-   b = np.zeros(m,dtype=float)    # will contain sum w*y*x^j
-   z = np.ones(n,dtype=float)     # basis vector for constant term
-
-   a[0,0] = np.sum(w)
-   b[0] = np.sum(w*y)
-
-   for p in range(1, 2*ndegree+1):     # power loop
-      z = z*x   # z is now x^p
-      if (p < m):  b[p] = np.sum(w*y*z)   # b is sum w*y*x^j
-      sum = np.sum(w*z)
-      for j in range(max(0,(p-ndegree)), min(ndegree,p)+1):
-         a[j,p-j] = sum
-
-   #a = LinearAlgebra.inverse(a)
-   a = np.linalg.inv(a)
-   #c = N.matrixmultiply(b, a)
-   c = np.dot(b, a)
+   x = np.asarray(x, dtype=float)[0:n]
+   y = np.asarray(y, dtype=float)[0:n]
+   sw = np.sqrt(np.asarray(w, dtype=float)[0:n])
+
+   # Solve the weighted least-squares problem with a QR decomposition
+   # of the weighted Vandermonde matrix instead of inverting the
+   # normal equations, which square the condition number.
+   vander = sw.reshape(n,1) * x.reshape(n,1)**np.arange(m)
+   q, r = np.linalg.qr(vander)
+   c = np.linalg.solve(r, np.dot(q.T, sw*y))
    if (return_fit == 0):
       return c     # exit if only fit coefficients are wanted
 
    # compute optional output parameters.
+   rinv = np.linalg.inv(r)
+   a = np.dot(rinv, rinv.T)  # inverse of the normal matrix
    yfit = np.zeros(n,dtype=float)+c[0]   # one-sigma error estimates, init
    for k in range(1, ndegree +1):
       yfit = yfit + c[k]*(x**k)  # sum basis vectors
@@ -1042,6 +1096,122 @@ def polyfitw(x, y, w, ndegree, return_fit=0):
 # ===========================================================================
 
 
+def polyfitr_multi(x, y, N, s, w=None, clip='both', maxpass=10):
+    """Weighted, sigma-clipped polynomial fits to many series that
+    share the same x grid.
+
+    :DESCRIPTION:
+      Fits a polynomial of order N to every row of y at once.  Each
+      pass tests every point in a row against the latest fit and
+      rejects those whose weighted residual exceeds s (the same
+      criterion as :func:`polyfitr` with weights and reject='batch'),
+      then refits.  Points rejected on an earlier pass come back if
+      they agree with the new fit.  Stops when the rejected points no
+      longer change.  Points are rejected by setting their weight to
+      zero, so every row keeps the same shape.
+
+    :INPUTS:
+       x : 1D numpy array, length n
+         Shared independent variable.
+
+       y : 2D numpy array, shape (m, n)
+         One series per row.
+
+       N : int
+         Polynomial order.
+
+       s : scalar
+         Rejection threshold in units of the weighted residual.
+
+    :OPTIONS:
+       w : 2D numpy array, shape (m, n)
+         Weights (1/variance).  Zero-weight points are ignored.  If
+         None, all weights are 1 and s is in units of each row's
+         standard deviation.
+
+       clip : 'both', 'above', or 'below'
+         As for :func:`polyfitr`.
+
+       maxpass : int
+         Maximum number of rejection passes.
+
+    :RETURNS:
+       (p, good, npass)
+         p : (m, N+1) coefficients for np.polyval, highest power first.
+         good : (m,) bool, False for rows with fewer than N+1
+                usable points (their coefficients are zero).
+         npass : number of passes made.
+    """
+    xx = np.asarray(x, dtype=float)
+    yy = np.array(y, dtype=float, copy=True)
+    m, n = yy.shape
+    noweights = w is None
+    if noweights:
+        ww = np.ones((m, n), dtype=float)
+    else:
+        ww = np.array(w, dtype=float, copy=True)
+    bad = ~(np.isfinite(yy) * np.isfinite(ww)) + ~np.isfinite(xx)
+    ww[bad] = 0.
+    yy[bad] = 0.
+    w0 = ww.copy()
+    rejected = np.zeros((m, n), dtype=bool)
+
+    # Fit in a scaled variable so the normal matrices stay well
+    # conditioned, then convert back to powers of x.
+    center = 0.5 * (xx.max() + xx.min())
+    scale = 0.5 * (xx.max() - xx.min())
+    if scale == 0:
+        scale = 1.
+    vander = ((xx - center) / scale).reshape(n, 1)**np.arange(N+1)
+
+    npass = 0
+    while True:
+        good = (ww > 0).sum(1) >= N+1
+        alpha = np.einsum('kj,ji,jl->kil', ww, vander, vander)
+        beta = np.einsum('kj,ji,kj->ki', ww, vander, yy)
+        alpha[~good] = np.identity(N+1)
+        beta[~good] = 0.
+        coef = np.linalg.solve(alpha, beta[:,:,np.newaxis])[:,:,0]
+        residual = yy - np.dot(coef, vander.T)
+        if noweights:
+            used = ww > 0
+            nused = np.maximum(used.sum(1), 1)
+            std = np.sqrt((residual**2 * used).sum(1) / nused -
+                          ((residual * used).sum(1) / nused)**2)
+            scaled = residual / std.reshape(m, 1)
+        else:
+            scaled = residual * np.sqrt(w0)
+        npass += 1
+        if clip=='both':
+            reject = np.abs(scaled) > s
+        elif clip=='above':
+            reject = scaled > s
+        elif clip=='below':
+            reject = scaled < -s
+        else:
+            reject = np.zeros(scaled.shape, dtype=bool)
+        reject *= (w0 > 0)
+        # Never reject a row down to fewer than N+1 points.
+        keep = ((w0 > 0) * ~reject).sum(1) >= N+1
+        reject[~keep] = rejected[~keep]
+        if npass >= maxpass or (reject == rejected).all():
+            break
+        rejected = reject
+        ww = w0 * ~rejected
+
+    # Powers of the scaled variable expanded as polynomials in x.
+    convert = np.zeros((N+1, N+1))
+    term = np.poly1d([1.])
+    for j in range(N+1):
+        convert[j, N-j:] = term.coeffs
+        term = term * np.poly1d([1./scale, -center/scale])
+    p = np.dot(coef, convert)
+    p[~good] = 0.
+    return p, good, npass
+
+# ===========================================================================
+
+
 class baseObject:
     """Empty object container.
     """
@@ -1051,17 +1221,87 @@ class baseObject:
 
 # ===========================================================================
 
+def rescale_trace(trace, nlam):
+    """Stretch a trace measured on a binned frame onto a frame with
+    'nlam' pixels along the dispersion axis.
+
+    The Fe lamps are taken binned by 1 in the spectral direction, so
+    the trace of the star must be expanded to match them.  Compute
+    this once per trace and pass the result to :func:`lampextract`
+    or :func:`lampextract_multi` for every lamp of that setup.
+    """
+    trace = np.asarray(trace, dtype=float)
+    bin2size = np.arange(1, len(trace)+1)
+    bin1size = np.arange(1, nlam+1)
+    ratio = float(nlam) / float(len(trace))
+    interpolates = InterpolatedUnivariateSpline(ratio*bin2size, trace, k=1)
+    return interpolates(bin1size)
+
+# ===========================================================================
+
+
+def aperture_weights(trace, width, extract_radius):
+    """Fractional-pixel weights of an extraction aperture.
+
+    Each pixel covers [j-0.5, j+0.5] in the cross-dispersion
+    direction and the aperture covers [trace-radius, trace+radius].
+    The weight of a pixel is the fraction of it that lies inside the
+    aperture, so a pixel only partly covered by the aperture edge
+    contributes only that fraction of its counts.
+
+    :RETURNS:
+      (nlam, width) array of weights between 0 and 1.
+    """
+    trace = np.asarray(trace, dtype=float).reshape(-1, 1)
+    columns = np.arange(width, dtype=float)
+    lower = np.maximum(columns - 0.5, trace - extract_radius)
+    upper = np.minimum(columns + 0.5, trace + extract_radius)
+    return np.clip(upper - lower, 0., 1.)
+
+# ===========================================================================
+
+
 def lampextract(frame,trace,extract_radius):
+    """Sum a 2D frame within an aperture around 'trace'.
+
+    :INPUTS:
+      frame : (nlam, width) array, dispersion along the first axis
+
+      trace : nlam-sequence of aperture centers
+
+      extract_radius : scalar, aperture half-width in pixels
+
+    :RETURNS:
+      (nlam, 1) array containing the extracted spectrum.
+    """
     nlam,width = frame.shape
+    weights = aperture_weights(trace, width, extract_radius)
+    standardSpectrum = (frame * weights).sum(1)
 
-    #trace.reshape(nlam,1) is the center of the fitted profile of the star
-    # xxx is the distance of the frame on either side of the fitted profile.
-    xxx = np.arange(width) - trace.reshape(nlam,1)
-    extractionApertures = np.abs(xxx) <= extract_radius
+    return standardSpectrum.reshape(nlam, 1)
+
+# ===========================================================================
 
-    standardSpectrum = np.zeros((nlam, 1), dtype=float)
-    for ii in range(nlam):
-        thisrow_good = extractionApertures[ii]
-        standardSpectrum[ii] = frame[ii, thisrow_good].sum()
 
-    return standardSpectrum
+def lampextract_multi(frames, trace, extract_radius):
+    """Extract several frames against the same trace in one call.
+
+    :INPUTS:
+      frames : sequence of (nlam, width) arrays, or an
+               (nframes, nlam, width) array.  All frames must have
+               the same shape.
+
+      trace : nlam-sequence of aperture centers (see :func:`rescale_trace`)
+
+      extract_radius : scalar, aperture half-width in pixels
+
+    :RETURNS:
+      (nframes, nlam) array; row k is the spectrum of frames[k].
+    """
+    frames = np.asarray(frames, dtype=float)
+    if frames.ndim == 2:
+        frames = frames.reshape((1,) + frames.shape)
+    nframes, nlam, width = frames.shape
+    weights = aperture_weights(trace, width, extract_radius)
+
+    return np.einsum('kij,ij->ki', frames, weights)
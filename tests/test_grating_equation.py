@@ -0,0 +1,38 @@
+'''
+Tests for the grating equation in grating_equation.py. Run with python -m pytest from the top directory.
+'''
+
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import grating_equation as ge
+
+#930 line/mm grating at 12/24 degrees, the blue setup (Param_930_12_24 in Wavelength_Calibration.py)
+ALPHA, THETA = 12., 24.
+FR, FD, FL, ZPNT = 92.517, 0.962, 377190., 1836.
+
+def test_pixels_inverts_wavelengths():
+    pixels = np.linspace(0., 4100., 200)
+    waves = ge.wavelengths(pixels, ALPHA, THETA, FR, FD, FL, ZPNT)
+    assert np.max(np.abs(ge.pixels(waves, ALPHA, THETA, FR, FD, FL, ZPNT) - pixels)) < 1e-6
+
+def test_wavelengths_inverts_pixels():
+    waves = np.linspace(3600., 5200., 200)
+    pixels = ge.pixels(waves, ALPHA, THETA, FR, FD, FL, ZPNT)
+    assert np.max(np.abs(ge.wavelengths(pixels, ALPHA, THETA, FR, FD, FL, ZPNT) - waves)) < 1e-6
+
+def test_zero_point_inverts_wavelengths():
+    #The zero point that puts each wavelength at its pixel is the one the wavelengths came from
+    pixels = np.linspace(0., 4100., 50)
+    waves = ge.wavelengths(pixels, ALPHA, THETA, FR, FD, FL, ZPNT)
+    zpoints = ge.zero_point(pixels, waves, ALPHA, THETA, FR, FD, FL)
+    assert np.max(np.abs(zpoints - ZPNT)) < 1e-6
+
+def test_dispersion_matches_finite_difference():
+    pixels = np.linspace(10., 4090., 50)
+    step = 1e-3
+    numeric = (ge.wavelengths(pixels + step, ALPHA, THETA, FR, FD, FL, ZPNT) - ge.wavelengths(pixels - step, ALPHA, THETA, FR, FD, FL, ZPNT))/(2.*step)
+    assert np.allclose(ge.dispersion(pixels, ALPHA, THETA, FR, FD, FL, ZPNT), numeric, rtol=1e-6)
@@ -0,0 +1,76 @@
+'''
+Tests for the resampling and binning kernels in spectools.py. Run with python -m pytest from the top directory.
+'''
+
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from spectools import resamplespec, rebinspec, errxy
+
+def lined_spectrum():
+    #Spectrum on a nonuniform wavelength grid, with a sloped continuum and two absorption lines
+    w0 = 3500. + 1.1*np.arange(1500) + 2e-5*np.arange(1500)**2.
+    spec0 = 1. + 1e-4*(w0 - 3500.) - 0.6*np.exp(-0.5*((w0 - 4340.5)/8.)**2.) - 0.4*np.exp(-0.5*((w0 - 4861.)/3.)**2.)
+    return w0, spec0
+
+def test_rebinspec_matches_resamplespec():
+    #rebinspec is the infinite oversampling limit of resamplespec, so they agree to within 1/oversamp of the spectrum
+    w0, spec0 = lined_spectrum()
+    w1 = np.linspace(3600., 5000., 500)
+    oversamp = 200
+    old = resamplespec(w1, w0, spec0, oversamp=oversamp)
+    new = rebinspec(w1, w0, spec0)
+    assert np.max(np.abs(new - old)) <= np.max(np.abs(spec0))/oversamp
+
+def test_rebinspec_conserves_flux():
+    #Binning onto every other old pixel center keeps the total, in units of old pixels
+    w0, spec0 = lined_spectrum()
+    w1 = w0[100:1400:2]
+    new = rebinspec(w1, w0, spec0)
+    x0 = np.arange(len(w0), dtype=float)
+    edges = np.interp(np.concatenate(([w1[0] - np.diff(w1).max()], 0.5*(w1[1:] + w1[:-1]), [w1[-1] + np.diff(w1).max()])), w0, x0)
+    fine = np.interp(np.linspace(edges[0], edges[-1], 200001), x0, spec0)
+    total = (fine.sum() - 0.5*(fine[0] + fine[-1]))*(edges[-1] - edges[0])/200000.
+    assert abs(new.sum() - total) < 1e-6*total
+
+def binned_reference(x, y, xbins):
+    #Per-bin statistics of y with a loop over the bins, using the errxy rule that a bin holds L <= x < R
+    stats = {'mean':[], 'median':[], 'sum':[], 'std':[], 'sdom':[], 'minmax':[]}
+    for left, right in zip(xbins[:-1], xbins[1:]):
+        data = y[(x >= left) & (x < right)]
+        if len(data) == 0:
+            stats['mean'].append(np.nan)
+            stats['median'].append(np.nan)
+            stats['sum'].append(0.)
+            stats['std'].append(np.nan)
+            stats['sdom'].append(np.nan)
+            stats['minmax'].append([np.nan, np.nan])
+            continue
+        stats['mean'].append(np.mean(data))
+        stats['median'].append(np.median(data))
+        stats['sum'].append(np.sum(data))
+        stats['std'].append(np.std(data))
+        stats['sdom'].append(np.std(data)/np.sqrt(len(data)))
+        stats['minmax'].append([np.mean(data) - np.min(data), np.max(data) - np.mean(data)])
+    return dict([(key, np.array(value)) for key, value in stats.items()])
+
+def test_errxy_matches_loop_over_bins():
+    #Counting from 0, bins 1, 3 and 6 are empty, bins 2 and 4 have one point, and some points fall outside every bin
+    rng = np.random.RandomState(5)
+    x = np.concatenate(([-5., 2.5, 4.5], rng.uniform(0., 1., 7), rng.uniform(5., 6., 4), rng.uniform(7., 8., 9), [20.]))
+    y = rng.normal(10., 2., len(x))
+    order = rng.permutation(len(x))
+    x, y = x[order], y[order]
+    xbins = np.array([0., 1., 2., 3., 4., 5., 6., 7., 8.])
+    reference = binned_reference(x, y, xbins)
+    for ymode in ['mean', 'median', 'sum']:
+        xx, yy, exx, eyy = errxy(x, y, xbins, xmode=None, ymode=ymode, xerr=None, yerr=None)
+        assert np.allclose(yy, reference[ymode], equal_nan=True)
+    for yerr in ['std', 'sdom']:
+        xx, yy, exx, eyy = errxy(x, y, xbins, xmode=None, ymode='mean', xerr=None, yerr=yerr)
+        assert np.allclose(eyy, reference[yerr], equal_nan=True)
+    xx, yy, exx, eyy = errxy(x, y, xbins, xmode=None, ymode='mean', xerr=None, yerr='minmax')
+    assert np.allclose(eyy, np.transpose(reference['minmax']), equal_nan=True)
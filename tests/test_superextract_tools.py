@@ -0,0 +1,42 @@
+'''
+Tests for the background fits in superextract_tools.py. Run with python -m pytest from the top directory.
+'''
+
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from superextract_tools import polyfitr, polyfitr_multi
+
+def sky_rows(nrows=50, ncols=40, seed=3):
+    #Sloped sky with unit noise, a few cosmic rays in each row, and the true sky without them
+    rng = np.random.RandomState(seed)
+    columns = np.arange(ncols, dtype=float)
+    sky = 100. + 0.5*columns + np.zeros((nrows, 1))
+    frame = sky + rng.normal(0., 1., sky.shape)
+    for row in range(nrows):
+        frame[row, rng.randint(0, ncols, 3)] += 50.
+    return columns, frame, sky
+
+def test_multi_matches_batch_polyfitr():
+    #Fitting every row at once must give the same fit as polyfitr with batch rejection on each row
+    columns, frame, sky = sky_rows()
+    weights = np.ones(frame.shape)
+    fits, good, npass = polyfitr_multi(columns, frame, 1, 3., w=weights, maxpass=10)
+    assert good.all()
+    for row in range(frame.shape[0]):
+        fit = polyfitr(columns, frame[row], 1, 3., w=weights[row], reject='batch', maxpass=10)
+        assert np.allclose(fits[row], fit, rtol=1e-6, atol=1e-8)
+
+def test_multi_agrees_with_single_rejection():
+    #The multi background and the default one (rows, one point rejected per iteration) both remove the cosmic rays
+    columns, frame, sky = sky_rows()
+    weights = np.ones(frame.shape)
+    fits, good, npass = polyfitr_multi(columns, frame, 1, 3., w=weights, maxpass=10)
+    for row in range(frame.shape[0]):
+        multi = np.polyval(fits[row], columns)
+        single = np.polyval(polyfitr(columns, frame[row], 1, 3., w=weights[row]), columns)
+        assert np.max(np.abs(multi - sky[row])) < 1.5
+        assert np.max(np.abs(multi - single)) < 0.5
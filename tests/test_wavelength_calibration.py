@@ -0,0 +1,36 @@
+'''
+Tests for the starting wavelength solution in Wavelength_Calibration.py. Run with python -m pytest from the top directory.
+'''
+
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import Wavelength_Calibration as wc
+import grating_equation as ge
+
+LAMP = 'tFe_ZZCeti_930_blue.ms.fits'
+HEADER = {'CCDSEC':'[9:2055,1:200]', 'PARAM18':2, 'GRT_TARG':12., 'CAM_TARG':24., 'DATE-OBS':'2016-05-26'}
+
+def test_offset_file_applied_once(tmpdir, monkeypatch):
+    #The same lamp calibrated twice with an offset file must start from the same wavelengths,
+    #even though the second run starts from the solution saved by the first.
+    monkeypatch.setenv('ZZCETI_SOLUTIONS', str(tmpdir.join('store')))
+    offset_file = tmpdir.join('offsets.txt')
+    offset_file.write('20.0\n-15.0\n')
+    Pixels = ge.header_pixels(HEADER, 1000)
+
+    parm1, waves1, offset1 = wc.starting_solution(LAMP, HEADER, Pixels, wc.Param_930_12_24, str(offset_file))
+    assert offset1 == 20.
+
+    #Save a solution that reproduces the first starting wavelengths, as a fit would
+    center = len(Pixels)//2
+    fr, fd, fl, zPnt = parm1
+    newzpoint = ge.zero_point(Pixels[center], waves1[center], 12., 24., fr, fd, fl)
+    wc.save_solution(LAMP, HEADER, [fr, fd, newzpoint], fl, 0.1)
+
+    parm2, waves2, offset2 = wc.starting_solution(LAMP, HEADER, Pixels, wc.Param_930_12_24, str(offset_file))
+    assert offset2 == 0.
+    assert np.max(np.abs(np.array(waves2) - np.array(waves1))) < 1.